@@ -4,6 +4,7 @@ import os
 import arcpy
 
 from src.utils import arcpy_utils as au
+from src.utils.scratch import ScratchWorkspace
 
 
 class GeometryAttributes:
@@ -36,6 +37,15 @@ class GeometryAttributes:
         self.top_filename = point_filename
         self.logger = logger or logging.getLogger(__name__)
 
+    def _temp_path(self, scratch, name: str, keep_temp: bool) -> str:
+        """
+        Returns the path of a temporary feature class.
+        Kept features are written to the filegdb, all others to the scratch workspace.
+        """
+        if keep_temp:
+            return os.path.join(self.path, name)
+        return scratch.path(name)
+
     def attr_crownArea(self):
         """
         Calculates the crown area and perimeter attributes and adds them to the crown feature class.
@@ -161,77 +171,79 @@ class GeometryAttributes:
                 - extreme outlier (2) if ratio crown area / enclosing circle area < 0.02... "
         )
 
-        v_enclosing_circle = os.path.join(self.path, "enclosing_circle_temp")
-
-        # calculate enclosing circle
-        arcpy.MinimumBoundingGeometry_management(
-            self.crown_filename,
-            v_enclosing_circle,
-            "CIRCLE",
-            "NONE",
-            "",
-            "MBG_FIELDS",
-        )
-
-        # add attribute fields
-        field_list = ["EC_diam", "EC_area", "ratio_CA_ECA"]
-
-        for field in field_list:
-            au.addField_ifNotExists(self.crown_filename, field, "FLOAT")
-
-        au.addField_ifNotExists(self.crown_filename, "outlier_ratio_CA_ECA", "SHORT")
-
-        # fill attribute fields
-        if (
-            au.check_isNull(self.crown_filename, "EC_diam", "FLOAT") == True
-            or au.check_isNull(self.crown_filename, "EC_area", "FLOAT") == True
-        ):
-            # EC_diam and EC_area
-            au.join_and_copy(
-                t_dest=self.crown_filename,
-                join_a_dest="crown_id",
-                t_src=v_enclosing_circle,
-                join_a_src="crown_id",
-                a_src=["MBG_Diameter", "Shape_Area"],
-                a_dest=["EC_diam", "EC_area"],
+        with ScratchWorkspace(self.path, require_geometry_fields=True) as scratch:
+            v_enclosing_circle = self._temp_path(
+                scratch, "enclosing_circle_temp", keep_temp
             )
 
-            # calculate ratio crown area / enclosing circle area
-            arcpy.CalculateField_management(
-                in_table=self.crown_filename,
-                field="ratio_CA_ECA",
-                expression="!crown_area! / !EC_area!",
-                expression_type="PYTHON3",
+            # calculate enclosing circle
+            arcpy.MinimumBoundingGeometry_management(
+                self.crown_filename,
+                v_enclosing_circle,
+                "CIRCLE",
+                "NONE",
+                "",
+                "MBG_FIELDS",
             )
-        else:
-            self.logger.info(
-                "\tAll rows in field are already populated. Exiting function."
-            )
-            # classify tree crown as normal, mild outlier or extreme outlier
 
-        if (
-            au.check_isNull(self.crown_filename, "outlier_ratio_CA_ECA", "SHORT")
-            == True
-        ):
-            with arcpy.da.UpdateCursor(
-                self.crown_filename, ["ratio_CA_ECA", "outlier_ratio_CA_ECA"]
-            ) as cursor:
-                for row in cursor:
-                    if row[0] >= 0.25:
-                        row[1] = 0
-                    elif row[0] < 0.25 and row[0] >= 0.02:
-                        row[1] = 1
-                    else:
-                        row[1] = 2
-                    cursor.updateRow(row)
+            # add attribute fields
+            field_list = ["EC_diam", "EC_area", "ratio_CA_ECA"]
 
-        else:
-            self.logger.info(
-                "\tAll rows in field are already populated. Exiting function."
+            for field in field_list:
+                au.addField_ifNotExists(self.crown_filename, field, "FLOAT")
+
+            au.addField_ifNotExists(
+                self.crown_filename, "outlier_ratio_CA_ECA", "SHORT"
             )
 
-        if keep_temp == False:
-            arcpy.Delete_management(v_enclosing_circle)
+            # fill attribute fields
+            if (
+                au.check_isNull(self.crown_filename, "EC_diam", "FLOAT") == True
+                or au.check_isNull(self.crown_filename, "EC_area", "FLOAT") == True
+            ):
+                # EC_diam and EC_area
+                au.join_and_copy(
+                    t_dest=self.crown_filename,
+                    join_a_dest="crown_id",
+                    t_src=v_enclosing_circle,
+                    join_a_src="crown_id",
+                    a_src=["MBG_Diameter", "Shape_Area"],
+                    a_dest=["EC_diam", "EC_area"],
+                )
+
+                # calculate ratio crown area / enclosing circle area
+                arcpy.CalculateField_management(
+                    in_table=self.crown_filename,
+                    field="ratio_CA_ECA",
+                    expression="!crown_area! / !EC_area!",
+                    expression_type="PYTHON3",
+                )
+            else:
+                self.logger.info(
+                    "\tAll rows in field are already populated. Exiting function."
+                )
+                # classify tree crown as normal, mild outlier or extreme outlier
+
+            if (
+                au.check_isNull(self.crown_filename, "outlier_ratio_CA_ECA", "SHORT")
+                == True
+            ):
+                with arcpy.da.UpdateCursor(
+                    self.crown_filename, ["ratio_CA_ECA", "outlier_ratio_CA_ECA"]
+                ) as cursor:
+                    for row in cursor:
+                        if row[0] >= 0.25:
+                            row[1] = 0
+                        elif row[0] < 0.25 and row[0] >= 0.02:
+                            row[1] = 1
+                        else:
+                            row[1] = 2
+                        cursor.updateRow(row)
+
+            else:
+                self.logger.info(
+                    "\tAll rows in field are already populated. Exiting function."
+                )
 
         au.round_fields_two_decimals(
             self.crown_filename, ["EC_diam", "EC_area", "ratio_CA_ECA"]
@@ -269,64 +281,64 @@ class GeometryAttributes:
                 - extreme outlier (2) if ratio crown area / convex hull area < 0.6... "
         )
 
-        v_convex_hull = os.path.join(self.path, "convex_hull_temp")
-
-        field_list = ["CH_length", "CH_width", "CH_area", "ratio_CA_CHA"]
-
-        for field in field_list:
-            au.addField_ifNotExists(self.crown_filename, field, "FLOAT")
+        with ScratchWorkspace(self.path, require_geometry_fields=True) as scratch:
+            v_convex_hull = self._temp_path(scratch, "convex_hull_temp", keep_temp)
 
-        au.addField_ifNotExists(self.crown_filename, "outlier_ratio_CA_CHA", "SHORT")
+            field_list = ["CH_length", "CH_width", "CH_area", "ratio_CA_CHA"]
 
-        arcpy.MinimumBoundingGeometry_management(
-            self.crown_filename,
-            v_convex_hull,
-            "CONVEX_HULL",
-            "NONE",
-            "",
-            "MBG_FIELDS",
-        )
+            for field in field_list:
+                au.addField_ifNotExists(self.crown_filename, field, "FLOAT")
 
-        # fill attribute fields
-        if au.check_isNull(self.crown_filename, field, "FLOAT") == True:
-            # CH_length, CH_width and CH_area
-            au.join_and_copy(
-                t_dest=self.crown_filename,
-                join_a_dest="crown_id",
-                t_src=v_convex_hull,
-                join_a_src="crown_id",
-                a_src=["MBG_Length", "MBG_Width", "Shape_Area"],
-                a_dest=["CH_length", "CH_width", "CH_area"],
-            )
-            # arcpy.Delete_management(v_convex_hull)
-
-            # calculate ratio crown area / convex hull area
-            arcpy.CalculateField_management(
-                in_table=self.crown_filename,
-                field="ratio_CA_CHA",
-                expression="!crown_area! / !CH_area!",
-                expression_type="PYTHON3",
+            au.addField_ifNotExists(
+                self.crown_filename, "outlier_ratio_CA_CHA", "SHORT"
             )
 
-            with arcpy.da.UpdateCursor(
-                self.crown_filename, ["ratio_CA_CHA", "outlier_ratio_CA_CHA"]
-            ) as cursor:
-                for row in cursor:
-                    if row[0] >= 0.7:
-                        row[1] = 0
-                    elif row[0] < 0.7 and row[0] >= 0.6:
-                        row[1] = 1
-                    else:
-                        row[1] = 2
-                    cursor.updateRow(row)
-
-        else:
-            self.logger.info(
-                "\tAll rows in field are already populated. Exiting function."
+            arcpy.MinimumBoundingGeometry_management(
+                self.crown_filename,
+                v_convex_hull,
+                "CONVEX_HULL",
+                "NONE",
+                "",
+                "MBG_FIELDS",
             )
 
-        if keep_temp == False:
-            arcpy.Delete_management(v_convex_hull)
+            # fill attribute fields
+            if au.check_isNull(self.crown_filename, field, "FLOAT") == True:
+                # CH_length, CH_width and CH_area
+                au.join_and_copy(
+                    t_dest=self.crown_filename,
+                    join_a_dest="crown_id",
+                    t_src=v_convex_hull,
+                    join_a_src="crown_id",
+                    a_src=["MBG_Length", "MBG_Width", "Shape_Area"],
+                    a_dest=["CH_length", "CH_width", "CH_area"],
+                )
+                # arcpy.Delete_management(v_convex_hull)
+
+                # calculate ratio crown area / convex hull area
+                arcpy.CalculateField_management(
+                    in_table=self.crown_filename,
+                    field="ratio_CA_CHA",
+                    expression="!crown_area! / !CH_area!",
+                    expression_type="PYTHON3",
+                )
+
+                with arcpy.da.UpdateCursor(
+                    self.crown_filename, ["ratio_CA_CHA", "outlier_ratio_CA_CHA"]
+                ) as cursor:
+                    for row in cursor:
+                        if row[0] >= 0.7:
+                            row[1] = 0
+                        elif row[0] < 0.7 and row[0] >= 0.6:
+                            row[1] = 1
+                        else:
+                            row[1] = 2
+                        cursor.updateRow(row)
+
+            else:
+                self.logger.info(
+                    "\tAll rows in field are already populated. Exiting function."
+                )
 
         au.round_fields_two_decimals(
             self.crown_filename,
@@ -357,56 +369,57 @@ class GeometryAttributes:
         self.logger.info("\tATTRIBUTE | EV_area:")
         self.logger.info("\tComputing the envelope area... ")
 
-        v_envelope = os.path.join(self.path, "envelope_temp")
-        arcpy.MinimumBoundingGeometry_management(
-            self.crown_filename,
-            v_envelope,
-            "ENVELOPE",
-            "NONE",
-            "",
-            "MBG_FIELDS",
-        )
-
-        field_list_crown = [
-            "EV_length",
-            "EV_width",
-            "EV_area",
-            "EV_angle",
-            "NS_width",
-            "ES_width",
-        ]
-
-        for field in field_list_crown:
-            au.addField_ifNotExists(self.crown_filename, field, "FLOAT")
-
-        field_list_envelop = ["EV_angle", "NS_width", "ES_width"]
-        for field in field_list_envelop:
-            au.addField_ifNotExists(v_envelope, field, "FLOAT")
-
-        # fill attribute fields
-        if (
-            au.check_isNull(self.crown_filename, "EV_length", "FLOAT") == True
-            or au.check_isNull(self.crown_filename, "EV_width", "FLOAT") == True
-            or au.check_isNull(self.crown_filename, "EV_area", "FLOAT") == True
-        ):
-            # CH_length, CH_width and CH_area
-            au.join_and_copy(
-                t_dest=self.crown_filename,
-                join_a_dest="crown_id",
-                t_src=v_envelope,
-                join_a_src="crown_id",
-                a_src=["MBG_Length", "MBG_Width", "Shape_Area"],
-                a_dest=["EV_length", "EV_width", "EV_area"],
-            )
-            # arcpy.Delete_management(v_convex_hull)
-
-        else:
-            self.logger.info(
-                "\tAll rows in field are already populated. Exiting function."
+        with ScratchWorkspace(self.path, require_geometry_fields=True) as scratch:
+            v_envelope = self._temp_path(scratch, "envelope_temp", keep_temp)
+            arcpy.MinimumBoundingGeometry_management(
+                self.crown_filename,
+                v_envelope,
+                "ENVELOPE",
+                "NONE",
+                "",
+                "MBG_FIELDS",
             )
 
-        # Calculate angle and NS and ES width
-        codeblock = """def classify_envAngle(envelope_width, envelope_length, envelope_angle, computed_measure):
+            field_list_crown = [
+                "EV_length",
+                "EV_width",
+                "EV_area",
+                "EV_angle",
+                "NS_width",
+                "ES_width",
+            ]
+
+            for field in field_list_crown:
+                au.addField_ifNotExists(self.crown_filename, field, "FLOAT")
+
+            field_list_envelop = ["EV_angle", "NS_width", "ES_width"]
+            for field in field_list_envelop:
+                au.addField_ifNotExists(v_envelope, field, "FLOAT")
+
+            # fill attribute fields
+            if (
+                au.check_isNull(self.crown_filename, "EV_length", "FLOAT") == True
+                or au.check_isNull(self.crown_filename, "EV_width", "FLOAT") == True
+                or au.check_isNull(self.crown_filename, "EV_area", "FLOAT") == True
+            ):
+                # CH_length, CH_width and CH_area
+                au.join_and_copy(
+                    t_dest=self.crown_filename,
+                    join_a_dest="crown_id",
+                    t_src=v_envelope,
+                    join_a_src="crown_id",
+                    a_src=["MBG_Length", "MBG_Width", "Shape_Area"],
+                    a_dest=["EV_length", "EV_width", "EV_area"],
+                )
+                # arcpy.Delete_management(v_convex_hull)
+
+            else:
+                self.logger.info(
+                    "\tAll rows in field are already populated. Exiting function."
+                )
+
+            # Calculate angle and NS and ES width
+            codeblock = """def classify_envAngle(envelope_width, envelope_length, envelope_angle, computed_measure):
                         eps = 1e-2
                         if abs(envelope_angle+90) < eps:
                             if computed_measure == "NS":
@@ -426,41 +439,38 @@ class GeometryAttributes:
                             return None
                     """
 
-        if au.check_isNull(self.crown_filename, "EV_angle", "FLOAT") == True:
-            arcpy.CalculatePolygonMainAngle_cartography(
-                v_envelope, "EV_angle", "GEOGRAPHIC"
-            )
-            arcpy.CalculateField_management(
-                in_table=v_envelope,
-                field="NS_width",
-                expression="classify_envAngle(!MBG_Width!, !MBG_Length!, !EV_angle!, 'NS')",
-                expression_type="PYTHON_9.3",
-                code_block=codeblock,
-            )
-            arcpy.CalculateField_management(
-                in_table=v_envelope,
-                field="ES_width",
-                expression="classify_envAngle(!MBG_Width!, !MBG_Length!, !EV_angle!, 'EW')",
-                expression_type="PYTHON_9.3",
-                code_block=codeblock,
-            )
-            # join measures to corresponding crown polygon
-            au.join_and_copy(
-                t_dest=self.crown_filename,
-                join_a_dest="crown_id",
-                t_src=v_envelope,
-                join_a_src="crown_id",
-                a_src=["EV_angle", "NS_width", "ES_width"],
-                a_dest=["EV_angle", "NS_width", "ES_width"],
-            )
-
-        else:
-            self.logger.info(
-                "\tAll rows in field are already populated. Exiting function."
-            )
-
-        if keep_temp == False:
-            arcpy.Delete_management(v_envelope)
+            if au.check_isNull(self.crown_filename, "EV_angle", "FLOAT") == True:
+                arcpy.CalculatePolygonMainAngle_cartography(
+                    v_envelope, "EV_angle", "GEOGRAPHIC"
+                )
+                arcpy.CalculateField_management(
+                    in_table=v_envelope,
+                    field="NS_width",
+                    expression="classify_envAngle(!MBG_Width!, !MBG_Length!, !EV_angle!, 'NS')",
+                    expression_type="PYTHON_9.3",
+                    code_block=codeblock,
+                )
+                arcpy.CalculateField_management(
+                    in_table=v_envelope,
+                    field="ES_width",
+                    expression="classify_envAngle(!MBG_Width!, !MBG_Length!, !EV_angle!, 'EW')",
+                    expression_type="PYTHON_9.3",
+                    code_block=codeblock,
+                )
+                # join measures to corresponding crown polygon
+                au.join_and_copy(
+                    t_dest=self.crown_filename,
+                    join_a_dest="crown_id",
+                    t_src=v_envelope,
+                    join_a_src="crown_id",
+                    a_src=["EV_angle", "NS_width", "ES_width"],
+                    a_dest=["EV_angle", "NS_width", "ES_width"],
+                )
+
+            else:
+                self.logger.info(
+                    "\tAll rows in field are already populated. Exiting function."
+                )
 
         au.round_fields_two_decimals(
             self.crown_filename,
@@ -483,35 +493,35 @@ class GeometryAttributes:
         self.logger.info(
             "\tComputing the crown diameter as maximum length of the convex hull... "
         )
-        v_mbg = os.path.join(self.path, "mbg_temp")
-        arcpy.MinimumBoundingGeometry_management(
-            self.crown_filename,
-            v_mbg,
-            "CONVEX_HULL",  # tree_detection_v1 uses "CIRCLE"
-            "NONE",
-            "",
-            "MBG_FIELDS",
-        )
-
-        in_table = self.crown_filename
-        field = "crown_diam"
-
-        self.logger.info("\tAdding the attribute <<crown_diam>>... ")
-        au.addField_ifNotExists(in_table, field, "FLOAT")
-
-        if au.check_isNull(in_table, field, "FLOAT") == True:
-            au.join_and_copy(
-                t_dest=self.crown_filename,
-                join_a_dest="crown_id",
-                t_src=v_mbg,
-                join_a_src="crown_id",
-                a_src=["MBG_Length"],
-                a_dest=["crown_diam"],
-            )
-            arcpy.Delete_management(v_mbg)
-        else:
-            self.logger.info(
-                "\tAll rows in field are already populated. Exiting function."
+        with ScratchWorkspace(self.path, require_geometry_fields=True) as scratch:
+            v_mbg = scratch.path("mbg_temp")
+            arcpy.MinimumBoundingGeometry_management(
+                self.crown_filename,
+                v_mbg,
+                "CONVEX_HULL",  # tree_detection_v1 uses "CIRCLE"
+                "NONE",
+                "",
+                "MBG_FIELDS",
             )
 
+            in_table = self.crown_filename
+            field = "crown_diam"
+
+            self.logger.info("\tAdding the attribute <<crown_diam>>... ")
+            au.addField_ifNotExists(in_table, field, "FLOAT")
+
+            if au.check_isNull(in_table, field, "FLOAT") == True:
+                au.join_and_copy(
+                    t_dest=self.crown_filename,
+                    join_a_dest="crown_id",
+                    t_src=v_mbg,
+                    join_a_src="crown_id",
+                    a_src=["MBG_Length"],
+                    a_dest=["crown_diam"],
+                )
+            else:
+                self.logger.info(
+                    "\tAll rows in field are already populated. Exiting function."
+                )
+
         au.round_fields_two_decimals(self.crown_filename, ["crown_diam"])
@@ -13,11 +13,13 @@ from src.utils import arcpy_utils as au
 
 
 # insitu crowns/stems
-def neighbourhood_stem(v_stem_path, v_crown_path, filegdb_path, v_neighbourhoods):
+def neighbourhood_stem(
+    v_stem_path, v_crown_path, filegdb_path, v_neighbourhoods, overwrite=False
+):
     au.createGDB_ifNotExists(filegdb_path)
     logger = logging.getLogger(__name__)
     fc_output = os.path.join(filegdb_path, "nb_tree_stem")
-    if arcpy.Exists(fc_output):
+    if arcpy.Exists(fc_output) and not overwrite:
         logger.info("Neighbourhood layer already exists. Skipping...")
         return
 
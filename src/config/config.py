@@ -1,6 +1,30 @@
-"""Project configuration"""
+"""
+Project configuration
 
+parameters.yaml and catalog.yaml are parsed once per process and cached; a
+file is parsed again only when its modification time or size changes.
+Parameters are validated when they are (re)loaded. get_config() returns a
+Config object of the cached files with the per-run overrides applied,
+load_parameters() and load_catalog() return copies of its dicts, so callers
+may modify them.
+
+Per-run overrides (deep merged into parameters.yaml):
+- override(...): context manager, e.g. for one run in this process
+- MUNICIPALITY_ENV: environment variable of the municipality, inherited by
+  child processes (RunContext.activate())
+
+Example:
+--------
+config = get_config()
+config.municipality, config.extrapolation()["output"]["filepath_csv"]
+
+with override(municipality="bodo", prediction={"workers": 2}):
+    extrapolate_data.run()
+"""
+
+import copy
 import os
+from contextlib import contextmanager
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -21,43 +45,215 @@ load_dotenv(dotenv_path)
 project_root = Path(__file__).parents[2]
 config_file = os.path.join(project_root, "config/config.yaml")
 
+# overrides the municipality of parameters.yaml in this process (and its child
+# processes), set by src.extrapolation.run_context.RunContext.activate()
+MUNICIPALITY_ENV = "TREKRONER_MUNICIPALITY"
+
 
 # --------------------------------------------------------------------------- #
-def load_catalog():
-    """Load catalog from yaml file.
+# Validation
+# --------------------------------------------------------------------------- #
+MODEL_FAMILIES = ("rf_total_cap", "rf_individual_es", "rf_carbon_es")
+MUNICIPALITY_KEYS = {"ref_id": str, "target_id": str, "col_species": str}
+MODEL_OPTION_KEYS = {
+    "test_size": float,
+    "random_state": int,
+    "response": (list, str),
+    "predictors": list,
+}
+SECTIONS = (
+    "scratch_workspace",
+    "profiler",
+    "gp_instrumentation",
+    "metrics",
+    "prediction",
+    "species_imputation",
+    "model_registry",
+    "reporting",
+    "bootstrap",
+    "rule_3_30_300",
+)
 
-    Returns
-    -------
-    dict: catalog
+
+def _check(errors, section, values, keys):
+    if not isinstance(values, dict):
+        errors.append(f"<{section}> is not a mapping")
+        return
+    for key, types in keys.items():
+        if key not in values:
+            errors.append(f"<{section}: {key}> is missing")
+        elif types is float and isinstance(values[key], (int, float)):
+            continue
+        elif not isinstance(values[key], types):
+            errors.append(f"<{section}: {key}> has type {type(values[key]).__name__}")
+
+
+def validate_parameters(parameters):
+    """Raise ValueError listing all schema violations of parameters."""
+    errors = []
+    municipality = parameters.get("municipality")
+    if not isinstance(municipality, str):
+        errors.append("<municipality> is missing")
+    elif municipality not in parameters:
+        errors.append(f"<municipality: {municipality}> has no parameter section")
+    else:
+        _check(errors, municipality, parameters[municipality], MUNICIPALITY_KEYS)
+
+    for key in ("cols_int", "cols_float"):
+        if not isinstance(parameters.get(key), list):
+            errors.append(f"<{key}> is not a list")
+    for family in MODEL_FAMILIES:
+        if family in parameters:
+            options = (parameters[family] or {}).get("model_options")
+            _check(errors, f"{family}: model_options", options, MODEL_OPTION_KEYS)
+    for section in SECTIONS:
+        if parameters.get(section) is not None:
+            _check(errors, section, parameters[section], {})
+
+    if errors:
+        raise ValueError("Invalid parameters.yaml: " + "; ".join(errors))
+
+
+# --------------------------------------------------------------------------- #
+# Cached configuration
+# --------------------------------------------------------------------------- #
+_files = {}  # {path: ((mtime_ns, size), parsed yaml)}
+_overrides = {}
+
+
+def _read_yaml(path, validate=None):
+    """Parsed yaml file, cached until its modification time or size changes."""
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _files.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    with open(path, "r") as f:
+        data = yaml_load(f)
+    if validate is not None:
+        validate(data)
+    _files[path] = (stamp, data)
+    return data
+
+
+def _merge(base, overrides):
+    merged = dict(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class Config:
     """
-    catalog = os.path.join(project_root, "config/catalog.yaml")
-    with open(catalog, "r") as f:
-        catalog = yaml_load(f)
+    Validated parameters and catalog of the current run (read-only, use
+    load_parameters() and load_catalog() for copies that may be modified).
 
-    # replace municipality variable with correct municipality
-    municipality = load_parameters()["municipality"]
+    Attributes:
+    -----------
+    parameters : dict
+        parameters.yaml with the overrides applied
+    catalog : dict
+        catalog.yaml, <<municipality>> replaced in the filepaths
+    municipality : str
+        municipality of the run
 
+    Methods:
+    --------
+    - extrapolation(self, municipality)
+    - model_options(self, family)
+    """
+
+    def __init__(self, parameters, catalog):
+        self.parameters = parameters
+        self.catalog = catalog
+        self.municipality = parameters["municipality"]
+
+    def extrapolation(self, municipality=None) -> dict:
+        """<municipality>_extrapolation section of the catalog."""
+        return self.catalog[f"{municipality or self.municipality}_extrapolation"]
+
+    def model_options(self, family) -> dict:
+        """model_options of rf_total_cap, rf_individual_es or rf_carbon_es."""
+        return self.parameters[family]["model_options"]
+
+
+def _run_overrides() -> dict:
+    overrides = dict(_overrides)
+    if os.environ.get(MUNICIPALITY_ENV) and "municipality" not in overrides:
+        overrides["municipality"] = os.environ[MUNICIPALITY_ENV]
+    return overrides
+
+
+_config = {}  # {(parameters, catalog, overrides): Config}
+
+
+def get_config() -> Config:
+    """Config of this process, rebuilt when a yaml file or the overrides change."""
+    parameters_file = os.path.join(project_root, "config/parameters.yaml")
+    catalog_file = os.path.join(project_root, "config/catalog.yaml")
+    parameters = _read_yaml(parameters_file, validate_parameters)
+    catalog = _read_yaml(catalog_file)
+    overrides = _run_overrides()
+
+    key = (_files[parameters_file][0], _files[catalog_file][0], repr(overrides))
+    if key not in _config:
+        if overrides:
+            parameters = _merge(parameters, overrides)
+            validate_parameters(parameters)
+        _config.clear()
+        _config[key] = Config(parameters, _substitute(catalog, parameters))
+    return _config[key]
+
+
+def _substitute(catalog, parameters) -> dict:
+    # replace municipality variable with correct municipality
+    municipality = parameters["municipality"]
+    catalog = dict(catalog)
     for key, value in catalog.items():
         # replace municipality in filepath
-        if "filepath" in catalog[key]:
+        if isinstance(value, dict) and "filepath" in value:
+            catalog[key] = dict(value)
             catalog[key]["filepath"] = value["filepath"].replace(
                 "<<municipality>>", municipality
             )
-
     return catalog
 
 
+@contextmanager
+def override(**parameters):
+    """Override parameters (deep merged) within the with block."""
+    previous = dict(_overrides)
+    _overrides.update(parameters)
+    try:
+        yield get_config()
+    finally:
+        _overrides.clear()
+        _overrides.update(previous)
+
+
+# --------------------------------------------------------------------------- #
+def load_catalog():
+    """Load catalog from yaml file (cached, see get_config).
+
+    Returns
+    -------
+    dict: catalog
+    """
+    return copy.deepcopy(get_config().catalog)
+
+
 def load_parameters():
-    """Load parameters from yaml file
+    """Load parameters from yaml file (cached and validated, see get_config).
 
     Returns
     -------
     dict: parameters
     """
-    parameters = os.path.join(project_root, "config/parameters.yaml")
-    with open(parameters, "r") as f:
-        parameters = yaml_load(f)
-    return parameters
+    return copy.deepcopy(get_config().parameters)
 
 
 # --------------------------------------------------------------------------- #
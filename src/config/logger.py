@@ -58,6 +58,14 @@ def setup_logging(
             project_dir, "log", logfile_name
         )
 
+        # update metrics file handler (json lines)
+        if "metrics_file_handler" in config["handlers"]:
+            config["handlers"]["metrics_file_handler"]["filename"] = os.path.join(
+                project_dir,
+                "log",
+                os.path.splitext(logfile_name)[0] + "_metrics.jsonl",
+            )
+
         # load configuration
         logging.config.dictConfig(config)
         logging.info("Logging configuration file found and loaded.")
@@ -1,62 +1,154 @@
 import logging
 import os
+import time
+
+import pandas as pd
 
 import src.utils.decorators as dec
-from src.config.config import load_catalog, load_parameters
 from src.config.logger import setup_logging
-from src.extrapolation import clean_reference, clean_target, export_results, regressor
+from src.extrapolation import (
+    bootstrap,
+    clean_reference,
+    clean_target,
+    design_matrix,
+    export_results,
+    model_registry,
+    regressor,
+    schema,
+    streaming,
+)
+from src.extrapolation.run_context import RunContext
+from src.utils import profiler
 
 
 @dec.timer
-def prepare_data():
+def prepare_data(overwrite=False, ctx=None):
     # Clean data
     # ---------------------------
     # fill missing values for dbh based on height or crown_diam
-    # encode categorical variables
-    municipality = load_parameters()["municipality"]
+    # (baerum uses the oslo reference trees, see RunContext)
+    # with streaming prediction the target is not loaded (df_target is None),
+    # predict_parquet reads it by row group
+    ctx = ctx or RunContext()
+
+    df_ref = clean_reference.main(
+        col_id=ctx.ref_id,
+        col_species=ctx.col_species,
+        overwrite=overwrite,
+        municipality=ctx.municipality,
+    )
+    df_target = clean_target.main(
+        col_id=ctx.target_id,
+        col_species=ctx.col_species,
+        overwrite=overwrite,
+        municipality=ctx.municipality,
+        load=not streaming.is_enabled(),
+    )
+
+    return df_ref, df_target
 
-    if municipality == "baerum":
-        params = load_parameters()
-        ref_id = params["oslo"]["ref_id"]
-        target_id = params["baerum"]["target_id"]
-        col_species = params["baerum"]["col_species"]
 
-        df_ref = clean_reference.main(col_id=ref_id, col_species=col_species)
-        df_target = clean_target.main(col_id=target_id, col_species=col_species)
+def _get_model(
+    X_train,
+    y_train,
+    predictors,
+    response,
+    model_params,
+    municipality,
+    file_prefix,
+    overwrite=False,
+    ctx=None,
+):
+    """
+    Load the model from the registry if it was trained on the same data,
+    predictors, response and parameters, else train (and tune) a new model
+    and store it in the registry. The models and their parameters are exported
+    to the model folder of the municipality of ctx.
 
-        return df_ref, df_target
+    Returns:
+        regression_model, registry, key
+    """
+    ctx = ctx or RunContext()
+    registry = model_registry.ModelRegistry(municipality=municipality)
+
+    estimator = "linear_regression" if municipality == "kristiansand" else "rf"
+    # all responses of the model group are listed in model_options
+    options = dict(model_params["model_options"])
+    options.pop("response", None)
+    params = {"estimator": estimator, **options}
+    key = registry.key(X_train, y_train, predictors, response, params)
+
+    regression_model = None if overwrite else registry.load(key)
+    if regression_model is None:
+        start = time.perf_counter()
+        if municipality == "kristiansand":
+            regression_model = regressor.linear_regression(
+                X_train, y_train, file_prefix, municipality=ctx.municipality
+            )
+        else:
+            regression_model = regressor.tune_rf(
+                X_train,
+                y_train,
+                model_params=model_params["model_options"],
+                file_prefix=file_prefix,
+                municipality=ctx.municipality,
+            )
+        train_s = round(time.perf_counter() - start, 1)
+
+        info = {}
+        if estimator == "rf":
+            info["best_params"] = {
+                "max_features": regression_model.max_features,
+                "n_estimators": regression_model.n_estimators,
+            }
+        registry.store(
+            key,
+            regression_model,
+            file_prefix=file_prefix,
+            response=list(response),
+            predictors=list(predictors),
+            params=params,
+            n_train=len(X_train),
+            train_s=train_s,
+            **info,
+        )
 
-    else:
-        params = load_parameters()
-        ref_id = params[municipality]["ref_id"]
-        target_id = params[municipality]["target_id"]
-        col_species = params[municipality]["col_species"]
+    return regression_model, registry, key
 
-        df_ref = clean_reference.main(col_id=ref_id, col_species=col_species)
-        df_target = clean_target.main(col_id=target_id, col_species=col_species)
 
-        return df_ref, df_target
+def _design(df_ref, df_target, predictors, responses, ctx):
+    """Design matrix of the run (species column and cache of ctx)."""
+    return design_matrix.build(
+        df_ref,
+        df_target,
+        predictors,
+        responses,
+        col_species=ctx.col_species,
+        cache_dir=ctx.path("cache", "filepath"),
+    )
 
 
 @dec.timer
-def totben_cap(df_ref, df_target):
+def totben_cap(df_ref, df_target, overwrite=False, ctx=None):
     """
     Predict the total annual benefits (Nkr/år) of trees
     in the municipalities building zone.
     """
-    municipality = load_parameters()["municipality"]
-    catalog = load_catalog()
+    ctx = ctx or RunContext()
 
     # load model parameters
-    model_params = load_parameters()["rf_total_cap"]
-    target_id = load_parameters()[municipality]["target_id"]
+    model_params = ctx.model_params["rf_total_cap"]
+    target_id = ctx.target_id
 
-    if municipality == "baerum":
-        municipality = "oslo"
+    # models of the reference municipality (baerum uses oslo models)
+    municipality = ctx.model_municipality
 
     response = model_params["model_options"]["response"]
     predictors = model_params["model_options"]["predictors"]
 
+    # encode reference and target data (cached by data hash)
+    design = _design(df_ref, df_target, predictors, response, ctx)
+
     # Split data
     # ---------------------------
     # model that contains all variables
@@ -65,71 +157,144 @@ def totben_cap(df_ref, df_target):
         model_params=model_params["model_options"],
         response=response,
         predictors=predictors,
+        design=design,
     )
 
     file_prefix = regressor.get_file_prefix(municipality, response)
     print(file_prefix)
 
-    path = catalog[f"{municipality}_extrapolation"]["model"]["filepath_pickle"]
-    filename = f"{file_prefix}_model.pkl"
-    model_filepath = os.path.join(path, filename)
-
     # Train model
     # -----------
-    # if model exist then load it, else train new model
-    if os.path.exists(model_filepath):
-        regression_model = regressor.load_model(model_filepath)
-    else:
-        if municipality == "kristiansand":
-            regression_model = regressor.linear_regression(
-                X_train, y_train, file_prefix
-            )
-        else:
-            regression_model = regressor.tune_rf(
-                X_train,
-                y_train,
-                model_params=model_params["model_options"],
-                file_prefix=file_prefix,
-            )
+    # load the model from the registry if it was trained on the same data,
+    # predictors and parameters, else train new model
+    regression_model, registry, key = _get_model(
+        X_train,
+        y_train,
+        predictors,
+        response,
+        model_params,
+        municipality,
+        file_prefix,
+        overwrite,
+        ctx,
+    )
 
     # Evaluate model
     # --------------
-    regressor.evaluate_model(
+    metrics = regressor.evaluate_model(
         regression_model,
         response,
         X_test,
         y_test,
         model_params=model_params,
         file_prefix=file_prefix,
+        predictors=predictors,
+        municipality=ctx.municipality,
     )
+    registry.update(key, metrics={" ".join(response): metrics})
 
     # Predict
     # -------
     regressor.predict(
         df_target=df_target,
         target_id=target_id,
-        regressor=regression_model,
+        regressor=registry.predictor(key, regression_model),
         response=response,
         predictors=predictors,
         file_prefix=file_prefix,
+        design=design,
+        municipality=ctx.municipality,
     )
     return
 
 
+def _multi_output(df_ref, df_target, model_params, response, overwrite=False, ctx=None):
+    """
+    Train one random forest on all response variables (model_options:
+    multi_output) and predict them in one pass over the target dataset.
+    Metrics, plots and result files are exported per response variable.
+    """
+    ctx = ctx or RunContext()
+    target_id = ctx.target_id
+    municipality = ctx.model_municipality
+
+    # encode reference and target data (cached by data hash)
+    predictors = model_params["model_options"]["predictors"]
+    design = _design(df_ref, df_target, predictors, response, ctx)
+
+    # Split data
+    # ---------------------------
+    # rows with a missing value in any of the response variables are dropped
+    predictors, X_train, X_test, y_train, y_test = regressor.split_data(
+        data=df_ref,
+        model_params=model_params["model_options"],
+        response=response,
+        predictors=predictors,
+        design=design,
+    )
+
+    file_prefix = regressor.get_file_prefix(municipality, response)
+
+    # Train model
+    # -----------
+    # load the model from the registry if it was trained on the same data,
+    # predictors and parameters, else train new model
+    regression_model, registry, key = _get_model(
+        X_train,
+        y_train,
+        predictors,
+        response,
+        model_params,
+        municipality,
+        file_prefix,
+        overwrite,
+        ctx,
+    )
+
+    # Evaluate model per response variable
+    # ------------------------------------
+    y_pred = regression_model.predict(X_test)
+    for i, y_var in enumerate(response):
+        metrics = regressor.evaluate_model(
+            regression_model,
+            [y_var],
+            X_test,
+            y_test[:, i],
+            model_params=model_params,
+            file_prefix=regressor.get_file_prefix(municipality, [y_var]),
+            y_pred=y_pred[:, i],
+            predictors=predictors,
+            municipality=ctx.municipality,
+        )
+        registry.update(key, metrics={y_var: metrics})
+
+    # Predict
+    # -------
+    regressor.predict_multi_output(
+        df_target=df_target,
+        target_id=target_id,
+        regressor=registry.predictor(key, regression_model),
+        response=response,
+        predictors=predictors,
+        model_municipality=municipality,
+        design=design,
+        municipality=ctx.municipality,
+    )
+
+
 @dec.timer
-def individual_es(df_ref, df_target):
+def individual_es(df_ref, df_target, overwrite=False, ctx=None):
     """Predict the individual ecosystem services of trees
     in the municipalities building zone."""
 
-    municipality = load_parameters()["municipality"]
-    catalog = load_catalog()
+    ctx = ctx or RunContext()
 
     # load model parameters
-    model_params = load_parameters()["rf_individual_es"]
-    target_id = load_parameters()[municipality]["target_id"]
+    model_params = ctx.model_params["rf_individual_es"]
+    target_id = ctx.target_id
 
-    if municipality == "baerum":
-        municipality = "oslo"
+    # models of the reference municipality (baerum uses oslo models)
+    municipality = ctx.model_municipality
 
     predictors = model_params["model_options"]["predictors"]
     lst_response_variables = model_params["model_options"]["response"]
@@ -144,6 +309,17 @@ def individual_es(df_ref, df_target):
             if x not in ["pollution_no2", "pollution_pm25", "pollution_so2"]
         ]
 
+    # one forest for all response variables
+    multi_output = model_params["model_options"].get("multi_output", False)
+    if multi_output and municipality != "kristiansand":
+        _multi_output(
+            df_ref, df_target, model_params, lst_response_variables, overwrite, ctx
+        )
+        return
+
+    # encode reference and target data once for all response variables
+    design = _design(df_ref, df_target, predictors, lst_response_variables, ctx)
+
     # loop over response variables, model and predict
     for y_var in lst_response_variables:
         # ensure y_var is a list of (one) string
@@ -158,75 +334,85 @@ def individual_es(df_ref, df_target):
             model_params=model_params["model_options"],
             response=y_var,
             predictors=predictors,
+            design=design,
         )
 
         file_prefix = regressor.get_file_prefix(municipality, y_var)
 
-        path = catalog[f"{municipality}_extrapolation"]["model"]["filepath_pickle"]
-        filename = f"{file_prefix}_model.pkl"
-        model_filepath = os.path.join(path, filename)
-
         # Train model
         # -----------
-        # if model exist then load it, else train new model
-        if os.path.exists(model_filepath):
-            regression_model = regressor.load_model(model_filepath)
-        else:
-            if municipality == "kristiansand":
-                regression_model = regressor.linear_regression(
-                    X_train, y_train, file_prefix
-                )
-            else:
-                regression_model = regressor.tune_rf(
-                    X_train,
-                    y_train,
-                    model_params=model_params["model_options"],
-                    file_prefix=file_prefix,
-                )
+        # load the model from the registry if it was trained on the same data,
+        # predictors and parameters, else train new model
+        regression_model, registry, key = _get_model(
+            X_train,
+            y_train,
+            predictors,
+            y_var,
+            model_params,
+            municipality,
+            file_prefix,
+            overwrite,
+            ctx,
+        )
 
         # Evaluate model
         # --------------
-        regressor.evaluate_model(
+        metrics = regressor.evaluate_model(
             regression_model,
             y_var,
             X_test,
             y_test,
             model_params=model_params,
             file_prefix=file_prefix,
+            predictors=predictors,
+            municipality=ctx.municipality,
         )
+        registry.update(key, metrics={" ".join(y_var): metrics})
 
         # Predict
         # -------
         regressor.predict(
             df_target=df_target,
             target_id=target_id,
-            regressor=regression_model,
+            regressor=registry.predictor(key, regression_model),
             response=y_var,
             predictors=predictors,
             file_prefix=file_prefix,
+            design=design,
+            municipality=ctx.municipality,
         )
 
 
 @dec.timer
-def carbon_es(df_ref, df_target):
+def carbon_es(df_ref, df_target, overwrite=False, ctx=None):
     """Predict the individual ecosystem services of trees
     in the municipalities building zone."""
 
-    municipality = load_parameters()["municipality"]
-    catalog = load_catalog()
+    ctx = ctx or RunContext()
 
     # load model parameters
-    model_params = load_parameters()["rf_carbon_es"]
-    target_id = load_parameters()[municipality]["target_id"]
+    model_params = ctx.model_params["rf_carbon_es"]
+    target_id = ctx.target_id
 
-    if municipality == "baerum":
-        municipality = "oslo"
+    # models of the reference municipality (baerum uses oslo models)
+    municipality = ctx.model_municipality
 
     predictors = model_params["model_options"]["predictors"]
     lst_response_variables = model_params["model_options"]["response"]
     if isinstance(lst_response_variables, str):
         lst_response_variables = [lst_response_variables]
 
+    # one forest for all response variables
+    multi_output = model_params["model_options"].get("multi_output", False)
+    if multi_output and municipality != "kristiansand":
+        _multi_output(
+            df_ref, df_target, model_params, lst_response_variables, overwrite, ctx
+        )
+        return
+
+    # encode reference and target data once for all response variables
+    design = _design(df_ref, df_target, predictors, lst_response_variables, ctx)
+
     # loop over response variables, model and predict
     for y_var in lst_response_variables:
         # ensure y_var is a list of (one) string
@@ -241,80 +427,158 @@ def carbon_es(df_ref, df_target):
             model_params=model_params["model_options"],
             response=y_var,
             predictors=predictors,
+            design=design,
         )
 
         file_prefix = regressor.get_file_prefix(municipality, y_var)
 
-        path = catalog[f"{municipality}_extrapolation"]["model"]["filepath_pickle"]
-        filename = f"{file_prefix}_model.pkl"
-        model_filepath = os.path.join(path, filename)
-
         # Train model
         # -----------
-        # if model exist then load it, else train new model
-        if os.path.exists(model_filepath):
-            regression_model = regressor.load_model(model_filepath)
-        else:
-            if municipality == "kristiansand":
-                regression_model = regressor.linear_regression(
-                    X_train, y_train, file_prefix
-                )
-            else:
-                regression_model = regressor.tune_rf(
-                    X_train,
-                    y_train,
-                    model_params=model_params["model_options"],
-                    file_prefix=file_prefix,
-                )
+        # load the model from the registry if it was trained on the same data,
+        # predictors and parameters, else train new model
+        regression_model, registry, key = _get_model(
+            X_train,
+            y_train,
+            predictors,
+            y_var,
+            model_params,
+            municipality,
+            file_prefix,
+            overwrite,
+            ctx,
+        )
 
         # Evaluate model
         # --------------
-        regressor.evaluate_model(
+        metrics = regressor.evaluate_model(
             regression_model,
             y_var,
             X_test,
             y_test,
             model_params=model_params,
             file_prefix=file_prefix,
+            predictors=predictors,
+            municipality=ctx.municipality,
         )
+        registry.update(key, metrics={" ".join(y_var): metrics})
 
         # Predict
         # -------
         regressor.predict(
             df_target=df_target,
             target_id=target_id,
-            regressor=regression_model,
+            regressor=registry.predictor(key, regression_model),
             response=y_var,
             predictors=predictors,
             file_prefix=file_prefix,
+            design=design,
+            municipality=ctx.municipality,
         )
 
 
-def export():
-    municipality = load_parameters()["municipality"]
-    target_id = load_parameters()[municipality]["target_id"]
-    col_species = load_parameters()[municipality]["col_species"]
-    export_results.merge_csv(col_id=target_id, col_species=col_species)
+def export(ctx=None):
+    ctx = ctx or RunContext()
+    export_results.merge_results(
+        col_id=ctx.target_id, col_species=ctx.col_species, ctx=ctx
+    )
     # clean_results.merge_geojson(col_id=target_id)
 
 
-def summary_stat():
-    parameters = load_parameters()
-    municipality = parameters["municipality"]
-    catalog = load_catalog()
-    csv_folder = catalog[f"{municipality}_extrapolation"]["output"]["filepath_csv"]
-    input_file = os.path.join(csv_folder, f"{municipality}_extrapolation_results.csv")
+def summary_stat(ctx=None):
+    ctx = ctx or RunContext()
+    csv_folder = ctx.path("output", "filepath_csv")
+    input_file = export_results.results_file(ctx.municipality)
 
-    municipality = load_parameters()["municipality"]
-    target_id = load_parameters()[municipality]["target_id"]
-    col_species = load_parameters()[municipality]["col_species"]
-    export_results.create_summary(input_file, csv_folder, col_species)
+    export_results.create_summary(
+        input_file, csv_folder, ctx.col_species, municipality=ctx.municipality
+    )
     return
 
 
+@dec.timer
+def bootstrap_ci(df_ref, df_target, ctx=None):
+    """
+    Bootstrap confidence intervals of the district totals of totben_cap and
+    the ecosystem services (bootstrap in parameters.yaml), written to
+    <municipality>_ci_ES_per_district.csv.
+    """
+    ctx = ctx or RunContext()
+    municipality = ctx.model_municipality
+    work_dir = ctx.path("cache", "filepath")
+    if df_target is None:
+        # not loaded for streaming prediction, the intervals need all targets
+        df_target = schema.read_table(ctx.path("target", "filepath_parquet"))
+
+    dfs = []
+    for family in ("rf_total_cap", "rf_individual_es", "rf_carbon_es"):
+        model_params = ctx.model_params[family]
+        predictors = model_params["model_options"]["predictors"]
+        responses, groups = ctx.model_groups(family)
+        design = _design(df_ref, df_target, predictors, responses, ctx)
+
+        for response in groups:
+            predictors, X_train, X_test, y_train, y_test = regressor.split_data(
+                data=df_ref,
+                model_params=model_params["model_options"],
+                response=response,
+                predictors=predictors,
+                design=design,
+            )
+            # the trained model of the step, refitted per replicate
+            regression_model, _, _ = _get_model(
+                X_train,
+                y_train,
+                predictors,
+                response,
+                model_params,
+                municipality,
+                regressor.get_file_prefix(municipality, response),
+                ctx=ctx,
+            )
+            dfs.append(
+                bootstrap.district_intervals(
+                    regression_model,
+                    X_train,
+                    y_train,
+                    design.X_target,
+                    df_target["grunnkretsnummer"],
+                    response=response,
+                    work_dir=work_dir,
+                )
+            )
+
+    df_ci = pd.concat(dfs, axis=1).round(1).reset_index()
+    filepath = os.path.join(
+        ctx.path("output", "filepath_csv"), f"{ctx.municipality}_ci_ES_per_district.csv"
+    )
+    df_ci.to_csv(filepath, index=False)
+    return filepath
+
+
+def run(ctx=None, overwrite=False):
+    """
+    Extrapolate one municipality: prepare_data, the three model families,
+    export and, if enabled in parameters.yaml, bootstrap_ci (see
+    src/run_extrapolation.py to run several municipalities).
+    """
+    logger = logging.getLogger(__name__)
+    ctx = ctx or RunContext()
+    logger.info(f"Extrapolate {ctx}")
+
+    df_ref, df_target = prepare_data(overwrite=overwrite, ctx=ctx)
+    totben_cap(df_ref, df_target, overwrite=overwrite, ctx=ctx)
+    individual_es(df_ref, df_target, overwrite=overwrite, ctx=ctx)
+    carbon_es(df_ref, df_target, overwrite=overwrite, ctx=ctx)
+    export(ctx=ctx)
+    if bootstrap.is_enabled():
+        bootstrap_ci(df_ref, df_target, ctx=ctx)
+    return ctx.municipality
+
+
 if __name__ == "__main__":
     # set up logging
     setup_logging()
+    profiler.enable_from_config()
     logger = logging.getLogger(__name__)
 
     # df_ref, df_target = prepare_data()
@@ -0,0 +1,262 @@
+"""
+Bootstrap confidence intervals of the extrapolated district totals.
+
+The district totals of the results (create_summary) are point estimates of the
+models trained on one sample of reference trees. A bootstrap replicate
+resamples the training rows with replacement, refits a copy of the trained
+model (same tuned parameters, random_state of the replicate), predicts the
+target trees in batches and sums the predictions per district
+(grunnkretsnummer). The percentile interval of the replicate totals is
+reported per district and for all districts together.
+
+Replicates run in worker processes. The training and target arrays are
+written once as .npy files to a work directory in the cache and memory mapped
+by every worker, so the target matrix is not copied per worker or replicate.
+The replicate seeds are derived from random_state, the intervals do not
+depend on the number of workers.
+
+Settings in parameters.yaml, bootstrap: enabled, n_replicates, confidence,
+workers, random_state, batch_size.
+
+Example:
+--------
+df_ci = bootstrap.district_intervals(
+    model, X_train, y_train, design.X_target, df_target["grunnkretsnummer"],
+    response=["totben_cap"], work_dir=cache_dir,
+)
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+
+from src.config.config import load_parameters
+
+ARRAYS = ("X_train", "y_train", "X_target", "codes")
+DEFAULT_REPLICATES = 200
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_WORKERS = 1
+DEFAULT_BATCH_SIZE = 100_000
+DEFAULT_RANDOM_STATE = 42
+
+
+def config() -> dict:
+    """bootstrap section of parameters.yaml."""
+    return load_parameters().get("bootstrap", {}) or {}
+
+
+def is_enabled() -> bool:
+    return bool(config().get("enabled", False))
+
+
+def district_codes(districts):
+    """
+    District code per row (-1 for missing districts) and the sorted district
+    labels, as the keys of DataFrame.groupby(districts).
+    """
+    codes, labels = pd.factorize(pd.Series(districts), sort=True)
+    return codes.astype(np.int64), labels
+
+
+def district_totals(y, codes, n_districts) -> np.ndarray:
+    """Sum of the predictions y per district, (n_districts, n_responses)."""
+    y = np.asarray(y, dtype=np.float64).reshape(len(codes), -1)
+    valid = codes >= 0
+    return np.stack(
+        [
+            np.bincount(codes[valid], weights=y[valid, j], minlength=n_districts)
+            for j in range(y.shape[1])
+        ],
+        axis=1,
+    )
+
+
+def predict(model, X, batch_size=DEFAULT_BATCH_SIZE) -> np.ndarray:
+    """
+    Predictions (n_rows, n_responses) of X in batches of batch_size rows,
+    rounded to two decimals as the results (regressor.predict).
+    """
+    batches = [
+        np.asarray(model.predict(X[i : i + batch_size])).reshape(
+            min(batch_size, len(X) - i), -1
+        )
+        for i in range(0, len(X), batch_size)
+    ]
+    return np.round(np.concatenate(batches), 2)
+
+
+# worker state, set once per worker process by _init_worker
+_worker = {}
+
+
+def _init_worker(path, estimator, n_districts, batch_size):
+    _worker.update(
+        {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ARRAYS
+        }
+    )
+    _worker.update(estimator=estimator, n_districts=n_districts, batch_size=batch_size)
+
+
+def _replicate(seed) -> np.ndarray:
+    """District totals (n_districts, n_responses) of one bootstrap replicate."""
+    X_train, y_train = _worker["X_train"], _worker["y_train"]
+    rows = np.sort(np.random.default_rng(seed).integers(0, len(X_train), len(X_train)))
+
+    model = clone(_worker["estimator"])
+    params = {"random_state": int(seed), "n_jobs": 1}
+    model.set_params(**{k: v for k, v in params.items() if k in model.get_params()})
+    model.fit(X_train[rows], y_train[rows])
+
+    y_target = predict(model, _worker["X_target"], _worker["batch_size"])
+    return district_totals(y_target, _worker["codes"], _worker["n_districts"])
+
+
+def replicate_totals(
+    model,
+    X_train,
+    y_train,
+    X_target,
+    codes,
+    n_districts,
+    n_replicates=DEFAULT_REPLICATES,
+    random_state=DEFAULT_RANDOM_STATE,
+    workers=DEFAULT_WORKERS,
+    batch_size=DEFAULT_BATCH_SIZE,
+    work_dir=None,
+) -> np.ndarray:
+    """
+    District totals of n_replicates bootstrap replicates.
+
+    Args:
+        model (obj): trained model, refitted (sklearn.base.clone) per replicate
+        X_train, y_train (np.ndarray): training data of model
+        X_target (np.ndarray): target predictors (imputed, design.X_target)
+        codes (np.ndarray): district code per target row (district_codes)
+        n_districts (int): number of districts
+        work_dir (str): directory of the memory mapped inputs, a temporary
+            directory in it is removed afterwards
+
+    Returns:
+        np.ndarray: (n_replicates, n_districts, n_responses)
+    """
+    logger = logging.getLogger(__name__)
+    seeds = np.random.SeedSequence(random_state).generate_state(n_replicates)
+
+    if work_dir:
+        os.makedirs(work_dir, exist_ok=True)
+    path = tempfile.mkdtemp(prefix="bootstrap_", dir=work_dir)
+    try:
+        arrays = {
+            "X_train": np.asarray(X_train, dtype=np.float32),
+            "y_train": np.asarray(y_train, dtype=np.float64),
+            "X_target": np.asarray(X_target, dtype=np.float32),
+            "codes": np.asarray(codes, dtype=np.int64),
+        }
+        for name in ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), arrays[name])
+        del arrays
+
+        logger.info(
+            f"Bootstrap {n_replicates} replicates with {workers} workers "
+            f"({len(X_train)} training rows, {len(X_target)} target rows)..."
+        )
+        initargs = (path, clone(model), n_districts, batch_size)
+        if workers <= 1:
+            _init_worker(*initargs)
+            totals = [_replicate(seed) for seed in seeds]
+        else:
+            with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=initargs
+            ) as executor:
+                totals = list(executor.map(_replicate, seeds))
+    finally:
+        _worker.clear()
+        shutil.rmtree(path, ignore_errors=True)
+
+    return np.stack(totals)
+
+
+def percentile_interval(totals, confidence=DEFAULT_CONFIDENCE) -> np.ndarray:
+    """Lower and upper percentile of the replicates (axis 0) of totals."""
+    alpha = (1 - confidence) / 2
+    return np.percentile(totals, [100 * alpha, 100 * (1 - alpha)], axis=0)
+
+
+def district_intervals(
+    model,
+    X_train,
+    y_train,
+    X_target,
+    districts,
+    response: List[str],
+    n_replicates=None,
+    confidence=None,
+    workers=None,
+    random_state=None,
+    batch_size=None,
+    work_dir=None,
+) -> pd.DataFrame:
+    """
+    Point estimate and bootstrap percentile interval of the district totals.
+    Arguments that are None default to the bootstrap section of
+    parameters.yaml.
+
+    Args:
+        districts (array): district of each target row (grunnkretsnummer)
+        response (list): response columns, in the output order of model
+
+    Returns:
+        df: index district_id (the districts and a last row "sum" of all
+        districts), columns <response>, <response>_lower and <response>_upper
+    """
+    settings = config()
+    if n_replicates is None:
+        n_replicates = settings.get("n_replicates", DEFAULT_REPLICATES)
+    if confidence is None:
+        confidence = settings.get("confidence", DEFAULT_CONFIDENCE)
+    if workers is None:
+        workers = settings.get("workers", DEFAULT_WORKERS)
+    if random_state is None:
+        random_state = settings.get("random_state", DEFAULT_RANDOM_STATE)
+    if batch_size is None:
+        batch_size = settings.get("batch_size", DEFAULT_BATCH_SIZE)
+    if not 0 < confidence < 1:
+        raise ValueError(f"bootstrap: confidence must be in (0, 1), not {confidence}")
+
+    codes, labels = district_codes(districts)
+    n_districts = len(labels)
+    point = district_totals(predict(model, X_target, batch_size), codes, n_districts)
+    totals = replicate_totals(
+        model,
+        X_train,
+        y_train,
+        X_target,
+        codes,
+        n_districts,
+        n_replicates=n_replicates,
+        random_state=random_state,
+        workers=workers,
+        batch_size=batch_size,
+        work_dir=work_dir,
+    )
+
+    # last row: all districts
+    point = np.vstack([point, point.sum(axis=0)])
+    totals = np.concatenate([totals, totals.sum(axis=1, keepdims=True)], axis=1)
+    lower, upper = percentile_interval(totals, confidence)
+
+    df = pd.DataFrame(index=pd.Index([*labels, "sum"], name="district_id"))
+    for j, y_var in enumerate(response):
+        df[y_var] = point[:, j]
+        df[f"{y_var}_lower"] = lower[:, j]
+        df[f"{y_var}_upper"] = upper[:, j]
+    return df
@@ -6,6 +6,7 @@ import numpy as np
 import pandas as pd
 
 from src.config.config import load_catalog, load_parameters
+from src.extrapolation import reporting, schema
 
 
 def logger_decorator(func):
@@ -18,12 +19,11 @@ def logger_decorator(func):
 
 
 @logger_decorator
-def load_reference() -> pd.DataFrame:
+def load_reference(municipality=None) -> pd.DataFrame:
     """Load reference data."""
 
     # set up logging
-    parameters = load_parameters()
-    municipality = parameters["municipality"]
+    municipality = municipality or load_parameters()["municipality"]
 
     catalog = load_catalog()
     raw_trees = catalog[f"{municipality}_extrapolation"]["raw_trees"]
@@ -37,11 +37,10 @@ def load_reference() -> pd.DataFrame:
 
 
 @logger_decorator
-def load_lookup() -> pd.DataFrame:
+def load_lookup(municipality=None) -> pd.DataFrame:
     """Load municipality specific lookup data from excel."""
 
-    parameters = load_parameters()
-    municipality = parameters["municipality"]
+    municipality = municipality or load_parameters()["municipality"]
 
     catalog = load_catalog()
     lookup = catalog[f"{municipality}_extrapolation"]["lookup"]
@@ -54,7 +53,7 @@ def load_lookup() -> pd.DataFrame:
     return df_lookup
 
 
-def clean_reference_cols(df_ref, df_lookup):
+def clean_reference_cols(df_ref, df_lookup, municipality=None):
     """
     Clean referance data.
     - rename cols using lookup
@@ -67,9 +66,11 @@ def clean_reference_cols(df_ref, df_lookup):
         _description_
     df_lookup : _type_
         _description_
+    municipality : str
+        municipality of the run, defaults to parameters.yaml
     """
 
-    municipality = load_parameters()["municipality"]
+    municipality = municipality or load_parameters()["municipality"]
 
     # 1. CLEAN COLUMNS
     # ----------------
@@ -107,7 +108,6 @@ def clean_reference_cols(df_ref, df_lookup):
             df_ref[col] = pd.to_numeric(df_ref[col], errors="coerce")
 
     # create new columns, if not exist
-    municipality = parameters["municipality"]
     cols_to_keep = parameters[municipality]["cols_ref"]
     for col in cols_to_keep:
         if col not in df_ref.columns:
@@ -228,45 +228,16 @@ def calc_summary(data, x, classify_other=False):
 
 
 def plot_summary(data, x, y, title, xlabel, ylabel, filename):
-    import matplotlib.pyplot as plt
-    import seaborn as sns
-
-    # plot histogram
-    fig, ax = plt.subplots(figsize=(30, 5))
-    sns.barplot(x=x, y=y, data=data, ax=ax, color="darkgreen")
-    ax.set_title(title, fontweight="ultralight", fontsize=20)
-    ax.set_xlabel(xlabel, fontweight="bold")
-    ax.set_ylabel(ylabel, fontweight="bold")
-    plt.xticks(rotation=45, fontweight="ultralight")
-    plt.yticks(fontsize=10)
-    plt.savefig(filename)
-
-
-def encode_and_rename(df, column, prefix):
-    """Helper function to encode and rename a dataframe column."""
-    df[column] = df[column].astype("category")
-    encoded_df = pd.get_dummies(df[column], prefix=prefix)
-
-    # ensure all spaces in col names are replaced with "_"
-    encoded_df.columns = encoded_df.columns.str.replace(" ", "_")
+    # saved for the reporting stage, rendered according to reporting: plots
+    reporting.plot_species_summary(data, x, y, title, xlabel, ylabel, filename)
 
-    # set all encoded_cols to int
-    encoded_df = encoded_df.astype(np.int64)
-    return pd.concat([df, encoded_df], axis=1)
 
-
-def encode_species(df, col_species):
-    """Encode species using one-hot encoding."""
-    df = encode_and_rename(df, col_species, "SP")
-    return df
-
-
-def export_reference(df_ref, df_species_summary):
+def export_reference(df_ref, df_species_summary, municipality=None):
     # export reference data to csv
     import numpy as np
 
     parameters = load_parameters()
-    municipality = parameters["municipality"]
+    municipality = municipality or parameters["municipality"]
 
     catalog = load_catalog()
     cols_int = parameters["cols_int"]
@@ -283,6 +254,8 @@ def export_reference(df_ref, df_species_summary):
 
     ref_trees = catalog[f"{municipality}_extrapolation"]["reference"]
     df_ref.to_csv(ref_trees["filepath_csv"], index=False, encoding="utf-8")
+    # typed cache, read by all downstream steps (schema.py)
+    df_ref = schema.write_table(df_ref, ref_trees["filepath_parquet"])
 
     summary_path = catalog[f"{municipality}_extrapolation"]["species_summary"][
         "filepath"
@@ -291,31 +264,30 @@ def export_reference(df_ref, df_species_summary):
     return df_ref
 
 
-def main(col_id, col_species):
+def main(col_id, col_species, overwrite=False, municipality=None):
     # set up logging
     logger = logging.getLogger(__name__)
-    params = load_parameters()
     catalog = load_catalog()
-    municipality = params["municipality"]
+    # municipality of the run (RunContext), defaults to parameters.yaml
+    municipality = municipality or load_parameters()["municipality"]
     logger.info(f"Load reference data for municipality: {municipality}")
 
     # if file not exist then create it
-    if not os.path.exists(
-        catalog[f"{municipality}_extrapolation"]["reference"]["filepath_csv"]
-    ):
+    ref_path = catalog[f"{municipality}_extrapolation"]["reference"]["filepath_parquet"]
+    if overwrite or not os.path.exists(ref_path):
         logger.info("Reference data not found, creating it")
         # load reference and lookup data
-        df_ref = load_reference()
+        df_ref = load_reference(municipality)
         if municipality == "oslo":
-            df_lookup = load_lookup()
+            df_lookup = load_lookup(municipality)
 
         # CLEAN REFERENCE
         # ---------------
-        df_ref = clean_reference_cols(df_ref, df_lookup=None)
+        df_ref = clean_reference_cols(df_ref, df_lookup=None, municipality=municipality)
         df_ref = clean_reference_rows(df_ref, col_species)
 
-        # ENCODE SPECIES
-        # --------------
+        # SPECIES SUMMARY
+        # ---------------
         df_species_summary = calc_summary(df_ref, col_species, classify_other=False)
         filename = catalog[f"{municipality}_extrapolation"]["species_summary"][
             "img_path"
@@ -329,15 +301,12 @@ def main(col_id, col_species):
             ylabel="Sannsynlighet (%)",
             filename=filename,
         )
-        df_ref = encode_species(df_ref, col_species)
 
         # EXPORT REFERENCE
         # ----------------
-        df_ref = export_reference(df_ref, df_species_summary)
+        df_ref = export_reference(df_ref, df_species_summary, municipality)
     else:
-        df_ref = pd.read_csv(
-            catalog[f"{municipality}_extrapolation"]["reference"]["filepath_csv"]
-        )
+        df_ref = schema.read_table(ref_path)
 
     # log info
     logger.info(f"Reference data shape: {df_ref.shape}")
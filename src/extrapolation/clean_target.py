@@ -6,6 +6,7 @@ import numpy as np
 import pandas as pd
 
 from src.config.config import load_catalog, load_parameters
+from src.extrapolation import schema, streaming
 
 
 def logger_decorator(func):
@@ -18,11 +19,10 @@ def logger_decorator(func):
 
 
 @logger_decorator
-def load_target() -> pd.DataFrame:
+def load_target(municipality=None) -> pd.DataFrame:
     """Load target data."""
 
-    parameters = load_parameters()
-    municipality = parameters["municipality"]
+    municipality = municipality or load_parameters()["municipality"]
 
     catalog = load_catalog()
     raw_crowns = catalog[f"{municipality}_extrapolation"]["raw_crowns"]
@@ -35,7 +35,7 @@ def load_target() -> pd.DataFrame:
     return df_target
 
 
-def clean_target_cols(df_target, col_id):
+def clean_target_cols(df_target, col_id, municipality=None):
     parameters = load_parameters()
 
     # convert all colnames to lowercase except col_id
@@ -62,7 +62,7 @@ def clean_target_cols(df_target, col_id):
             df_target[col] = df_target[col].round(2)
 
     # create new columns, if not exist
-    municipality = parameters["municipality"]
+    municipality = municipality or parameters["municipality"]
     cols_to_keep = parameters[municipality]["cols_target"]
     for col in cols_to_keep:
         if col not in df_target.columns:
@@ -122,102 +122,161 @@ def clean_target_rows(df_target, col_species):
     return df_target
 
 
-def fill_missing_species(df_target, df_summary, col_species):
-    """Fill missing species in df_target using df_summary."""
+def _district_probabilities(col_species, col_district_ref, municipality=None):
+    """Species probability per district of the reference trees:
+    {district: (species, probabilities)}."""
+    municipality = municipality or load_parameters()["municipality"]
+    catalog = load_catalog()
+    ref_path = catalog[f"{municipality}_extrapolation"]["reference"]["filepath_parquet"]
+
+    df_ref = schema.read_table(ref_path, columns=[col_species, col_district_ref])
+    df_ref = df_ref.dropna()
+    counts = df_ref.groupby([col_district_ref, col_species], observed=True).size()
+
+    probabilities = {}
+    for district, district_counts in counts.groupby(level=0):
+        species = district_counts.index.get_level_values(1).to_numpy()
+        p = (district_counts / district_counts.sum()).to_numpy()
+        probabilities[district] = (species, p)
+    return probabilities
+
+
+def fill_missing_species(
+    df_target,
+    df_summary,
+    col_species,
+    seed=None,
+    by_district=False,
+    col_district="grunnkretsnummer",
+    col_district_ref="district_code",
+    municipality=None,
+):
+    """
+    Fill missing species in df_target by drawing from the species probability
+    distribution of the reference trees (df_summary). All missing values are
+    drawn at once with a seeded generator, so the result is reproducible.
+
+    Args:
+        df_target (df): target data
+        df_summary (str): path to the species summary csv (col_species, Perc)
+        col_species (str): species column
+        seed (int): seed of the random generator
+        by_district (bool): draw from the species distribution of the reference
+            trees in the same district (col_district in the target,
+            col_district_ref in the reference), districts without reference
+            trees use the distribution of the municipality
+        municipality (str): municipality of the reference trees (by_district),
+            defaults to parameters.yaml
+    """
 
     logger = logging.getLogger(__name__)
     logger.info(
         "Fill missing species in df_target using species probability distribution."
     )
+    rng = np.random.default_rng(seed)
+
     # load summary into df
     df_summary = pd.read_csv(df_summary)
-    # logger.info("Sum of Perc:", df_summary["Perc"].sum())
     # normalize Perc to probabilities (100% = 1)
-    df_summary["Perc"] = df_summary["Perc"] / df_summary["Perc"].sum()
-
-    # fil no data values in test_df['species'] by using
-    # the probability distribution of df['species']
-    df_target[col_species] = df_target[col_species].apply(
-        lambda x: np.random.choice(df_summary[col_species], p=df_summary["Perc"])
-        if pd.isnull(x)
-        else x
-    )
+    species = df_summary[col_species].to_numpy()
+    probabilities = (df_summary["Perc"] / df_summary["Perc"].sum()).to_numpy()
+
+    missing = df_target[col_species].isnull().to_numpy()
+    logger.info(f"Missing species: {missing.sum()} of {len(df_target)}")
+    values = df_target[col_species].to_numpy(dtype=object, copy=True)
+
+    if by_district and col_district in df_target.columns:
+        districts = _district_probabilities(col_species, col_district_ref, municipality)
+        target_districts = df_target[col_district].to_numpy()
+        fallback = missing.copy()
+        for district in pd.unique(target_districts[missing]):
+            if district not in districts:
+                continue
+            rows = missing & (target_districts == district)
+            district_species, district_p = districts[district]
+            values[rows] = rng.choice(district_species, size=rows.sum(), p=district_p)
+            fallback &= ~rows
+        values[fallback] = rng.choice(species, size=fallback.sum(), p=probabilities)
+    else:
+        values[missing] = rng.choice(species, size=missing.sum(), p=probabilities)
 
-    # species_origin to str and fill missing values
-    # convert int to string (1 -> "1")
+    df_target[col_species] = values
 
+    # species_origin to str, imputed species are marked as estimated
+    # convert int to string (1 -> "1")
     df_target["species_origin"] = df_target["species_origin"].astype(str)
-    df_target["species_origin"] = df_target["species_origin"].apply(
-        lambda x: "estimated by probability distribution" if pd.isnull(x) else str(x)
-    )
+    df_target.loc[missing, "species_origin"] = "estimated by probability distribution"
 
     return df_target
 
 
-def encode_and_rename(df, column, prefix):
-    """Helper function to encode and rename a dataframe column."""
-    df[column] = df[column].astype("category")
-    encoded_df = pd.get_dummies(df[column], prefix=prefix)
-
-    # ensure all spaces in col names are replaced with "_"
-    encoded_df.columns = encoded_df.columns.str.replace(" ", "_")
-
-    # set all encoded_cols to int
-    encoded_df = encoded_df.astype(np.int64)
-    return pd.concat([df, encoded_df], axis=1)
-
-
-def encode_species(df, col_species):
-    """Encode norwegian_name and species using one-hot encoding."""
-    df = encode_and_rename(df, col_species, "SP")
-    return df
-
-
-def export_target(df_target):
+def export_target(df_target, municipality=None):
     # export target data to csv
-    parameters = load_parameters()
-    municipality = parameters["municipality"]
+    municipality = municipality or load_parameters()["municipality"]
 
     catalog = load_catalog()
     target_trees = catalog[f"{municipality}_extrapolation"]["target"]
     df_target.to_csv(target_trees["filepath_csv"], index=False, encoding="utf-8")
-    df_target.to_parquet(target_trees["filepath_parquet"], index=False)
-    return
+    # typed cache (schema.py), row groups are the chunks of the streaming
+    # prediction (streaming.py)
+    row_group_size = streaming.config().get(
+        "row_group_size", streaming.DEFAULT_ROW_GROUP_SIZE
+    )
+    return schema.write_table(
+        df_target, target_trees["filepath_parquet"], row_group_size=row_group_size
+    )
 
 
-def main(col_id, col_species):
+def main(col_id, col_species, overwrite=False, municipality=None, load=True):
+    """
+    Clean the target data, if it is not cached (or overwrite), and return it.
+    With load=False the cached target is not read (streaming prediction reads
+    it by row group) and None is returned.
+    """
     # set up logging
     logger = logging.getLogger(__name__)
     params = load_parameters()
-    municipality = params["municipality"]
+    # municipality of the run (RunContext), defaults to parameters.yaml
+    municipality = municipality or params["municipality"]
     catalog = load_catalog()
     target_path = catalog[f"{municipality}_extrapolation"]["target"]["filepath_parquet"]
     logger.info(f"Load target data for municipality: {municipality}")
 
     # if file not exist then create it
-    if not os.path.exists(target_path):
+    if overwrite or not os.path.exists(target_path):
         logger.info("Target data not found, creating it.")
-        df_target = load_target()
+        df_target = load_target(municipality)
 
         # CLEAN TARGET
         # ------------
-        df_target = clean_target_cols(df_target, col_id)
+        df_target = clean_target_cols(df_target, col_id, municipality)
         df_target = clean_target_rows(df_target, col_species)
 
-        # ENCODE SPECIES
+        # IMPUTE SPECIES
         # --------------
         df_summary = catalog[f"{municipality}_extrapolation"]["species_summary"][
             "filepath"
         ]
 
-        df_target = fill_missing_species(df_target, df_summary, col_species)
-        df_target = encode_species(df_target, col_species)
+        imputation = params.get("species_imputation", {}) or {}
+        df_target = fill_missing_species(
+            df_target,
+            df_summary,
+            col_species,
+            seed=imputation.get("seed"),
+            by_district=imputation.get("by_district", False),
+            municipality=municipality,
+        )
 
         # EXPORT TARGET
         # -------------
-        export_target(df_target)
-    else:
-        df_target = pd.read_parquet(target_path)
+        df_target = export_target(df_target, municipality)
+    elif load:
+        df_target = schema.read_table(target_path)
+
+    if not load:
+        logger.info(f"Target data cached: {target_path}")
+        return None
 
     # log info
     logger.info(f"Target data shape: {df_target.shape}")
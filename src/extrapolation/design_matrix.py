@@ -0,0 +1,335 @@
+"""
+Design matrix of the extrapolation models.
+
+The predictors of the reference and target data are encoded once into
+contiguous float32 arrays with a stable column order (predictors in the order
+of parameters.yaml, followed by the encoded species columns):
+
+- X_ref: reference predictors (n_ref, n_predictors), missing values kept
+- Y_ref: reference responses (n_ref, n_responses), float64
+- X_target: target predictors, missing values filled with the target median
+  (not built for streaming prediction, see streaming.py)
+
+The species predictor is one-hot encoded here, from the species column of the
+cleaned tables: one SP_<species> column per species of the reference data, set
+from a uint8 indicator block (species_indicators). Target species that are not
+in the reference data are encoded as all zeros.
+
+The arrays are cached as .npy files in <cache>/<key>/, where key is a hash of
+the data and the column lists, and are loaded memory-mapped on a cache hit.
+mask(response) selects the reference rows without missing values in the
+predictors and the response; split(response) returns the same train/test split
+as train_test_split on the dropna'ed reference frame.
+
+Example:
+--------
+dm = design_matrix.build(df_ref, df_target, predictors, responses)
+for y_var in responses:
+    X_train, X_test, y_train, y_test = dm.split([y_var], test_size, random_state)
+    ...
+    y_target = model.predict(dm.X_target)
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+from src.config.config import load_catalog, load_parameters
+
+SPECIES_COLS = ("norwegian_name", "taxon_genus")
+ARRAYS = ("X_ref", "Y_ref", "X_target", "medians")
+
+
+def _col_species() -> str:
+    params = load_parameters()
+    return params[params["municipality"]]["col_species"]
+
+
+def _encoded_name(value, encoding_marker) -> str:
+    # column names of the former pd.get_dummies(prefix="SP") encoding
+    return f"{encoding_marker}{value}".replace(" ", "_")
+
+
+def encoded_columns(df_ref, col_species, encoding_marker="SP_") -> List:
+    """Encoded species columns: one per species in the reference data, sorted."""
+    species = sorted(str(value) for value in df_ref[col_species].dropna().unique())
+    return [_encoded_name(value, encoding_marker) for value in species]
+
+
+def predictor_columns(
+    df_ref, predictors, col_species=None, encoding_marker="SP_"
+) -> List:
+    """
+    Predictor columns of the design matrix. Species predictors (norwegian_name,
+    taxon_genus) are replaced by the encoded columns (prefix encoding_marker) of
+    the species column of the municipality (parameters.yaml: col_species).
+    The predictors list is not modified.
+    """
+    if not any(col in predictors for col in SPECIES_COLS):
+        return list(predictors)
+
+    col_species = col_species or _col_species()
+    cols_encoded = encoded_columns(df_ref, col_species, encoding_marker)
+    return [col for col in predictors if col not in SPECIES_COLS] + cols_encoded
+
+
+def species_indicators(values, columns, encoding_marker="SP_") -> np.ndarray:
+    """
+    One-hot uint8 block (n_rows, n_columns) of the species values. columns are
+    the encoded columns of the reference data (encoded_columns), species that
+    are not in columns (unseen in the reference data) get an all-zero row.
+    """
+    values = pd.Categorical(values)
+    index = {name: j for j, name in enumerate(columns)}
+    lookup = np.array(
+        [
+            index.get(_encoded_name(value, encoding_marker), -1)
+            for value in values.categories.astype(str)
+        ]
+        + [-1],  # code -1: missing species
+        dtype=np.int64,
+    )
+    cols = lookup[values.codes]
+    rows = np.flatnonzero(cols >= 0)
+
+    block = np.zeros((len(values), len(columns)), dtype=np.uint8)
+    block[rows, cols[rows]] = 1
+    return block
+
+
+def encode(df, columns, col_species=None, medians=None, encoding_marker="SP_"):
+    """
+    float32 matrix (n_rows, len(columns)) of df. The predictor columns are read
+    from df (missing values filled with medians, if given), the encoded species
+    columns are computed from the species column (species_indicators), so the
+    encoded columns never exist as dense DataFrame columns.
+    """
+    cols_encoded = [col for col in columns if col.startswith(encoding_marker)]
+    cols_numeric = [col for col in columns if not col.startswith(encoding_marker)]
+
+    # nullable Int64 columns of the Parquet cache (schema.py) hold pd.NA
+    X = df[cols_numeric].astype(np.float64)
+    if medians is not None:
+        X = X.fillna(medians)
+
+    X_encoded = np.empty((len(df), len(columns)), dtype=np.float32)
+    X_encoded[:, : len(cols_numeric)] = X.to_numpy(dtype=np.float32)
+    if cols_encoded:
+        X_encoded[:, len(cols_numeric) :] = species_indicators(
+            df[col_species or _col_species()], cols_encoded, encoding_marker
+        )
+    return X_encoded
+
+
+def data_hash(df_ref, df_target, columns, responses) -> str:
+    """
+    Hash of the reference and target values used by the design matrix
+    (columns: the design matrix columns, the species column is hashed instead
+    of the encoded columns).
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps([list(columns), list(responses)]).encode("utf-8"))
+    for df, cols in ((df_ref, [*columns, *responses]), (df_target, columns)):
+        if df is None:
+            continue
+        cols = [col for col in cols if col in df.columns]
+        h.update(pd.util.hash_pandas_object(df[cols], index=True).values.tobytes())
+    return h.hexdigest()[:16]
+
+
+class DesignMatrix:
+    """
+    Encoded reference and target data of one set of predictors and responses.
+
+    Attributes:
+    -----------
+    columns : list
+        predictor columns, in the column order of X_ref and X_target
+    col_species : str
+        species column of the encoded columns (None if no species predictor)
+    responses : list
+        response columns, in the column order of Y_ref
+    X_ref, Y_ref, X_target : np.ndarray
+        see module docstring, X_target is None if built without the target
+    medians : np.ndarray
+        target median per predictor, used to fill missing values (None if
+        built without the target)
+    key : str
+        data hash (cache key)
+
+    Methods:
+    --------
+    - mask(self, response)
+    - split(self, response, test_size, random_state)
+    """
+
+    def __init__(
+        self, columns, responses, X_ref, Y_ref, X_target, medians, key, col_species
+    ):
+        self.columns = list(columns)
+        self.col_species = col_species
+        self.responses = list(responses)
+        self.X_ref = X_ref
+        self.Y_ref = Y_ref
+        self.X_target = X_target
+        self.medians = medians
+        self.key = key
+        self._valid_X = ~np.isnan(X_ref).any(axis=1)
+
+    def _response_index(self, response) -> List[int]:
+        if isinstance(response, str):
+            response = [response]
+        return [self.responses.index(col) for col in response]
+
+    def mask(self, response) -> np.ndarray:
+        """Reference rows without missing values in predictors and response."""
+        Y = self.Y_ref[:, self._response_index(response)]
+        return self._valid_X & ~np.isnan(Y).any(axis=1)
+
+    def split(self, response, test_size, random_state) -> Tuple:
+        """
+        Train/test split of the rows in mask(response).
+        y is raveled for a single response, as in regressor.split_data.
+
+        Returns:
+            X_train, X_test, y_train, y_test
+        """
+        rows = self.mask(response)
+        X = self.X_ref[rows]
+        y = self.Y_ref[rows][:, self._response_index(response)]
+        if y.shape[1] == 1:
+            y = y.ravel()
+
+        return train_test_split(X, y, test_size=test_size, random_state=random_state)
+
+
+def _cache_dir() -> str:
+    municipality = load_parameters()["municipality"]
+    return load_catalog()[f"{municipality}_extrapolation"]["cache"]["filepath"]
+
+
+def _load(path, key) -> DesignMatrix:
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+    arrays = {}
+    for name in ARRAYS:
+        filepath = os.path.join(path, f"{name}.npy")
+        # X_target and medians are not saved without the target
+        exists = os.path.exists(filepath)
+        arrays[name] = np.load(filepath, mmap_mode="r") if exists else None
+    return DesignMatrix(
+        meta["columns"],
+        meta["responses"],
+        key=key,
+        col_species=meta.get("col_species"),
+        **arrays,
+    )
+
+
+def _save(design, path):
+    """Write the arrays to path (via a temporary directory, atomic on rename)."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name in ARRAYS:
+        if getattr(design, name) is not None:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(design, name))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        meta = {
+            "columns": design.columns,
+            "responses": design.responses,
+            "col_species": design.col_species,
+        }
+        json.dump(meta, f)
+
+    try:
+        os.replace(tmp_path, path)
+    except OSError:  # written by another process in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def build(
+    df_ref,
+    df_target,
+    predictors,
+    responses,
+    encoding_marker="SP_",
+    col_species=None,
+    cache_dir=None,
+    overwrite=False,
+) -> DesignMatrix:
+    """
+    Encode the reference and target data, or load them from the cache.
+
+    Args:
+        df_ref (df): cleaned reference data (clean_reference.main)
+        df_target (df): cleaned target data (clean_target.main), None to
+            encode the reference only (streaming prediction reads the target
+            by row group, X_target and medians are None)
+        predictors (list): predictors in parameters.yaml (model_options)
+        responses (list): all response variables that use the predictors
+        encoding_marker (str): prefix of the encoded species columns
+        col_species (str): species column to encode, defaults to parameters.yaml
+            (<municipality>: col_species)
+        cache_dir (str): cache directory, defaults to the catalog
+            (<municipality>_extrapolation: cache), False disables the cache
+        overwrite (bool): rebuild even if cached
+
+    Returns:
+        DesignMatrix
+    """
+    logger = logging.getLogger(__name__)
+    if isinstance(responses, str):
+        responses = [responses]
+
+    columns = predictor_columns(df_ref, predictors, col_species, encoding_marker)
+    if any(col.startswith(encoding_marker) for col in columns):
+        col_species = col_species or _col_species()
+    else:
+        col_species = None
+    key = data_hash(df_ref, df_target, [*columns, col_species], responses)
+
+    if cache_dir is None:
+        cache_dir = _cache_dir()
+    path = os.path.join(cache_dir, key) if cache_dir else None
+
+    if path and os.path.exists(path) and not overwrite:
+        logger.info(f"Load design matrix <{key}> from cache.")
+        return _load(path, key)
+
+    logger.info(f"Build design matrix <{key}>: {columns} ~ {responses}")
+    cols_numeric = [col for col in columns if not col.startswith(encoding_marker)]
+    X_target, medians = None, None
+    if df_target is not None:
+        medians = df_target[cols_numeric].astype(np.float64).median()
+        X_target = encode(df_target, columns, col_species, medians, encoding_marker)
+        # encoded columns have no missing values, their median for completeness
+        medians = np.concatenate(
+            [medians.to_numpy(), np.median(X_target[:, len(cols_numeric) :], axis=0)]
+        )
+        X_target = np.ascontiguousarray(X_target)
+    design = DesignMatrix(
+        columns,
+        responses,
+        X_ref=encode(df_ref, columns, col_species, encoding_marker=encoding_marker),
+        Y_ref=np.ascontiguousarray(
+            df_ref[responses].astype(np.float64).to_numpy(dtype=np.float64)
+        ),
+        X_target=X_target,
+        medians=medians,
+        key=key,
+        col_species=col_species,
+    )
+
+    if path:
+        if overwrite:
+            shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        _save(design, path)
+    return design
@@ -1,21 +1,43 @@
+import logging
 import os
 
 os.environ["USE_PYGEOS"] = "0"
 import geopandas as gpd
 import pandas as pd
+import pyarrow.parquet as pq
 
-from src.config.config import load_catalog, load_parameters
+from src.config.config import MODEL_FAMILIES, load_catalog, load_parameters
+from src.extrapolation import regressor, summaries
+from src.extrapolation.run_context import RunContext
 
 
-def merge_csv(col_id, col_species):
-    # export target data to csv
-    parameters = load_parameters()
-    municipality = parameters["municipality"]
-
+def results_file(municipality, ext="parquet") -> str:
+    """Wide results table <output>/<municipality>_extrapolation_results.<ext>"""
     catalog = load_catalog()
-    csv_folder = catalog[f"{municipality}_extrapolation"]["output"]["filepath_csv"]
-
-    csv_files = [
+    output_folder = catalog[f"{municipality}_extrapolation"]["output"]["filepath_csv"]
+    return os.path.join(output_folder, f"{municipality}_extrapolation_results.{ext}")
+
+
+def read_results(filepath, columns=None) -> pd.DataFrame:
+    """Read the results table (parquet, or csv of earlier runs)."""
+    if filepath.endswith(".parquet"):
+        return pd.read_parquet(filepath, columns=columns)
+    return pd.read_csv(filepath, usecols=columns, low_memory=False)
+
+
+def merge_results(col_id, col_species, ctx=None):
+    """
+    Build the wide results table keyed by target ID: the target columns and
+    one column per predicted response. The predictions are read from the
+    <prefix>_predicted.parquet files of the models of the run
+    (regressor.predict), the table is sorted by target ID and written once to
+    <municipality>_extrapolation_results.parquet and .csv.
+    """
+    logger = logging.getLogger(__name__)
+    ctx = ctx or RunContext()
+    municipality = ctx.municipality
+
+    responses = [
         "totben_cap",
         "co2_storage_kg",
         "co2_seq_kg_yr",
@@ -25,75 +47,99 @@ def merge_csv(col_id, col_species):
         # "pollution_so2",
         "pollution_g",
     ]
+    cols_target = [
+        col_id,
+        col_species,
+        "species_origin",
+        "delomradenummer",
+        "grunnkretsnummer",
+        "dbh",
+        "dbh_origin",
+        "height_total_tree",
+        "height_origin",
+        "crown_area",
+        "crown_diam",
+        "crown_origin",
+        "pollution_zone",
+    ]
 
-    dfs = {}
-
-    for file in csv_files:
-        dfs[file] = pd.read_csv(
-            os.path.join(csv_folder, f"{municipality}_{file}_predicted.csv"),
-            low_memory=False,
-        )
-
-    # drop cols except for id and value
-    for col, df in dfs.items():
-        if col == "totben_cap":
-            df = df[
-                [
-                    col_id,
-                    col_species,
-                    "species_origin",
-                    "delomradenummer",
-                    "grunnkretsnummer",
-                    "dbh",
-                    "dbh_origin",
-                    "height_total_tree",
-                    "height_origin",
-                    "crown_area",
-                    "crown_diam",
-                    "crown_origin",
-                    "pollution_zone",
-                    "totben_cap",
-                    "totben_cap_ca",
-                ]
-            ]
-        else:
-            df = df[[col_id, col]]
-
-        # update dict
-        dfs[col] = df
-        print(df.shape)
-        print(df.head(2))
-
-    # merge all dfs based on id (13504, 15 ) + (13504, 2) +  (13504, 2) + (13504, 2) + (13504, 2) + > (13504, 23)
-
-    df_merged = dfs["totben_cap"]
+    df_merged = _target_columns(cols_target, municipality)
     # if duplicates in col_id print ERROR
     if df_merged[col_id].duplicated().any():
-        print("ERROR: duplicates in col_id")
-        print(df_merged[df_merged[col_id].duplicated()])
+        logger.error("Duplicates in col_id")
+        logger.error(df_merged[df_merged[col_id].duplicated()])
         return
 
-    for col, df in dfs.items():
-        if col != "totben_cap":
-            print(f"Merge {col} with shape {df.shape} to df_merged")
-            df_merged = df_merged.merge(df, on=col_id)
-
-    print(df_merged.shape)
+    for response, df in _read_predictions(ctx, responses, col_id).items():
+        logger.info(f"Merge {response} with shape {df.shape} to results")
+        df_merged = df_merged.merge(df, on=col_id)
 
     # calculate
     # totben_cap_ca = totben_cap / crown_area
     df_merged["totben_cap_ca"] = df_merged["totben_cap"] / df_merged["crown_area"]
-    df_merged = df_merged.round(2)
-    print(df_merged.head(2))
-
-    # export to csv
-    df_merged.to_csv(
-        os.path.join(csv_folder, f"{municipality}_extrapolation_results.csv"),
-        index=False,
-    )
+    df_merged = df_merged[
+        [*cols_target, "totben_cap", "totben_cap_ca", *responses[1:]]
+    ].round(2)
+    df_merged = df_merged.sort_values(col_id, ignore_index=True)
+    logger.info(f"Results table: {df_merged.shape}")
+
+    # export to parquet (results table) and csv
+    df_merged.to_parquet(results_file(municipality), index=False)
+    df_merged.to_csv(results_file(municipality, "csv"), index=False)
     return
 
 
+def _prediction_files(ctx) -> dict:
+    """
+    {response: <prefix>_predicted.parquet} of the models of the run, the
+    prefix of the model municipality and the responses of each model
+    (RunContext.model_groups, regressor.get_file_prefix).
+    """
+    files = {}
+    for family in MODEL_FAMILIES:
+        for group in ctx.model_groups(family)[1]:
+            prefix = regressor.get_file_prefix(ctx.model_municipality, group)
+            for response in group:
+                files[response] = regressor.predictions_file(prefix, ctx.municipality)
+    return files
+
+
+def _read_predictions(ctx, responses, col_id):
+    """{response: df[col_id, response]} of the prediction files of the run."""
+    files = _prediction_files(ctx)
+
+    dfs = {}
+    for response in responses:
+        filepath = files.get(response)
+        if filepath is None:
+            raise ValueError(f"No model predicts <{response}> (parameters.yaml).")
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(f"Predictions of <{response}> missing: {filepath}")
+        if response not in pq.read_schema(filepath).names:
+            raise ValueError(f"Column <{response}> missing in {filepath}")
+        dfs[response] = pd.read_parquet(filepath, columns=[col_id, response])
+    return dfs
+
+
+def _target_columns(cols_target, municipality):
+    """
+    Target columns of the results table, with missing predictor values filled
+    with the median as in regressor.predict (rf_total_cap predictors).
+    """
+    parameters = load_parameters()
+    catalog = load_catalog()
+
+    target_path = catalog[f"{municipality}_extrapolation"]["target"]["filepath_parquet"]
+    df_target = pd.read_parquet(target_path, columns=cols_target)
+
+    predictors = parameters["rf_total_cap"]["model_options"]["predictors"]
+    predictors = [col for col in predictors if col in cols_target]
+    predictors = df_target[predictors].select_dtypes("number").columns
+    df_target[predictors] = df_target[predictors].astype("float64")
+    df_target[predictors] = df_target[predictors].fillna(df_target[predictors].median())
+    return df_target
+
+
 def merge_geojson(col_id):
     # export target data to csv
     parameters = load_parameters()
@@ -102,8 +148,7 @@ def merge_geojson(col_id):
     catalog = load_catalog()
     csv_folder = catalog[f"{municipality}_extrapolation"]["output"]["filepath_csv"]
 
-    filename = f"{municipality}_extrapolation_results.csv"
-    df = pd.read_csv(os.path.join(csv_folder, filename))
+    df = read_results(results_file(municipality))
 
     geojson_path = catalog[f"{municipality}_extrapolation"]["raw_crowns"][
         "filepath_geojson"
@@ -122,46 +167,25 @@ def merge_geojson(col_id):
     return
 
 
-def create_summary(input_file, output_path, col_species):
-    # read results csv
-    parameters = load_parameters()
-    municipality = parameters["municipality"]
-
-    df = pd.read_csv(input_file, low_memory=False)
+def create_summary(input_file, output_path, col_species, municipality=None):
+    """
+    Summary statistics of the results table (summaries.summarize), written to
+    <municipality>_summary_ES.csv, <municipality>_sum_ES_per_district.csv and
+    for Oslo <municipality>_summar_ES_schools.csv.
+    """
+    municipality = municipality or load_parameters()["municipality"]
 
-    categorical_vars = [col_species, "pollution_zone"]
-    continuous_vars = [
-        "dbh",
-        "height_total_tree",
-        "crown_area",
-        "co2_storage_kg",
-        "co2_seq_kg_yr",
-        "runoff_m3_yr",
-        "pollution_no2",
-        "pollution_pm25",
-        "pollution_so2",
-        "pollution_g_yr",
-        "co2_storage_nok_2023",
-        "co2_seq_nok_2023",
-        "runoff_nok_2023",
-        "pollution_nok_2023",
-        "totben_cap_2023",
-        "totben_cap_2023_ca",
-    ]
-
-    # calculate col totben_cap_2023_ca
-    df["totben_cap_2023_ca"] = df["totben_cap_2023"] / df["crown_area"]
-
-    # round all cols to 2 except wgs_lon and wgs_lat
+    # categorical_vars = [col_species, "pollution_zone"]
+    df_summary, df_sum, df_schools_summary = summaries.summarize(
+        input_file,
+        summaries.CONTINUOUS_VARS,
+        schools=municipality == "oslo",
+    )
 
-    df = df.round(2)
     # SUMMARY STAT BUILT-UP ZONE
     # ---------------------------
     # count mean std min 25% 50% 75% max
     # median sum
-    df_summary = df[continuous_vars].describe()
-    df_summary.loc["median"] = df[continuous_vars].median()
-    df_summary.loc["sum"] = df[continuous_vars].sum()
     df_summary = df_summary.round(1)
 
     # export to csv
@@ -173,8 +197,6 @@ def create_summary(input_file, output_path, col_species):
 
     # SUM OF ES PER DISTRICTS
     # -----------------------
-    df_sum = df.groupby(["grunnkretsnummer"]).sum()
-    df_sum = df_sum[continuous_vars]
     df_sum = df_sum.reset_index()
     df_sum = df_sum.rename(columns={"grunnkretsnummer": "district_id"})
     df_sum = df_sum.round(1)
@@ -188,14 +210,9 @@ def create_summary(input_file, output_path, col_species):
         index=False,
     )
 
-    if municipality == "oslo":
+    if df_schools_summary is not None:
         # SUMMARY STAT SCHOOLS
         # --------------------
-        df_schools = df[df["teig_undervisning"] == 1]
-
-        df_schools_summary = df_schools[continuous_vars].describe()
-        df_schools_summary.loc["median"] = df_schools[continuous_vars].median()
-        df_schools_summary.loc["sum"] = df_schools[continuous_vars].sum()
         df_schools_summary = df_schools_summary.round(1)
 
         # transform
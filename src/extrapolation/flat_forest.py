@@ -0,0 +1,205 @@
+"""
+Flat array inference of trained random forests.
+
+A fitted RandomForestRegressor is flattened into contiguous node arrays of all
+trees (tree i starts at roots[i]):
+
+- feature (int64), threshold (float64): split of each node, feature < 0 for
+  leaves
+- children (int64): (n_nodes, 2) child nodes, [right, left], so that the
+  result of X[feature] <= threshold indexes the next node
+- value (float64): leaf values (n_nodes, n_outputs)
+
+predict() moves all (row, tree) pairs of a batch one tree level per step and
+drops the pairs that reached a leaf, then averages the leaf values in tree
+order. The result is identical to RandomForestRegressor.predict (single
+process): X is compared as float32 with the float64 thresholds and the trees
+are summed in the same order.
+
+The arrays are saved as .npy files in one directory and can be loaded memory
+mapped, so worker processes share the pages of one file. A FlatForest loaded
+from disk is pickled as its path: workers memory map the same files instead of
+receiving a copy of the arrays.
+
+Example:
+--------
+forest = FlatForest.from_model(rf_model)
+forest.save("registry/1f2e3d4c.forest")
+forest = FlatForest.load("registry/1f2e3d4c.forest", mmap_mode="r")
+y_target = forest.predict(X_target, workers=4)
+"""
+
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+
+from src.config.config import load_parameters
+
+ARRAYS = ("feature", "threshold", "children", "value", "roots")
+DEFAULT_BATCH_SIZE = 10_000
+
+
+def is_enabled() -> bool:
+    """prediction: flat_forest in parameters.yaml (default True)."""
+    config = load_parameters().get("prediction", {}) or {}
+    return bool(config.get("flat_forest", True))
+
+
+def is_forest(model) -> bool:
+    return isinstance(model, RandomForestRegressor)
+
+
+class FlatForest:
+    """
+    Node arrays of a random forest regressor, see module docstring.
+
+    Attributes:
+    -----------
+    feature, threshold, children, value, roots : np.ndarray
+        node arrays of all trees
+    n_features : int
+        number of predictors
+    path : str
+        directory the arrays were loaded from (None if built in memory)
+
+    Methods:
+    --------
+    - from_model(cls, model)
+    - save(self, path)
+    - load(cls, path, mmap_mode)
+    - predict(self, X, batch_size, workers)
+    """
+
+    def __init__(
+        self,
+        feature,
+        threshold,
+        children,
+        value,
+        roots,
+        n_features,
+        path=None,
+        mmap_mode=None,
+    ):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.n_features = int(n_features)
+        self.path = path
+        self.mmap_mode = mmap_mode
+
+    def __reduce__(self):
+        # memory mapped forests are sent to worker processes by path
+        if self.path is not None and self.mmap_mode is not None:
+            return (FlatForest.load, (self.path, self.mmap_mode))
+        return super().__reduce__()
+
+    @classmethod
+    def from_model(cls, model):
+        """Flatten the trees of a fitted RandomForestRegressor."""
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        sizes = np.array([tree.node_count for tree in trees], dtype=np.int64)
+        roots = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+
+        feature, threshold, children, value = [], [], [], []
+        for tree, offset in zip(trees, roots):
+            is_leaf = tree.children_left == -1
+            feature.append(np.where(is_leaf, -1, tree.feature))
+            threshold.append(tree.threshold)
+            # leaves keep -1 (never followed)
+            right = np.where(is_leaf, -1, tree.children_right + offset)
+            left = np.where(is_leaf, -1, tree.children_left + offset)
+            children.append(np.stack([right, left], axis=1))
+            value.append(tree.value[:, :, 0])
+
+        return cls(
+            feature=np.concatenate(feature).astype(np.int64),
+            threshold=np.concatenate(threshold).astype(np.float64),
+            children=np.concatenate(children).astype(np.int64),
+            value=np.ascontiguousarray(np.concatenate(value), dtype=np.float64),
+            roots=roots,
+            n_features=model.n_features_in_,
+        )
+
+    def save(self, path) -> str:
+        """Write the arrays to path (via a temporary directory, atomic on rename)."""
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"n_features": self.n_features}, f)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Load the arrays of path, memory mapped by default."""
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ARRAYS
+        }
+        return cls(**arrays, **meta, path=path, mmap_mode=mmap_mode)
+
+    def _predict_batch(self, X) -> np.ndarray:
+        n_rows, n_trees = len(X), len(self.roots)
+        children = self.children.reshape(-1)
+
+        # node of each (row, tree) pair, row-major, and its offset in X
+        node = np.tile(self.roots, n_rows)
+        offset = np.repeat(np.arange(n_rows, dtype=np.int64) * X.shape[1], n_trees)
+        X = X.reshape(-1)
+
+        active = np.flatnonzero(self.feature[node] >= 0)
+        while active.size:
+            current = node[active]
+            go_left = X[offset[active] + self.feature[current]]
+            go_left = go_left <= self.threshold[current]
+            current = children[2 * current + go_left]
+            node[active] = current
+            active = active[self.feature[current] >= 0]
+
+        # sum in tree order, as RandomForestRegressor.predict
+        node = node.reshape(n_rows, n_trees)
+        y = np.zeros((n_rows, self.value.shape[1]), dtype=np.float64)
+        for i in range(n_trees):
+            y += self.value[node[:, i]]
+        y /= n_trees
+        return y
+
+    def predict(self, X, batch_size=DEFAULT_BATCH_SIZE, workers=1) -> np.ndarray:
+        """
+        Predict X (n_rows, n_features) in batches of batch_size rows, batches
+        are predicted in parallel with workers threads.
+
+        Returns:
+            np.ndarray: (n_rows,) for one output, else (n_rows, n_outputs)
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(
+                f"X has shape {X.shape}, the forest expects {self.n_features} "
+                "features"
+            )
+
+        batches = [X[i : i + batch_size] for i in range(0, len(X), batch_size)]
+        if workers > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self._predict_batch, batches))
+        else:
+            results = [self._predict_batch(batch) for batch in batches]
+
+        y = np.concatenate(results) if results else np.zeros((0, self.value.shape[1]))
+        if y.shape[1] == 1:
+            return y.ravel()
+        return y
@@ -0,0 +1,208 @@
+"""
+Model registry of the extrapolation models.
+
+Each trained model is stored under a key that hashes the training data
+(X_train, y_train), the predictors, the response and the model parameters, so
+a model is only reused if none of them changed. Models are stored with joblib
+in <registry>/<key>.joblib; index.json records per key the file prefix,
+response, predictors, parameters, training time and test metrics.
+
+Random forests are also stored as flat node arrays in <registry>/<key>.forest
+(flat_forest.py); predictor() returns them memory mapped for prediction.
+
+Models are compressed by default (model_registry: compress in
+parameters.yaml). With compress: 0 the numpy arrays in the file can be loaded
+memory-mapped (mmap_mode="r"), so that worker processes share the pages of one
+file instead of each holding a copy. Note that sklearn trees copy their node
+arrays into their own buffers on load; memory mapping pays off for models
+stored as plain numpy arrays.
+
+Example:
+--------
+registry = ModelRegistry()
+key = registry.key(X_train, y_train, predictors, response, params)
+model = registry.load(key)
+if model is None:
+    model = train(...)
+    registry.store(key, model, file_prefix=file_prefix, train_s=train_s)
+registry.update(key, metrics={"runoff_m3": {...}})
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+from typing import Dict
+
+import joblib
+import numpy as np
+
+from src.config.config import load_catalog, load_parameters
+from src.extrapolation import flat_forest
+
+DEFAULT_COMPRESS = 3
+
+
+def _hash_array(h, array):
+    array = np.ascontiguousarray(np.asarray(array, dtype=np.float64))
+    h.update(str(array.shape).encode("utf-8"))
+    h.update(array.tobytes())
+
+
+class ModelRegistry:
+    """
+    Trained models keyed by a hash of training data, predictors, response and
+    parameters.
+
+    Attributes:
+    -----------
+    path : str
+        registry directory (catalog: <municipality>_extrapolation: model:
+        filepath_registry)
+    compress : int
+        joblib compression level, 0 stores uncompressed (memory-mappable)
+    index : dict
+        {key: {"file_prefix", "response", "predictors", "params", "n_train",
+        "trained_at", "train_s", "metrics"}}
+
+    Methods:
+    --------
+    - key(self, X_train, y_train, predictors, response, params)
+    - load(self, key, mmap_mode)
+    - store(self, key, model, **info)
+    - update(self, key, **info)
+    - latest(self, file_prefix)
+    - predictor(self, key, model)
+    """
+
+    def __init__(self, path=None, municipality=None, compress=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        params = load_parameters()
+        if path is None:
+            municipality = municipality or params["municipality"]
+            catalog = load_catalog()
+            path = catalog[f"{municipality}_extrapolation"]["model"][
+                "filepath_registry"
+            ]
+        if compress is None:
+            config = params.get("model_registry", {}) or {}
+            compress = config.get("compress", DEFAULT_COMPRESS)
+
+        self.path = path
+        self.compress = compress
+        self.index_file = os.path.join(path, "index.json")
+        self.index = self._read_index()
+
+    def _read_index(self) -> Dict:
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file, "r") as f:
+            return json.load(f)
+
+    def _write_index(self):
+        # merge with entries written by other processes in the meantime
+        index = self._read_index()
+        index.update(self.index)
+        self.index = index
+
+        os.makedirs(self.path, exist_ok=True)
+        tmp_file = f"{self.index_file}.tmp{os.getpid()}"
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f, indent=2, default=str)
+        os.replace(tmp_file, self.index_file)
+
+    def _model_file(self, key) -> str:
+        return os.path.join(self.path, f"{key}.joblib")
+
+    def _forest_path(self, key) -> str:
+        return os.path.join(self.path, f"{key}.forest")
+
+    @staticmethod
+    def key(X_train, y_train, predictors, response, params) -> str:
+        """Hash of the training data, predictors, response and parameters."""
+        h = hashlib.sha256()
+        _hash_array(h, X_train)
+        _hash_array(h, y_train)
+        h.update(
+            json.dumps(
+                [list(predictors), list(response), params],
+                sort_keys=True,
+                default=str,
+            ).encode("utf-8")
+        )
+        return h.hexdigest()[:16]
+
+    def load(self, key, mmap_mode=None):
+        """Model stored under key, None if not in the registry."""
+        filepath = self._model_file(key)
+        if key not in self.index or not os.path.exists(filepath):
+            return None
+
+        self.logger.info(
+            f"Load model <{key}> ({self.index[key].get('file_prefix')}) "
+            "from registry..."
+        )
+        # compressed files cannot be memory mapped
+        if self.compress:
+            mmap_mode = None
+        return joblib.load(filepath, mmap_mode=mmap_mode)
+
+    def store(self, key, model, **info) -> str:
+        """Store model under key, with info (file_prefix, train_s, ...)."""
+        os.makedirs(self.path, exist_ok=True)
+        filepath = self._model_file(key)
+        joblib.dump(model, filepath, compress=self.compress)
+        if flat_forest.is_forest(model):
+            flat_forest.FlatForest.from_model(model).save(self._forest_path(key))
+
+        entry = {
+            "trained_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "model": type(model).__name__,
+            "metrics": {},
+        }
+        entry.update(info)
+        self.index[key] = entry
+        self._write_index()
+
+        self.logger.info(f"Stored model <{key}> in registry: {filepath}")
+        return filepath
+
+    def update(self, key, **info):
+        """Add info to the index entry of key (e.g. metrics per response)."""
+        if key not in self.index:
+            return
+        entry = self.index[key]
+        for name, value in info.items():
+            if isinstance(value, dict) and isinstance(entry.get(name), dict):
+                entry[name].update(value)
+            else:
+                entry[name] = value
+        self._write_index()
+
+    def predictor(self, key, model):
+        """
+        Model used for prediction: the flat node arrays of key (memory mapped)
+        for random forests (prediction: flat_forest in parameters.yaml), else
+        model itself.
+        """
+        if not flat_forest.is_enabled() or not flat_forest.is_forest(model):
+            return model
+
+        path = self._forest_path(key)
+        if not os.path.exists(path):  # stored before the forest export
+            if key not in self.index:
+                return flat_forest.FlatForest.from_model(model)
+            flat_forest.FlatForest.from_model(model).save(path)
+        return flat_forest.FlatForest.load(path, mmap_mode="r")
+
+    def latest(self, file_prefix) -> Dict:
+        """Most recent index entry of file_prefix, None if not trained yet."""
+        entries = [
+            entry
+            for entry in self.index.values()
+            if entry.get("file_prefix") == file_prefix
+        ]
+        if not entries:
+            return None
+        return max(entries, key=lambda entry: entry["trained_at"])
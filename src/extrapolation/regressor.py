@@ -11,6 +11,7 @@ from sklearn.metrics import mean_squared_error, r2_score
 from sklearn.model_selection import GridSearchCV, train_test_split
 
 from src.config.config import load_catalog, load_parameters
+from src.extrapolation import design_matrix, flat_forest, reporting, streaming
 
 
 def get_file_prefix(municipality, response):
@@ -26,28 +27,16 @@ def get_file_prefix(municipality, response):
 
 def _get_predictors(df_ref, predictors, encoding_marker) -> List:
     # if norwegian name or taxon genus in predictors get encoded cols
-    if "norwegian_name" in predictors or "taxon_genus" in predictors:
-        cols_encoded = [
-            col for col in df_ref.columns if col.startswith(encoding_marker)
-        ]
-
-        # drop norwegian_name and/or taxon_genus from predictors
-        if "norwegian_name" in predictors:
-            predictors.remove("norwegian_name")
-        if "taxon_genus" in predictors:
-            predictors.remove("taxon_genus")
-
-        predictors = [*predictors, *cols_encoded]
-        return predictors
-
-    else:
-        return predictors
+    # (returns a new list, predictors is not modified)
+    return design_matrix.predictor_columns(
+        df_ref, predictors, encoding_marker=encoding_marker
+    )
 
 
-def _export_model(model, file_prefix):
+def _export_model(model, file_prefix, municipality=None):
     logger = logging.getLogger(__name__)
     logger.info("Export model...")
-    municipality = load_parameters()["municipality"]
+    municipality = municipality or load_parameters()["municipality"]
     catalog = load_catalog()
 
     # construct file path
@@ -59,11 +48,11 @@ def _export_model(model, file_prefix):
         pickle.dump(model, f)
 
 
-def _export_model_params(model_params, file_prefix):
+def _export_model_params(model_params, file_prefix, municipality=None):
     logger = logging.getLogger(__name__)
     logger.info("Export model parameters...")
     # Save the model params to a file
-    municipality = load_parameters()["municipality"]
+    municipality = municipality or load_parameters()["municipality"]
     catalog = load_catalog()
 
     path = catalog[f"{municipality}_extrapolation"]["model"]["filepath_json"]
@@ -74,11 +63,11 @@ def _export_model_params(model_params, file_prefix):
         json.dump(model_params, f)
 
 
-def _update_model_params(new_params, file_prefix):
+def _update_model_params(new_params, file_prefix, municipality=None):
     logger = logging.getLogger(__name__)
     logger.info("Update model parameters...")
 
-    municipality = load_parameters()["municipality"]
+    municipality = municipality or load_parameters()["municipality"]
     catalog = load_catalog()
 
     path = catalog[f"{municipality}_extrapolation"]["model"]["filepath_json"]
@@ -99,74 +88,57 @@ def _update_model_params(new_params, file_prefix):
         json.dump(existing_params, f)
 
 
-def _plot_model_performance(response, y_test, y_pred, dict, file_prefix):
-    import matplotlib.pyplot as plt
-    import seaborn as sns
-
-    logger = logging.getLogger(__name__)
-    logger.info("Plot model performance...")
-
-    # list to string
-    response_str = " ".join(response)
-    # remove ' ' from filename
-    response_str = response_str.replace("'", "")
-    response_str = response_str.replace("[", "")
-    response_str = response_str.replace("]", "")
-
-    # plot results and save plot to output folder
-    plt.clf()
-
-    # Regression plot
-    sns.jointplot(
-        x=y_test,
-        y=y_pred,
-        kind="reg",
-        truncate=False,
-        # xlim=(0, 60), ylim=(0, 12),
-        color="#427360",
-        height=7,
-    )
-    plt.xlabel(f"actual {response_str}")
-    plt.ylabel(f"predicted {response_str}")
-    plt.figtext(
-        0,
-        -0.05,
-        f"R2: {dict['r2']}    RMSE: {dict['rmse']:.2f}\
-        \n{dict['model_name']}",
-        ha="left",
-        fontsize=10,
-    )
-
-    # save plot
-    municipality = load_parameters()["municipality"]
+def _plot_model_performance(
+    response, y_test, y_pred, dict, file_prefix, municipality=None
+):
+    # saved for the reporting stage, rendered according to reporting: plots
+    municipality = municipality or load_parameters()["municipality"]
     catalog = load_catalog()
 
     path = catalog[f"{municipality}_extrapolation"]["model"]["filepath_img"]
     filename = f"{file_prefix}_performance.png"
     filepath = os.path.join(path, filename)
-    plt.savefig(filepath, bbox_inches="tight")
+    reporting.plot_performance(response, y_test, y_pred, dict, filepath)
 
 
-def split_data(data, model_params, response, predictors) -> Tuple:
+def split_data(data, model_params, response, predictors, design=None) -> Tuple:
     """Splits data into features and targets training and test sets.
 
     Args:
         data (df): Reference dataframe containing features and target.
         model_params (dict): model parameters defined in parameters.yml
+        design (DesignMatrix): encoded data (design_matrix.build), if given
+            the split is taken from its float32 arrays instead of data
     Returns:
         Split data (tpl): X_train, X_test, y_train, y_test
     """
     logger = logging.getLogger(__name__)
     logger.info("Split data into training and test sets...")
 
+    if design is not None:
+        X_train, X_test, y_train, y_test = design.split(
+            response,
+            test_size=model_params["test_size"],
+            random_state=model_params["random_state"],
+        )
+        logger.info(f"PREDICTORS: {design.columns}")
+        logger.info(f"RESPONSE: {response}")
+        logger.info(f"Y_train shape: {y_train.shape}")
+        logger.info(f"y_test shape: {y_test.shape}")
+        return design.columns, X_train, X_test, y_train, y_test
+
     # get encoded cols if norwegian_name or taxon_genus in predictors
     predictors = _get_predictors(
         df_ref=data, predictors=predictors, encoding_marker="SP_"
     )
 
+    # encode the species column (design_matrix.encode)
+    X = pd.DataFrame(
+        design_matrix.encode(data, predictors), columns=predictors, index=data.index
+    )
+
     # drop rows with missing values in predictors and response
-    cols = [*response, *predictors]
-    data = data[cols].dropna()
+    data = pd.concat([data[response], X], axis=1).dropna()
 
     X = data[predictors]
     y = data[response]
@@ -178,8 +150,13 @@ def split_data(data, model_params, response, predictors) -> Tuple:
         random_state=model_params["random_state"],
     )
 
-    y_train = y_train.values.ravel()
-    y_test = y_test.values.ravel()
+    # multi-output models are trained on the (n_samples, n_responses) matrix
+    if len(response) == 1:
+        y_train = y_train.values.ravel()
+        y_test = y_test.values.ravel()
+    else:
+        y_train = y_train.values
+        y_test = y_test.values
 
     logger.info(f"PREDICTORS: {predictors}")
     logger.info(f"RESPONSE: {response}")
@@ -206,10 +183,119 @@ def load_model(filepath):
     return model
 
 
-def tune_rf(X_train, y_train, model_params, file_prefix):
+# parameter grid of tune_rf
+PARAM_GRID = {
+    "n_estimators": range(1, 40),
+    "max_features": [1.0, "sqrt", "log2"],
+}
+
+
+def _cv_scores_per_n_estimators(X, y, max_features, folds, random_state):
+    """
+    R2 score per fold and per n_estimators for one max_features value.
+
+    One forest with max(n_estimators) trees is fitted per fold. The first k
+    trees of a forest are identical to a forest of k trees with the same
+    random_state, so the cumulative mean of the per-tree predictions gives the
+    prediction of every smaller forest without refitting.
+
+    Returns:
+        np.array: scores of shape (n_folds, len(PARAM_GRID["n_estimators"]))
+    """
+    n_estimators = np.asarray(PARAM_GRID["n_estimators"])
+    scores = np.empty((len(folds), len(n_estimators)))
+
+    for i, (train_idx, val_idx) in enumerate(folds):
+        forest = RandomForestRegressor(
+            n_estimators=int(n_estimators.max()),
+            max_features=max_features,
+            random_state=random_state,
+            n_jobs=-1,
+        )
+        forest.fit(X[train_idx], y[train_idx])
+
+        X_val = X[val_idx].astype(np.float32)
+        tree_pred = np.stack([tree.predict(X_val) for tree in forest.estimators_])
+        # accumulate tree by tree (same summation order as forest.predict)
+        cum_pred = np.cumsum(tree_pred, axis=0)
+        for j, n in enumerate(n_estimators):
+            scores[i, j] = r2_score(y[val_idx], cum_pred[n - 1] / n)
+
+    return scores
+
+
+def _halving_search(X_train, y_train, model_params):
+    """
+    Successive halving over max_features, with the CV folds as resource.
+
+    All max_features candidates are scored on a few folds, the best 1/factor
+    candidates are scored on factor times more folds, until one candidate is
+    left or all folds are used. n_estimators is evaluated incrementally for
+    every candidate (see _cv_scores_per_n_estimators).
+
+    Returns:
+        best_params (dict), best_score (float): same keys as GridSearchCV
+    """
+    from sklearn.model_selection import KFold
+
+    logger = logging.getLogger(__name__)
+    factor = model_params.get("halving_factor", 3)
+    n_splits = 10
+
+    X = np.asarray(X_train, dtype=np.float64)
+    y = np.asarray(y_train, dtype=np.float64)
+    # same folds as GridSearchCV(cv=10) for a regressor
+    folds = list(KFold(n_splits=n_splits).split(X))
+
+    candidates = list(PARAM_GRID["max_features"])
+    n_rounds = int(np.ceil(np.log(len(candidates)) / np.log(factor))) + 1
+    n_folds = max(2, int(np.ceil(n_splits / factor ** (n_rounds - 1))))
+    scores = {}  # {max_features: (n_folds, n_estimators) scores}
+
+    while True:
+        n_folds = min(n_folds, n_splits)
+        for max_features in candidates:
+            done = scores.get(max_features, np.empty((0, 0)))
+            new = _cv_scores_per_n_estimators(
+                X,
+                y,
+                max_features,
+                folds[len(done) : n_folds],
+                model_params["random_state"],
+            )
+            scores[max_features] = np.vstack([done, new]) if len(done) else new
+
+        best = {mf: scores[mf].mean(axis=0).max() for mf in candidates}
+        logger.info(f"Halving round ({n_folds} folds): {best}")
+
+        if len(candidates) == 1 and n_folds == n_splits:
+            break
+        if n_folds == n_splits:
+            # all folds used, keep the best candidate
+            candidates = [max(candidates, key=lambda mf: best[mf])]
+            break
+
+        n_keep = max(1, int(np.ceil(len(candidates) / factor)))
+        # stable sort keeps the grid order for ties (as GridSearchCV)
+        candidates = sorted(candidates, key=lambda mf: -best[mf])[:n_keep]
+        n_folds = n_folds * factor
+
+    max_features = candidates[0]
+    mean_scores = scores[max_features].mean(axis=0)
+    best_index = int(np.argmax(mean_scores))
+    best_params = {
+        "max_features": max_features,
+        "n_estimators": int(PARAM_GRID["n_estimators"][best_index]),
+    }
+    return best_params, float(mean_scores[best_index])
+
+
+def tune_rf(X_train, y_train, model_params, file_prefix, municipality=None):
     """
     Tuning random forest parameters n_estimators and max_features.
-    Using grid search with 10-fold cross-validation.
+    Using grid search with 10-fold cross-validation (model_options: tuning: grid)
+    or successive halving over max_features with incrementally evaluated
+    n_estimators (model_options: tuning: halving).
 
     n_estimators: The number of trees in the forest.
     max_features: The number of features to consider when looking for the best split.
@@ -218,25 +304,42 @@ def tune_rf(X_train, y_train, model_params, file_prefix):
         X_train (df): Training features.
         y_train (df): Training target.
         params (dict): Parameters defined in parameters/data_science.yml.
+        municipality (str): Municipality of the run (catalog paths), defaults
+            to parameters.yaml.
 
     Returns:
         best_rfmodel (obj): Best random forest model.
     """
     logger = logging.getLogger(__name__)
     logger.info("Tuning random forest parameters...")
+
+    if model_params.get("tuning", "grid") == "halving":
+        best_params, avg_r2_score = _halving_search(X_train, y_train, model_params)
+        logger.info(
+            f"Average R2 score across all folds of the cross-validation: {avg_r2_score}"
+        )
+        logger.info(f"Best parameters: {best_params}")
+
+        # refit on all training data
+        best_rfmodel = RandomForestRegressor(
+            random_state=model_params["random_state"], **best_params
+        )
+        best_rfmodel.fit(X_train, y_train)
+        logger.info(
+            f"R2 score of the best model: {best_rfmodel.score(X_train, y_train)}"
+        )
+
+        _export_model(best_rfmodel, file_prefix, municipality)
+        _export_model_params(best_params, file_prefix, municipality)
+        return best_rfmodel
+
     # Create a RadomForest regression model
     rfmodel = RandomForestRegressor(random_state=model_params["random_state"])
 
-    # Define the parameter grid
-    param_grid = {
-        "n_estimators": range(1, 40),
-        "max_features": [1.0, "sqrt", "log2"],
-    }
-
     # Perform grid search
     # use all processors available (n_jobs=-1)
     grid_search = GridSearchCV(
-        rfmodel, param_grid, cv=10, scoring="r2", n_jobs=-1, verbose=1
+        rfmodel, PARAM_GRID, cv=10, scoring="r2", n_jobs=-1, verbose=1
     )
     grid_search.fit(X_train, y_train)
 
@@ -258,13 +361,13 @@ def tune_rf(X_train, y_train, model_params, file_prefix):
     logger.info(f"Best parameters: {best_params}")
 
     # export best model and parameters
-    _export_model(best_rfmodel, file_prefix)
-    _export_model_params(best_params, file_prefix)
+    _export_model(best_rfmodel, file_prefix, municipality)
+    _export_model_params(best_params, file_prefix, municipality)
 
     return best_rfmodel
 
 
-def linear_regression(X_train, y_train, file_prefix):
+def linear_regression(X_train, y_train, file_prefix, municipality=None):
     logger = logging.getLogger(__name__)
     logger.info("Tuning random forest parameters...")
 
@@ -274,23 +377,30 @@ def linear_regression(X_train, y_train, file_prefix):
     linear_model = LinearRegression()
     linear_model.fit(X_train, y_train)
 
-    _export_model(linear_model, file_prefix)
+    _export_model(linear_model, file_prefix, municipality)
 
     return linear_model
 
 
-def get_model(X_train, y_train, model_params, file_prefix):
+def get_model(X_train, y_train, model_params, file_prefix, municipality=None):
     """
-    Train model using the tuned parameters stored in the model_params.json file.
+    Train model using the tuned parameters of the latest model of file_prefix
+    in the model registry, or else of the <file_prefix>_model_params.json file.
     """
+    from src.extrapolation.model_registry import ModelRegistry
 
     logger = logging.getLogger(__name__)
     logger.info("Train model using the tuned parameters...")
-    municipality = load_parameters()["municipality"]
+    municipality = municipality or load_parameters()["municipality"]
     path = load_catalog()[f"{municipality}_extrapolation"]["model"]["filepath_json"]
 
-    with open(path, "r") as f:
-        best_params = json.load(f)
+    entry = ModelRegistry(municipality=municipality).latest(file_prefix)
+    if entry is not None and "n_estimators" in entry.get("best_params", {}):
+        best_params = entry["best_params"]
+    else:
+        filepath = os.path.join(path, f"{file_prefix}_model_params.json")
+        with open(filepath, "r") as f:
+            best_params = json.load(f)
 
     n_estimators = best_params["n_estimators"]
     max_features = best_params["max_features"]
@@ -304,13 +414,23 @@ def get_model(X_train, y_train, model_params, file_prefix):
     rfmodel.fit(X_train, y_train)
 
     # export trained model
-    _export_model(rfmodel, file_prefix)
-    _export_model_params(best_params, file_prefix)
+    _export_model(rfmodel, file_prefix, municipality)
+    _export_model_params(best_params, file_prefix, municipality)
 
     return rfmodel
 
 
-def evaluate_model(model, response, X_test, y_test, model_params, file_prefix):
+def evaluate_model(
+    model,
+    response,
+    X_test,
+    y_test,
+    model_params,
+    file_prefix,
+    y_pred=None,
+    predictors=None,
+    municipality=None,
+):
     """Evaluate model performance on test data.
     and store the results in a dictionary.
 
@@ -318,6 +438,11 @@ def evaluate_model(model, response, X_test, y_test, model_params, file_prefix):
         model (obj): Trained model.
         X_test (df): Test features.
         y_test (df): Test target.
+        y_pred (array): Predictions of X_test, predicted with model if None
+            (one column of a multi-output prediction).
+        predictors (list): Column names of X_test if it is an array.
+        municipality (str): Municipality of the run (catalog paths), defaults
+            to parameters.yaml.
 
     Returns:
         mae (float): Mean absolute error.
@@ -329,7 +454,8 @@ def evaluate_model(model, response, X_test, y_test, model_params, file_prefix):
     logger.info("Evaluate model performance on test data...")
 
     # Make predictions using the trained model
-    y_pred = model.predict(X_test)
+    if y_pred is None:
+        y_pred = model.predict(X_test)
 
     # Calculate and return the RMSE
     mae = round(np.mean(np.abs(y_test - y_pred)), 2)
@@ -339,7 +465,7 @@ def evaluate_model(model, response, X_test, y_test, model_params, file_prefix):
 
     if "kristiansand" in file_prefix:
         # Get equation of the model
-        X_test = pd.DataFrame(X_test)
+        X_test = pd.DataFrame(X_test, columns=predictors)
 
         b0 = round(model.intercept_, 1)
         b1 = round(model.coef_[0], 1)
@@ -383,64 +509,175 @@ def evaluate_model(model, response, X_test, y_test, model_params, file_prefix):
         \n{dict['model_name']}",
     )
 
-    _plot_model_performance(response, y_test, y_pred, dict, file_prefix)
+    _plot_model_performance(response, y_test, y_pred, dict, file_prefix, municipality)
 
     # if file prefix contains "kristiansand"
     if "kristiansand" not in file_prefix:
-        _export_model_params(dict, file_prefix)
+        _export_model_params(dict, file_prefix, municipality)
 
     return dict
 
 
-def predict(df_target, target_id, regressor, response, predictors, file_prefix):
+def predict(
+    df_target,
+    target_id,
+    regressor,
+    response,
+    predictors,
+    file_prefix,
+    design=None,
+    municipality=None,
+):
     """Extrapolate (predict) the values to the target dataset.
 
+    The predictions are written to <file_prefix>_predicted.parquet (target ID
+    and one column per response), the columns of the results table
+    (export_results.merge_results).
+
     Args:
-        df_target (df): Target dataset.
-        model (obj): Trained model.
+        df_target (df): Target dataset, None with streaming prediction (the
+            target parquet file is read by row group).
+        model (obj): Trained model (or its flat_forest.FlatForest).
+        design (DesignMatrix): encoded data (design_matrix.build), if given
+            its imputed X_target is used instead of imputing df_target again
+        municipality (str): Municipality of the run (catalog paths), defaults
+            to parameters.yaml.
 
     Returns:
-        df_target (df): Target dataset with predicted values.
+        df_target (df): Target dataset.
     """
 
     logger = logging.getLogger(__name__)
     logger.info("Predicting values to target dataset...")
 
-    # delete row if predictors contain missing values
-    # df = df_target.dropna(subset=predictors)
-    # fill missing values with median
-    logger.info(f"Median imputation of missing values in continuous {predictors}...")
-    df = df_target.copy()
-    df[predictors] = df[predictors].fillna(df[predictors].median())
-
-    X_target = df[predictors]
+    if streaming.is_enabled():
+        _predict_streaming(
+            regressor,
+            response,
+            predictors,
+            file_prefix,
+            design,
+            target_id=target_id,
+            municipality=municipality,
+        )
+        return df_target
+
+    if design is not None:
+        X_target = design.X_target
+    else:
+        # fill missing values with median
+        logger.info(f"Median imputation of missing values in {predictors}...")
+        X_target = pd.DataFrame(
+            design_matrix.encode(df_target, predictors), columns=predictors
+        )
+        X_target = X_target.fillna(X_target.median())
 
     # predict
-    y_target = regressor.predict(X_target)
-    y_target = np.round(y_target, 2)
-    y_target = pd.DataFrame(y_target, columns=response)
-
-    # add predicted values to target dataset
-    df_result = df.copy()
-    # drop all rows starting with SP_ (encoded cols)
-    df_result = df_result[df_result.columns.drop(list(df_result.filter(regex="SP_")))]
-    # sort by ID
-    df_result = df_result.sort_values(by=[target_id])
-    df_result[response] = y_target[response]
-
-    _export_results(df_result, file_prefix)
+    if isinstance(regressor, flat_forest.FlatForest):
+        workers = streaming.config().get("workers", streaming.DEFAULT_WORKERS)
+        y_target = regressor.predict(X_target, workers=workers)
+    else:
+        y_target = regressor.predict(X_target)
+    y_target = np.round(y_target, 2).reshape(len(df_target), len(response))
+
+    _export_predictions(
+        df_target[target_id], y_target, response, file_prefix, municipality
+    )
     return df_target
 
 
-def _export_results(df_target, file_prefix):
-    logger = logging.getLogger(__name__)
-    logger.info("Exporting results...")
-    # export target data to csv
-    municipality = load_parameters()["municipality"]
+def predict_multi_output(
+    df_target,
+    target_id,
+    regressor,
+    response,
+    predictors,
+    model_municipality,
+    design=None,
+    municipality=None,
+):
+    """Predict all responses of a multi-output model in one pass over the
+    target dataset, see predict().
+
+    Args:
+        df_target (df): Target dataset.
+        regressor (obj): Trained multi-output model.
+        response (list): Response variables, in the column order of the model.
+        model_municipality (str): Municipality of the model (file prefix).
+        design (DesignMatrix): encoded data (design_matrix.build).
+        municipality (str): Municipality of the run (catalog paths).
+
+    Returns:
+        df_target (df): Target dataset.
+    """
+    file_prefix = get_file_prefix(model_municipality, response)
+    return predict(
+        df_target,
+        target_id,
+        regressor,
+        response,
+        predictors,
+        file_prefix,
+        design,
+        municipality=municipality,
+    )
+
+
+def _predict_streaming(
+    regressor,
+    response,
+    predictors,
+    file_prefix,
+    design=None,
+    target_id=None,
+    municipality=None,
+):
+    """Predict over the row groups of the target parquet file (streaming.py),
+    writing <file_prefix>_predicted.parquet with the ID and response columns.
+    """
+    parameters = load_parameters()
+    municipality = municipality or parameters["municipality"]
+    target_id = target_id or parameters[municipality]["target_id"]
+    catalog = load_catalog()[f"{municipality}_extrapolation"]
+
+    # medians of the target, computed from the target file (predict_parquet)
+    # if the design matrix was built without the target
+    medians = None
+    col_species = None
+    if design is not None:
+        col_species = design.col_species
+    if design is not None and design.medians is not None:
+        medians = pd.Series(np.asarray(design.medians), index=design.columns)
+        medians = medians.dropna()
+
+    streaming.predict_parquet(
+        regressor,
+        catalog["target"]["filepath_parquet"],
+        predictions_file(file_prefix, municipality),
+        target_id=target_id,
+        predictors=predictors,
+        response=response,
+        medians=medians,
+        col_species=col_species,
+    )
+
+
+def predictions_file(file_prefix, municipality=None) -> str:
+    """<output>/<file_prefix>_predicted.parquet"""
+    municipality = municipality or load_parameters()["municipality"]
     catalog = load_catalog()
 
     path = catalog[f"{municipality}_extrapolation"]["output"]["filepath_csv"]
-    file_name = f"{file_prefix}_predicted.csv"
-    filepath = os.path.join(path, file_name)
-    df_target.to_csv(filepath, index=False, encoding="utf-8")
-    return logger.info(f"Exported results to {filepath}")
+    return os.path.join(path, f"{file_prefix}_predicted.parquet")
+
+
+def _export_predictions(ids, y_target, response, file_prefix, municipality=None):
+    logger = logging.getLogger(__name__)
+    logger.info("Exporting predictions...")
+
+    df = pd.DataFrame(y_target, columns=response)
+    df.insert(0, ids.name, ids.to_numpy())
+
+    filepath = predictions_file(file_prefix, municipality)
+    df.to_parquet(filepath, index=False)
+    return logger.info(f"Exported predictions to {filepath}")
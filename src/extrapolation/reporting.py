@@ -0,0 +1,220 @@
+"""
+Diagnostic plots of the extrapolation, rendered outside the training loop.
+
+The plotting functions do not render, they save the plot data next to the
+image as <image>.plot.npz (arrays and a JSON description). When the plot is
+rendered depends on reporting: plots in parameters.yaml:
+
+- deferred: only the plot data is saved, render_pending() renders the
+  images after the run (reporting stage, python -m src.extrapolation.reporting)
+- background: rendered in a background process while the run continues
+- inline: rendered at once (former behaviour)
+- off: only the plot data is saved, no images
+
+matplotlib and seaborn are imported only when an image is rendered, so
+deferred batch runs do not load them.
+
+Example:
+--------
+reporting.plot_performance(response, y_test, y_pred, metrics, filepath)
+...
+reporting.render_pending([img_dir])
+"""
+
+import atexit
+import functools
+import glob
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.config.config import load_catalog, load_parameters
+from src.extrapolation.run_context import MODEL_MUNICIPALITY
+
+MODES = ("deferred", "background", "inline", "off")
+DEFAULT_MODE = "deferred"
+JOB_SUFFIX = ".plot.npz"
+
+_executor = None
+
+
+def mode() -> str:
+    """reporting: plots in parameters.yaml."""
+    config = load_parameters().get("reporting", {}) or {}
+    plots = config.get("plots", DEFAULT_MODE)
+    if plots not in MODES:
+        raise ValueError(f"reporting: plots must be one of {MODES}, not <{plots}>")
+    return plots
+
+
+def _job_file(filepath) -> str:
+    return f"{filepath}{JOB_SUFFIX}"
+
+
+def _log_failure(job_file, future):
+    # background renders fail silently unless their exception is logged
+    if future.cancelled() or future.exception() is None:
+        return
+    logger = logging.getLogger(__name__)
+    logger.error(
+        f"Rendering {job_file} failed: {future.exception()!r}. "
+        "Render it again with python -m src.extrapolation.reporting."
+    )
+
+
+def _submit(job_file):
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=1)
+        atexit.register(_executor.shutdown, wait=True)
+    future = _executor.submit(render, job_file)
+    future.add_done_callback(functools.partial(_log_failure, job_file))
+
+
+def _save(kind, filepath, arrays, meta) -> str:
+    """Save the plot data of filepath and render it according to mode()."""
+    os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+    job_file = _job_file(filepath)
+    job = json.dumps({"kind": kind, "filepath": filepath, "meta": meta}, default=str)
+    # written via a temporary file, a background render never sees half a job
+    tmp_file = f"{job_file}.tmp{os.getpid()}.npz"
+    np.savez(tmp_file, job=np.array(job), **arrays)
+    os.replace(tmp_file, job_file)
+
+    plots = mode()
+    if plots == "inline":
+        render(job_file)
+    elif plots == "background":
+        _submit(job_file)
+    return job_file
+
+
+def plot_performance(response, y_test, y_pred, metrics, filepath) -> str:
+    """Actual vs. predicted values of the test set (regressor.evaluate_model)."""
+    arrays = {
+        "y_test": np.asarray(y_test, dtype=np.float64),
+        "y_pred": np.asarray(y_pred, dtype=np.float64),
+    }
+    meta = {"response": list(response), "metrics": metrics}
+    return _save("performance", filepath, arrays, meta)
+
+
+def plot_species_summary(data, x, y, title, xlabel, ylabel, filepath) -> str:
+    """Bar chart of the species distribution (clean_reference.main)."""
+    arrays = {
+        "x": np.array(data[x].astype(str).tolist(), dtype=str),
+        "y": data[y].to_numpy(dtype=np.float64),
+    }
+    meta = {"title": title, "xlabel": xlabel, "ylabel": ylabel}
+    return _save("species_summary", filepath, arrays, meta)
+
+
+def _render_performance(arrays, meta, filepath):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    metrics = meta["metrics"]
+    response_str = " ".join(meta["response"])
+
+    # Regression plot
+    plt.clf()
+    grid = sns.jointplot(
+        x=arrays["y_test"],
+        y=arrays["y_pred"],
+        kind="reg",
+        truncate=False,
+        color="#427360",
+        height=7,
+    )
+    plt.xlabel(f"actual {response_str}")
+    plt.ylabel(f"predicted {response_str}")
+    plt.figtext(
+        0,
+        -0.05,
+        f"R2: {metrics['r2']}    RMSE: {metrics['rmse']:.2f}\
+        \n{metrics['model_name']}",
+        ha="left",
+        fontsize=10,
+    )
+    plt.savefig(filepath, bbox_inches="tight")
+    plt.close(grid.fig)
+
+
+def _render_species_summary(arrays, meta, filepath):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    fig, ax = plt.subplots(figsize=(30, 5))
+    sns.barplot(x=arrays["x"], y=arrays["y"], ax=ax, color="darkgreen")
+    ax.set_title(meta["title"], fontweight="ultralight", fontsize=20)
+    ax.set_xlabel(meta["xlabel"], fontweight="bold")
+    ax.set_ylabel(meta["ylabel"], fontweight="bold")
+    plt.xticks(rotation=45, fontweight="ultralight")
+    plt.yticks(fontsize=10)
+    plt.savefig(filepath)
+    plt.close(fig)
+
+
+RENDERERS = {
+    "performance": _render_performance,
+    "species_summary": _render_species_summary,
+}
+
+
+def render(job_file) -> str:
+    """Render the image of a saved plot, returns its filepath."""
+    logger = logging.getLogger(__name__)
+    with np.load(job_file, allow_pickle=False) as data:
+        job = json.loads(str(data["job"]))
+        arrays = {name: data[name] for name in data.files if name != "job"}
+
+    logger.info(f"Plot {job['kind']}: {job['filepath']}")
+    RENDERERS[job["kind"]](arrays, job["meta"], job["filepath"])
+    return job["filepath"]
+
+
+def render_pending(directories, force=False) -> list:
+    """
+    Render the saved plots in directories whose image is missing or older than
+    the plot data.
+
+    Returns:
+        list: rendered images
+    """
+    rendered = []
+    for directory in dict.fromkeys(directories):
+        for job_file in sorted(glob.glob(os.path.join(directory, f"*{JOB_SUFFIX}"))):
+            image = job_file[: -len(JOB_SUFFIX)]
+            if (
+                force
+                or not os.path.exists(image)
+                or os.path.getmtime(image) < os.path.getmtime(job_file)
+            ):
+                rendered.append(render(job_file))
+    return rendered
+
+
+def image_directories(municipality=None) -> list:
+    """Image directories of a municipality and of the models it uses."""
+    municipality = municipality or load_parameters()["municipality"]
+    catalog = load_catalog()
+    directories = []
+    for name in (municipality, MODEL_MUNICIPALITY.get(municipality, municipality)):
+        extrapolation = catalog[f"{name}_extrapolation"]
+        directories.append(extrapolation["model"]["filepath_img"])
+        directories.append(
+            os.path.dirname(extrapolation["species_summary"]["img_path"])
+        )
+    return list(dict.fromkeys(directories))
+
+
+if __name__ == "__main__":
+    from src.config.logger import setup_logging
+
+    setup_logging()
+    logger = logging.getLogger(__name__)
+    for image in render_pending(image_directories()):
+        logger.info(f"Rendered {image}")
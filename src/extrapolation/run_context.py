@@ -0,0 +1,113 @@
+"""
+Run context of the extrapolation of one municipality.
+
+The context carries the municipality, the municipality whose models are used
+(Bærum uses the models trained on the Oslo reference trees), the catalog
+section and the parameters of the municipality and of the model families.
+The extrapolation steps (extrapolate_data.py) take it as an argument instead
+of reading the municipality from parameters.yaml, and pass its municipality on
+to the cleaning, regressor and export helpers.
+
+activate() also sets the municipality of load_parameters() in this process,
+so that several municipalities can be run side by side in separate processes
+(src/run_extrapolation.py).
+
+Example:
+--------
+ctx = RunContext("bodo").activate()
+df_ref, df_target = extrapolate_data.prepare_data(ctx=ctx)
+extrapolate_data.totben_cap(df_ref, df_target, ctx=ctx)
+"""
+
+import os
+
+from src.config.config import (
+    MODEL_FAMILIES,
+    MUNICIPALITY_ENV,
+    load_catalog,
+    load_parameters,
+)
+
+# municipalities that use the models (and reference trees) of another
+MODEL_MUNICIPALITY = {"baerum": "oslo"}
+
+
+class RunContext:
+    """
+    Municipality, catalog paths and model parameters of one extrapolation run.
+
+    Attributes:
+    -----------
+    municipality : str
+        municipality of the target trees
+    model_municipality : str
+        municipality of the reference trees and models (registry, file prefix)
+    catalog : dict
+        <municipality>_extrapolation section of catalog.yaml
+    ref_id, target_id, col_species : str
+        ID columns of the reference and target trees and the species column
+    model_params : dict
+        {model family: parameters}, see MODEL_FAMILIES
+
+    Methods:
+    --------
+    - activate(self)
+    - path(self, *keys)
+    - model_groups(self, family)
+    """
+
+    def __init__(self, municipality=None, parameters=None, catalog=None):
+        parameters = parameters or load_parameters()
+        catalog = catalog or load_catalog()
+
+        self.municipality = municipality or parameters["municipality"]
+        self.model_municipality = MODEL_MUNICIPALITY.get(
+            self.municipality, self.municipality
+        )
+        self.catalog = catalog[f"{self.municipality}_extrapolation"]
+
+        self.ref_id = parameters[self.model_municipality]["ref_id"]
+        self.target_id = parameters[self.municipality]["target_id"]
+        self.col_species = parameters[self.municipality]["col_species"]
+        self.model_params = {family: parameters[family] for family in MODEL_FAMILIES}
+
+    def __repr__(self):
+        return (
+            f"RunContext(municipality={self.municipality!r}, "
+            f"model_municipality={self.model_municipality!r})"
+        )
+
+    def activate(self):
+        """Use this municipality in load_parameters() of this process."""
+        os.environ[MUNICIPALITY_ENV] = self.municipality
+        return self
+
+    def path(self, *keys) -> str:
+        """Catalog entry of the municipality, e.g. path("output", "filepath_csv")."""
+        entry = self.catalog
+        for key in keys:
+            entry = entry[key]
+        return entry
+
+    def model_groups(self, family):
+        """
+        Responses of a model family, as modelled by its step: (responses of the
+        design matrix, [responses of each model]).
+        """
+        model_options = self.model_params[family]["model_options"]
+        response = model_options["response"]
+        if isinstance(response, str):
+            response = [response]
+        if family == "rf_total_cap":
+            return response, [response]
+
+        if family == "rf_individual_es" and self.model_municipality == "bodo":
+            response = [
+                y_var
+                for y_var in response
+                if y_var not in ["pollution_no2", "pollution_pm25", "pollution_so2"]
+            ]
+        multi_output = model_options.get("multi_output", False)
+        if multi_output and self.model_municipality != "kristiansand":
+            return response, [response]
+        return response, [[y_var] for y_var in response]
@@ -0,0 +1,111 @@
+"""
+Column types of the cleaned reference and target tables.
+
+The cleaned tables are cached as Parquet with explicit types, so that they are
+read back with the same dtypes and a fraction of the memory of the CSV files:
+
+- species names and origin strings: category
+- tree measurements (dbh, height, crown): float32
+- IDs and integer codes (cols_int in parameters.yaml): nullable Int64
+- other numeric columns (ecosystem service values): float64
+
+Example:
+--------
+write_table(df_ref, catalog["oslo_extrapolation"]["reference"]["filepath_parquet"])
+df_ref = read_table(catalog["oslo_extrapolation"]["reference"]["filepath_parquet"])
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.config.config import load_parameters
+
+CATEGORICAL_COLS = (
+    "norwegian_name",
+    "scientific_name",
+    "common_name",
+    "taxon_genus",
+    "species_origin",
+    "dbh_origin",
+    "height_origin",
+    "crown_origin",
+    "crown_diam_origin",
+    "geo_relation",
+)
+MEASUREMENT_COLS = (
+    "dbh",
+    "height_total_tree",
+    "crown_area",
+    "crown_diam",
+    "crown_peri",
+    "crown_vol",
+    "ratio_ca_eca",
+    "ratio_ca_cha",
+)
+ID_COLS = (
+    "tree_id",
+    "crown_id",
+    "crown_id_2014",
+    "crown_id_2021",
+    "school_id",
+    "teig_undervisning",
+    "delomradenummer",
+    "grunnkretsnummer",
+)
+
+
+def _to_nullable_int(series) -> pd.Series:
+    """Int64 if all values are integral numbers, else the series unchanged."""
+    numeric = pd.to_numeric(series, errors="coerce")
+    if numeric.notna().sum() != series.notna().sum():
+        return series  # e.g. string IDs
+    if not np.all(np.mod(numeric.dropna(), 1) == 0):
+        return series
+    return numeric.astype("Int64")
+
+
+def _to_category(series) -> pd.Series:
+    # mixed values (e.g. 1 and "estimated") as strings, missing values kept
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.where(series.isna(), series.astype(str))
+    return series.astype("category")
+
+
+def apply_schema(df) -> pd.DataFrame:
+    """Cast the columns of a cleaned reference or target table."""
+    cols_int = {col.lower() for col in load_parameters()["cols_int"]}
+    cols_int |= set(ID_COLS)
+
+    df = df.copy()
+    for col in df.columns:
+        name = col.lower()
+        if name in CATEGORICAL_COLS:
+            df[col] = _to_category(df[col])
+        elif name in MEASUREMENT_COLS:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(np.float32)
+        elif name in cols_int:
+            df[col] = _to_nullable_int(df[col])
+        elif df[col].dtype == object and df[col].isna().all():
+            # columns created empty (cols_ref/cols_target not in the data)
+            df[col] = df[col].astype(np.float64)
+    return df
+
+
+def write_table(df, filepath, row_group_size=None) -> pd.DataFrame:
+    """Apply the schema and write df to filepath (Parquet)."""
+    logger = logging.getLogger(__name__)
+    df = apply_schema(df)
+    os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+    df.to_parquet(filepath, index=False, row_group_size=row_group_size)
+
+    memory = df.memory_usage(deep=True).sum() / 1024**2
+    logger.info(f"Cached {df.shape} ({memory:.1f} MB in memory): {filepath}")
+    return df
+
+
+def read_table(filepath, columns=None) -> pd.DataFrame:
+    """Read a cleaned table, with the dtypes of write_table."""
+    return pd.read_parquet(filepath, columns=columns)
@@ -0,0 +1,204 @@
+"""
+Out-of-core prediction over the row groups of the target Parquet file.
+
+For large target sets (all crowns of a municipality) the target is not held
+in memory as a whole. Instead:
+
+1. column_medians() computes the median of the predictors with missing values
+   in one pass over the file (one column at a time, the Parquet statistics
+   tell which columns contain nulls).
+2. Each row group is read, imputed with these medians, its species column
+   encoded (design_matrix.encode) and predicted in a worker process (the
+   model is sent once per worker).
+3. The predictions (target ID and one column per response) are appended to a
+   Parquet output file row group by row group.
+
+The extrapolation does not load the target when streaming is enabled: the
+models are fitted on the reference (design_matrix.build without the target)
+and the target is only read here.
+
+Peak memory is a few row groups. The row group size of the target file is set
+in clean_target.export_target (parameters.yaml, prediction: row_group_size).
+
+Example:
+--------
+predict_parquet(
+    model, target_parquet, "oslo_totben_cap_predicted.parquet",
+    target_id="id", predictors=predictors, response=["totben_cap"], workers=4,
+)
+"""
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.config.config import load_parameters
+from src.extrapolation import design_matrix
+
+DEFAULT_ROW_GROUP_SIZE = 100_000
+DEFAULT_WORKERS = 1
+
+
+def config() -> dict:
+    """prediction section of parameters.yaml."""
+    return load_parameters().get("prediction", {}) or {}
+
+
+def is_enabled() -> bool:
+    return bool(config().get("streaming", False))
+
+
+def _has_nulls(parquet_file, column) -> bool:
+    """True if the column may contain nulls (unknown statistics count as True)."""
+    metadata = parquet_file.metadata
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            chunk = row_group.column(j)
+            if chunk.path_in_schema != column:
+                continue
+            stats = chunk.statistics
+            if stats is None or not stats.has_null_count or stats.null_count > 0:
+                return True
+    return False
+
+
+def column_medians(path, columns) -> pd.Series:
+    """
+    Median of the columns with missing values (as DataFrame.median()),
+    reading one column at a time.
+    """
+    parquet_file = pq.ParquetFile(path)
+    medians = {}
+    for column in columns:
+        if not _has_nulls(parquet_file, column):
+            continue
+        values = parquet_file.read(columns=[column]).column(0).to_pandas()
+        medians[column] = pd.to_numeric(values, errors="coerce").median()
+    return pd.Series(medians, dtype=np.float64)
+
+
+# worker state, set once per worker process by _init_worker
+_worker = {}
+
+
+def _init_worker(model, path, target_id, predictors, medians, col_species):
+    _worker.update(
+        model=model,
+        parquet_file=pq.ParquetFile(path),
+        target_id=target_id,
+        predictors=predictors,
+        medians=medians,
+        col_species=col_species,
+    )
+
+
+def _read_columns(predictors, col_species) -> List[str]:
+    """Columns of the target file needed to encode the predictors."""
+    columns = [col for col in predictors if not col.startswith("SP_")]
+    if col_species and len(columns) < len(predictors):
+        columns.append(col_species)
+    return columns
+
+
+def _predict_row_group(i) -> tuple:
+    """Target IDs and predictions (n_rows, n_responses) of row group i."""
+    predictors = _worker["predictors"]
+    columns = _read_columns(predictors, _worker["col_species"])
+    df = (
+        _worker["parquet_file"]
+        .read_row_group(i, columns=[_worker["target_id"], *columns])
+        .to_pandas()
+    )
+    X = design_matrix.encode(
+        df, predictors, _worker["col_species"], medians=_worker["medians"]
+    )
+    y = np.round(_worker["model"].predict(X), 2).reshape(len(df), -1)
+    return df[_worker["target_id"]].to_numpy(), y
+
+
+def predict_parquet(
+    model,
+    path,
+    output_path,
+    target_id,
+    predictors,
+    response: List[str],
+    medians=None,
+    workers=None,
+    col_species=None,
+) -> str:
+    """
+    Predict the responses of all rows in the target Parquet file.
+
+    Args:
+        model (obj): trained (multi-output) model or flat_forest.FlatForest
+            (memory mapped forests are opened by path in each worker),
+            predictors in column order
+        path (str): target Parquet file (clean_target.export_target)
+        output_path (str): Parquet file with target_id and response columns
+        target_id (str): ID column of the target
+        predictors (list): predictor columns (encoded, see design_matrix)
+        response (list): response columns, in the output order of the model
+        medians (Series): medians to fill missing values, computed from path
+            if None
+        workers (int): worker processes, defaults to parameters.yaml
+        col_species (str): species column of the encoded SP_ predictors
+            (design_matrix.encode)
+
+    Returns:
+        str: output_path
+    """
+    logger = logging.getLogger(__name__)
+    if workers is None:
+        workers = config().get("workers", DEFAULT_WORKERS)
+    if medians is None:
+        medians = column_medians(path, _read_columns(predictors, None))
+
+    n_row_groups = pq.ParquetFile(path).metadata.num_row_groups
+    logger.info(
+        f"Predict {response} over {n_row_groups} row groups with {workers} workers..."
+    )
+
+    id_type = pq.read_schema(path).field(target_id).type
+    schema = pa.schema(
+        [(target_id, id_type), *[(col, pa.float64()) for col in response]]
+    )
+
+    initargs = (model, path, target_id, list(predictors), medians, col_species)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tmp_path = f"{output_path}.tmp{os.getpid()}"
+    n_rows = 0
+
+    if workers <= 1 or n_row_groups == 1:
+        _init_worker(*initargs)
+        results = map(_predict_row_group, range(n_row_groups))
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=initargs
+        )
+        results = executor.map(_predict_row_group, range(n_row_groups))
+
+    writer = pq.ParquetWriter(tmp_path, schema)
+    try:
+        for ids, y in results:
+            arrays = [pa.array(ids, type=id_type)]
+            arrays += [pa.array(y[:, j]) for j in range(len(response))]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            n_rows += len(ids)
+    finally:
+        writer.close()
+        if executor is not None:
+            executor.shutdown()
+        _worker.clear()
+
+    os.replace(tmp_path, output_path)
+    logger.info(f"Predicted {n_rows} rows: {output_path}")
+    return output_path
@@ -0,0 +1,261 @@
+"""
+Summary statistics of the extrapolation results.
+
+The statistics of create_summary (export_results.py) are computed in one scan
+of the results table with DuckDB: a single query with GROUPING SETS for the
+municipality (all trees), the districts (grunnkretsnummer) and the school
+grounds (teig_undervisning = 1, Oslo only). The values are rounded to two
+decimals before aggregation, as the results table is rounded in pandas
+(numpy round half to even), so the CSV outputs are the same as those of the
+former pandas implementation. Without duckdb the statistics are computed with
+pandas.
+
+Trees without crown area are left out of the benefit per crown area
+(totben_cap_2023_ca) instead of dividing by zero.
+
+Example:
+--------
+df_summary, df_sum, df_schools = summaries.summarize(
+    input_file, CONTINUOUS_VARS, schools=municipality == "oslo"
+)
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:  # pandas fallback
+    duckdb = None
+
+CONTINUOUS_VARS = [
+    "dbh",
+    "height_total_tree",
+    "crown_area",
+    "co2_storage_kg",
+    "co2_seq_kg_yr",
+    "runoff_m3_yr",
+    "pollution_no2",
+    "pollution_pm25",
+    "pollution_so2",
+    "pollution_g_yr",
+    "co2_storage_nok_2023",
+    "co2_seq_nok_2023",
+    "runoff_nok_2023",
+    "pollution_nok_2023",
+    "totben_cap_2023",
+    "totben_cap_2023_ca",
+]
+# rows of the summary tables (DataFrame.describe, median and sum)
+STATS = ["count", "mean", "std", "min", "25%", "50%", "75%", "max", "median", "sum"]
+COL_DISTRICT = "grunnkretsnummer"
+COL_SCHOOL = "teig_undervisning"
+DECIMALS = 2
+
+# GROUPING(district, school) of the grouping sets
+_LEVEL_ALL, _LEVEL_DISTRICT, _LEVEL_SCHOOL = 3, 1, 2
+
+
+def _ratio_pandas(df):
+    # totben_cap_2023 / crown_area, NaN without crown area
+    return df["totben_cap_2023"] / df["crown_area"].where(df["crown_area"] != 0)
+
+
+def _describe(df, columns) -> pd.DataFrame:
+    df_summary = df[columns].describe()
+    df_summary.loc["median"] = df[columns].median()
+    df_summary.loc["sum"] = df[columns].sum()
+    return df_summary
+
+
+def _summarize_pandas(input_file, continuous_vars, schools):
+    from src.extrapolation.export_results import read_results
+
+    df = read_results(input_file)
+    df["totben_cap_2023_ca"] = _ratio_pandas(df)
+    df = df.round(DECIMALS)
+
+    df_summary = _describe(df, continuous_vars)
+    df_district = df.groupby([COL_DISTRICT]).sum()[continuous_vars]
+    df_schools = None
+    if schools:
+        df_schools = _describe(df[df[COL_SCHOOL] == 1], continuous_vars)
+    return df_summary, df_district, df_schools
+
+
+def _source(input_file) -> str:
+    path = str(input_file).replace("'", "''")
+    if path.endswith(".parquet"):
+        return f"read_parquet('{path}')"
+    return f"read_csv_auto('{path}')"
+
+
+def _round(expression) -> str:
+    # numpy round: rint(x * 10**decimals) / 10**decimals
+    scale = 10**DECIMALS
+    return f"round_even(CAST({expression} AS DOUBLE) * {scale}, 0) / {scale}"
+
+
+def _query(input_file, continuous_vars, schools) -> str:
+    columns = []
+    for col in continuous_vars:
+        if col == "totben_cap_2023_ca":
+            expression = (
+                'CASE WHEN "crown_area" <> 0 '
+                'THEN CAST("totben_cap_2023" AS DOUBLE) / "crown_area" END'
+            )
+        else:
+            expression = f'"{col}"'
+        columns.append(f'{_round(expression)} AS "{col}"')
+    school = f'"{COL_SCHOOL}" = 1' if schools else "CAST(NULL AS BOOLEAN)"
+
+    aggregates = []
+    for i, col in enumerate(continuous_vars):
+        aggregates += [
+            f'COUNT("{col}") AS c{i}_count',
+            f'FAVG("{col}") AS c{i}_mean',
+            f'STDDEV_SAMP("{col}") AS c{i}_std',
+            f'MIN("{col}") AS c{i}_min',
+            f'QUANTILE_CONT("{col}", [0.25, 0.5, 0.75]) AS c{i}_quartiles',
+            f'MAX("{col}") AS c{i}_max',
+            f'COALESCE(FSUM("{col}"), 0) AS c{i}_sum',
+        ]
+
+    newline = ",\n            "
+    return f"""
+        WITH results AS (
+            SELECT
+            {newline.join(columns)},
+            "{COL_DISTRICT}" AS district,
+            {school} AS school
+            FROM {_source(input_file)}
+        )
+        SELECT
+            GROUPING(district, school) AS level,
+            district,
+            school,
+            {newline.join(aggregates)}
+        FROM results
+        GROUP BY GROUPING SETS ((), (district), (school))
+        ORDER BY level, district
+    """
+
+
+def _stats(row, continuous_vars) -> pd.DataFrame:
+    """Summary table (STATS x continuous_vars) of one row of the query."""
+    values = {}
+    for i, col in enumerate(continuous_vars):
+        quartiles = row[f"c{i}_quartiles"]
+        if not isinstance(quartiles, (list, np.ndarray)):
+            quartiles = [np.nan] * 3  # no values
+        values[col] = [
+            row[f"c{i}_count"],
+            row[f"c{i}_mean"],
+            row[f"c{i}_std"],
+            row[f"c{i}_min"],
+            *quartiles,
+            row[f"c{i}_max"],
+            quartiles[1],
+            row[f"c{i}_sum"],
+        ]
+    df = pd.DataFrame(values, index=STATS, columns=continuous_vars)
+    return df.apply(pd.to_numeric, errors="coerce").astype(np.float64)
+
+
+def _empty_stats(continuous_vars) -> pd.DataFrame:
+    # DataFrame.describe of no rows: count and sum 0
+    df = pd.DataFrame(np.nan, index=STATS, columns=continuous_vars)
+    df.loc[["count", "sum"]] = 0.0
+    return df
+
+
+def _district_dtype(input_file, has_null):
+    """dtype of the district column as read by pandas (read_results)."""
+    import pyarrow.parquet as pq
+
+    if str(input_file).endswith(".parquet"):
+        schema = pq.read_schema(input_file)
+        dtype = schema.empty_table().to_pandas()[COL_DISTRICT].dtype
+        if has_null and pd.api.types.is_integer_dtype(dtype):
+            # numpy integers with missing values are read as float
+            dtype = dtype if pd.api.types.is_extension_array_dtype(dtype) else "float64"
+        return dtype
+    return pd.read_csv(input_file, usecols=[COL_DISTRICT])[COL_DISTRICT].dtype
+
+
+def _summarize_duckdb(input_file, continuous_vars, schools):
+    with duckdb.connect() as con:
+        df = con.execute(_query(input_file, continuous_vars, schools)).df()
+
+    df_all = df[df["level"] == _LEVEL_ALL]
+    df_summary = _stats(df_all.iloc[0], continuous_vars)
+
+    # districts as DataFrame.groupby(COL_DISTRICT).sum(): without missing keys
+    df_district = df[df["level"] == _LEVEL_DISTRICT]
+    has_null = df_district["district"].isna().any()
+    df_district = df_district[df_district["district"].notna()]
+    sums = [f"c{i}_sum" for i in range(len(continuous_vars))]
+    df_district = pd.DataFrame(
+        df_district[sums].to_numpy(dtype=np.float64),
+        index=pd.Index(
+            df_district["district"].astype(_district_dtype(input_file, has_null)),
+            name=COL_DISTRICT,
+        ),
+        columns=continuous_vars,
+    )
+
+    df_schools = None
+    if schools:
+        df_school = df[(df["level"] == _LEVEL_SCHOOL) & (df["school"] == True)]  # noqa
+        if df_school.empty:
+            df_schools = _empty_stats(continuous_vars)
+        else:
+            df_schools = _stats(df_school.iloc[0], continuous_vars)
+    return df_summary, df_district, df_schools
+
+
+def _check_columns(input_file, continuous_vars, schools):
+    import pyarrow.parquet as pq
+
+    if str(input_file).endswith(".parquet"):
+        names = pq.read_schema(input_file).names
+    else:
+        names = pd.read_csv(input_file, nrows=0).columns
+    required = [col for col in continuous_vars if col != "totben_cap_2023_ca"]
+    required += ["totben_cap_2023", "crown_area", COL_DISTRICT]
+    if schools:
+        required.append(COL_SCHOOL)
+    missing = [col for col in dict.fromkeys(required) if col not in names]
+    if missing:
+        raise ValueError(f"Columns {missing} not in results table {input_file}")
+
+
+def summarize(input_file, continuous_vars=None, schools=False, engine=None):
+    """
+    Summary statistics of the results table.
+
+    Args:
+        input_file (str): results table (parquet or csv)
+        continuous_vars (list): columns to summarize, defaults to CONTINUOUS_VARS
+        schools (bool): also summarize the school grounds (Oslo)
+        engine (str): "duckdb" or "pandas", defaults to duckdb if installed
+
+    Returns:
+        tuple: (summary of all trees, sums per district, summary of the school
+        grounds or None); the summaries have the rows STATS
+    """
+    logger = logging.getLogger(__name__)
+    continuous_vars = list(continuous_vars or CONTINUOUS_VARS)
+    engine = engine or ("duckdb" if duckdb is not None else "pandas")
+    if engine not in ("duckdb", "pandas"):
+        raise ValueError(f"engine must be duckdb or pandas, not <{engine}>")
+    if engine == "duckdb" and duckdb is None:
+        raise ValueError("engine duckdb requires the duckdb package")
+
+    _check_columns(input_file, continuous_vars, schools)
+    logger.info(f"Summarize {input_file} ({engine})")
+    if engine == "duckdb":
+        return _summarize_duckdb(input_file, continuous_vars, schools)
+    return _summarize_pandas(input_file, continuous_vars, schools)
@@ -17,6 +17,8 @@ from src.attributes.geo_relation_rule_attributes import RuleAttributes
 
 # from src import ADMIN_GDB, INTERIM_PATH, MUNICIPALITY, SPATIAL_REFERENCE, RuleAttributes
 from src.utils import arcpy_utils as au
+from src.utils import metrics, profiler
+from src.utils.scratch import ScratchWorkspace
 
 
 def buffer_per_nb(
@@ -33,7 +35,9 @@ def buffer_per_nb(
     logger.info("Processing")
 
     # Detect trees per neighbourhood
-    for n_code in neighbourhood_list:
+    n_total = len(neighbourhood_list)
+    neighbourhoods = profiler.iterate(neighbourhood_list, "buffer_per_nb", "n_code")
+    for n_code in metrics.track(neighbourhoods, "buffer_per_nb", n_total):
         logger.info("-------------------------------------------------------------")
         logger.info("CASE 3: BUFFER TREE STEMS FOR NEIGHBOURHOOD <<{}>>".format(n_code))
         logger.info("-------------------------------------------------------------")
@@ -52,11 +56,6 @@ def buffer_per_nb(
             interim_path, "input_crowns.gdb", "b_" + n_code + "_kroner"
         )
 
-        # temp
-        v_buffer = os.path.join(filegdb_path, "tmp_c3_buffer")
-        v_erase = os.path.join(filegdb_path, "tmp_c3_erase_ALScrown")
-        v_dissolve = os.path.join(filegdb_path, "tmp_c3_dissolve")
-
         # output
         out_name = "crowns_c3_modelled"
         v_crowns_c3_modelled = os.path.join(filegdb_path, out_name)
@@ -83,18 +82,24 @@ def buffer_per_nb(
         else:
             buffer_distance_attr_field = "crown_radius"
 
-        arcpy.Buffer_analysis(
-            v_stems_c3, v_buffer, buffer_distance_attr_field, "", "", "ALL"
-        )
+        # temporary files are deleted when the scratch workspace is closed
+        with ScratchWorkspace(filegdb_path) as scratch:
+            v_buffer = scratch.path("tmp_c3_buffer")
+            v_erase = scratch.path("tmp_c3_erase_ALScrown")
+            v_dissolve = scratch.path("tmp_c3_dissolve")
 
-        # subtract ALS crowns from buffer
-        arcpy.Erase_analysis(v_buffer, v_crowns_raw, v_erase)
+            arcpy.Buffer_analysis(
+                v_stems_c3, v_buffer, buffer_distance_attr_field, "", "", "ALL"
+            )
 
-        # dissolve
-        arcpy.Dissolve_management(v_erase, v_dissolve)
+            # subtract ALS crowns from buffer
+            arcpy.Erase_analysis(v_buffer, v_crowns_raw, v_erase)
 
-        # Convert to singlepart (Buffer tool creates one multipolygon object)
-        arcpy.MultipartToSinglepart_management(v_dissolve, v_crowns_c3_modelled)
+            # dissolve
+            arcpy.Dissolve_management(v_erase, v_dissolve)
+
+            # Convert to singlepart (Buffer tool creates one multipolygon object)
+            arcpy.MultipartToSinglepart_management(v_dissolve, v_crowns_c3_modelled)
 
         # add fields to the new feature class
         au.addField_ifNotExists(v_crowns_c3_modelled, "geo_relation", "TEXT")
@@ -106,11 +111,6 @@ def buffer_per_nb(
             v_crowns_c3_modelled, "bydelnummer", str(n_code), "PYTHON_9.3"
         )
 
-        # delete temporary files
-        files = [v_buffer, v_erase, v_dissolve]
-        for file in files:
-            arcpy.Delete_management(file)
-
 
 # check if can be deleted
 def buffer_study_area(filegdb_path, v_crowns_all, spatial_reference, municipality):
@@ -125,12 +125,6 @@ def buffer_study_area(filegdb_path, v_crowns_all, spatial_reference, municipalit
     # input
     v_stems_c3 = os.path.join(filegdb_path, "stems_c3")
 
-    # temp
-    v_buffer = os.path.join(filegdb_path, "tmp_c3_buffer")
-    v_erase = os.path.join(filegdb_path, "tmp_c3_erase_ALScrown")
-    v_dissolve = os.path.join(filegdb_path, "tmp_c3_dissolve")
-    v_singlepart = os.path.join(filegdb_path, "tmp_c3_singlepart")
-
     # output
     out_name = "crowns_c3_modelled"
     v_crowns_c3_modelled = os.path.join(filegdb_path, out_name)
@@ -155,28 +149,29 @@ def buffer_study_area(filegdb_path, v_crowns_all, spatial_reference, municipalit
     else:
         buffer_distance_attr_field = "crown_radius"
 
-    arcpy.Buffer_analysis(
-        v_stems_c3, v_buffer, buffer_distance_attr_field, "", "", "ALL"
-    )
+    # temporary files are deleted when the scratch workspace is closed
+    with ScratchWorkspace(filegdb_path) as scratch:
+        v_buffer = scratch.path("tmp_c3_buffer")
+        v_erase = scratch.path("tmp_c3_erase_ALScrown")
+        v_dissolve = scratch.path("tmp_c3_dissolve")
 
-    # subtract ALS crowns from buffer
-    arcpy.Erase_analysis(v_buffer, v_crowns_all, v_erase)
+        arcpy.Buffer_analysis(
+            v_stems_c3, v_buffer, buffer_distance_attr_field, "", "", "ALL"
+        )
 
-    # dissolve
-    arcpy.Dissolve_management(v_erase, v_dissolve)
+        # subtract ALS crowns from buffer
+        arcpy.Erase_analysis(v_buffer, v_crowns_all, v_erase)
 
-    # Convert to singlepart (Buffer tool creates one multipolygon object)
-    arcpy.MultipartToSinglepart_management(v_dissolve, v_crowns_c3_modelled)
+        # dissolve
+        arcpy.Dissolve_management(v_erase, v_dissolve)
+
+        # Convert to singlepart (Buffer tool creates one multipolygon object)
+        arcpy.MultipartToSinglepart_management(v_dissolve, v_crowns_c3_modelled)
 
     # add fields to the new feature class
     au.addField_ifNotExists(v_crowns_c3_modelled, "geo_relation", "TEXT")
     au.calculateField_ifEmpty(v_crowns_c3_modelled, "geo_relation", "'Case 3'")
 
-    # delete temporary files
-    files = [v_buffer, v_erase, v_dissolve, v_singlepart]
-    for file in files:
-        arcpy.Delete_management(file)
-
 
 if __name__ == "__main__":
     pass
@@ -17,6 +17,7 @@ from arcpy import env
 
 from src.attributes.geo_relation_rule_attributes import RuleAttributes
 from src.utils import arcpy_utils as au
+from src.utils import metrics, profiler
 
 # ------------------------------------------------------ #
 # Functions
@@ -333,7 +334,9 @@ def classify_per_nb(
     logger.info("Processing")
 
     # Detect trees per neighbourhood
-    for n_code in neighbourhood_list:
+    n_total = len(neighbourhood_list)
+    neighbourhoods = profiler.iterate(neighbourhood_list, "classify_per_nb", "n_code")
+    for n_code in metrics.track(neighbourhoods, "classify_per_nb", n_total):
         logger.info("-------------------------------------------------------------")
         logger.info(
             "CLASSIFYING THE GEO RELATION FOR NEIGHBOURHOOD <<{}>>".format(n_code)
@@ -7,6 +7,7 @@ from arcpy import env
 # local packages
 # from src import ADMIN_GDB, INTERIM_PATH, MUNICIPALITY, SPATIAL_REFERENCE
 from src.utils import arcpy_utils as au
+from src.utils import metrics, profiler
 
 
 def merge_per_nb(neighbourhood_list, gdb_stems, spatial_reference, round):
@@ -17,7 +18,9 @@ def merge_per_nb(neighbourhood_list, gdb_stems, spatial_reference, round):
     interim_path = Path(gdb_stems).parent
 
     # Detect trees per neighbourhood
-    for n_code in neighbourhood_list:
+    n_total = len(neighbourhood_list)
+    neighbourhoods = profiler.iterate(neighbourhood_list, "merge_per_nb", "n_code")
+    for n_code in metrics.track(neighbourhoods, "merge_per_nb", n_total):
         logger.info("-------------------------------------------------------------")
         logger.info("MERGE CASES PER NEIGHBOURHOOD <<{}>>".format(n_code))
         logger.info("-------------------------------------------------------------")
@@ -18,16 +18,21 @@ from src.integration import case_3_model_crown as model_crown
 from src.integration import classify_geo_relation as cgr
 from src.integration import merge_trees
 from src.utils import arcpy_utils as au
+from src.utils import gp_stats, profiler
 
 
 @dec.timer
-def join_data(round):
+def join_data(round, confirm=True, overwrite=False):
     """_summary_
 
     Parameters
     ----------
     round : int
         Round 1 (process per neighbourhood) or Round 2 (process whole study area)
+    confirm : bool
+        ask the user to confirm the municipality before round 1
+    overwrite : bool
+        recompute outputs that already exist (set by the pipeline runner)
     """
     # load catalog
 
@@ -62,7 +67,7 @@ def join_data(round):
     gdb_crowns_round_2 = catalog["geo_relation_round_2"]["filepath"]
 
     # confirm municipality
-    if round == 1:
+    if round == 1 and confirm:
         confirm_municipality = (
             input(f"Is '{municipality}' the correct municipality? (y/n): ")
             .strip()
@@ -98,6 +103,7 @@ def join_data(round):
             spatial_reference,
             round,
             fc_area_extent,
+            overwrite=overwrite,
         )
 
         # 3. MODEL use a buffer based on in-situ radius to model "CASE 3" crowns
@@ -130,6 +136,7 @@ def join_data(round):
             fc_interim_input_stems,
             spatial_reference,
             fc_area_extent,
+            overwrite=overwrite,
         )
 
         # 3. MODEL use a buffer based on in-situ radius to model "CASE 3" crowns
@@ -304,6 +311,8 @@ if __name__ == "__main__":
 
     # set up logger
     setup_logging()
+    profiler.enable_from_config()
+    gp_stats.instrument_from_config()
     logger = logging.getLogger(__name__)
 
     if quality_check():
@@ -15,10 +15,11 @@ from src.config.config import load_catalog, load_parameters
 from src.config.logger import setup_logging
 from src.data import clean, load
 from src.utils import arcpy_utils as au
+from src.utils import gp_stats, profiler
 
 
 @dec.timer
-def prepare_data():
+def prepare_data(confirm=True):
     # load catalog
 
     logger = logging.getLogger(__name__)
@@ -49,12 +50,15 @@ def prepare_data():
     ]  # [field names]
 
     # confirm municipality
-    confirm_municipality = (
-        input(f"Is '{municipality}' the correct municipality? (y/n): ").strip().lower()
-    )
-    if confirm_municipality != "y":
-        logger.info("User disagreed with the municipality.")
-        exit()
+    if confirm:
+        confirm_municipality = (
+            input(f"Is '{municipality}' the correct municipality? (y/n): ")
+            .strip()
+            .lower()
+        )
+        if confirm_municipality != "y":
+            logger.info("User disagreed with the municipality.")
+            exit()
 
     # get nb list
     ls_neighbourhood = au.get_neighbourhood_list(fc_neighbourhood, key_neighbourhood)
@@ -106,6 +110,8 @@ if __name__ == "__main__":
 
     # set up logger
     setup_logging()
+    profiler.enable_from_config()
+    gp_stats.instrument_from_config()
 
     # run script
     prepare_data()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------- #
+# Name: run_extrapolation.py
+# Description: Extrapolate several municipalities concurrently
+# Dependencies: pandas, scikit-learn (no arcpy)
+# --------------------------------------------------------------------------- #
+"""
+Runs the extrapolation (prepare_data, totben_cap, individual_es, carbon_es and
+export, see extrapolate_data.run) of several municipalities at the same time,
+one process per municipality. Each process activates the RunContext of its
+municipality, the municipality in parameters.yaml is not used.
+
+Municipalities that use the models of another municipality (Bærum uses the
+Oslo models, run_context.MODEL_MUNICIPALITY) start when that municipality is
+done, so they load the trained models from the shared registry instead of
+training them a second time (they are run without overwrite).
+
+Usage:
+    python -m src.run_extrapolation oslo baerum bodo kristiansand
+    python -m src.run_extrapolation oslo baerum --workers 2 --overwrite
+"""
+
+import argparse
+import logging
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List
+
+from src.config.logger import setup_logging
+from src.extrapolation.run_context import MODEL_MUNICIPALITY, RunContext
+
+
+def _run_municipality(municipality, overwrite=False) -> str:
+    """Worker process: extrapolate one municipality."""
+    from src import extrapolate_data
+
+    setup_logging()
+    ctx = RunContext(municipality).activate()
+    return extrapolate_data.run(ctx, overwrite=overwrite)
+
+
+def run(municipalities: List[str], workers=None, overwrite=False) -> Dict:
+    """
+    Extrapolate the municipalities in separate processes.
+
+    Args:
+        municipalities (list): e.g. ["oslo", "baerum", "bodo", "kristiansand"]
+        workers (int): number of processes, defaults to one per municipality
+        overwrite (bool): recreate cleaned data and retrain models, not used
+            for municipalities that use the models of another municipality
+
+    Returns:
+        dict: {municipality: "done" | "failed" | "skipped"}
+    """
+    logger = logging.getLogger(__name__)
+    pending = list(dict.fromkeys(municipalities))
+    running = {}
+    status = {}
+
+    def _ready(municipality):
+        # waits for the municipality of its models, if that is run as well
+        dependency = MODEL_MUNICIPALITY.get(municipality)
+        return dependency not in pending and dependency not in running.values()
+
+    with ProcessPoolExecutor(max_workers=workers or len(pending)) as executor:
+        while pending or running:
+            for municipality in [m for m in pending if _ready(m)]:
+                dependency = MODEL_MUNICIPALITY.get(municipality)
+                pending.remove(municipality)
+                if status.get(dependency) in ("failed", "skipped"):
+                    logger.error(f"Skip {municipality}: {dependency} failed.")
+                    status[municipality] = "skipped"
+                    continue
+                logger.info(f"Start extrapolation of {municipality}...")
+                # models of the dependency were (re)trained in this run
+                future = executor.submit(
+                    _run_municipality,
+                    municipality,
+                    overwrite and dependency is None,
+                )
+                running[future] = municipality
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                municipality = running.pop(future)
+                try:
+                    future.result()
+                    status[municipality] = "done"
+                    logger.info(f"Extrapolation of {municipality} done.")
+                except Exception:
+                    status[municipality] = "failed"
+                    logger.exception(f"Extrapolation of {municipality} failed.")
+
+    return status
+
+
+if __name__ == "__main__":
+    setup_logging()
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser(
+        description="Extrapolate several municipalities concurrently."
+    )
+    parser.add_argument("municipalities", nargs="+", help="municipalities to run")
+    parser.add_argument("--workers", type=int, default=None, help="processes")
+    parser.add_argument(
+        "--overwrite", action="store_true", help="recreate data and retrain models"
+    )
+    args = parser.parse_args()
+
+    for municipality, result in run(
+        args.municipalities, workers=args.workers, overwrite=args.overwrite
+    ).items():
+        logger.info(f"{municipality:<15} {result}")
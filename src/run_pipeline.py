@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------- #
+# Name: run_pipeline.py
+# Description: Run the pipeline stages that are out of date
+# Dependencies: ArcGIS Pro 3.0+, Spatial Analyst
+# --------------------------------------------------------------------------- #
+"""
+Declares the inputs, outputs and parameters of the pipeline stages and runs
+only the stages whose inputs, parameters or outputs changed since the last run
+(see src/utils/dag.py).
+
+Usage:
+    python -m src.run_pipeline                      # all stages
+    python -m src.run_pipeline extrapolate_summary  # a stage and its upstream
+    python -m src.run_pipeline --status             # report stale stages
+    python -m src.run_pipeline --force              # rerun everything
+
+Stages are run with overwrite=True, the existence checks inside the stage
+functions are only used when the entry points are run separately.
+"""
+
+import argparse
+import logging
+import os
+
+from src.config.config import load_catalog, load_parameters
+from src.config.logger import setup_logging
+from src.utils import gp_stats, profiler
+from src.utils.dag import Pipeline, Stage
+
+
+# --------------------------------------------------------------------------- #
+# Stage functions (imports are deferred, not all stages need arcpy)
+# --------------------------------------------------------------------------- #
+def _prepare_data(overwrite=True):
+    from src.prepare_data import prepare_data
+
+    prepare_data(confirm=False)
+
+
+def _join_round_1(overwrite=True):
+    from src.join_data import join_data
+
+    join_data(round=1, confirm=False, overwrite=overwrite)
+
+
+def _join_round_2(overwrite=True):
+    from src.join_data import join_data, merge_data
+
+    join_data(round=2, confirm=False, overwrite=overwrite)
+    merge_data()
+
+
+def _copy_output(overwrite=True):
+    from src.join_data import copy_output
+
+    copy_output()
+
+
+def _attr_neighbourhood(overwrite=True):
+    from src.attributes.overlay.nodes import neighbourhood_stem
+
+    catalog = load_catalog()
+    input_gdb = catalog["attr_input"]["filepath"]
+    neighbourhood_stem(
+        v_stem_path=os.path.join(input_gdb, catalog["attr_input"]["fc"][2]),
+        v_crown_path=os.path.join(input_gdb, catalog["attr_input"]["fc"][0]),
+        filegdb_path=catalog["attr_overlay"]["filepath"],
+        v_neighbourhoods=catalog["neighbourhood"]["filepath"],
+        overwrite=overwrite,
+    )
+
+
+def _clean_data(overwrite=True):
+    from src import extrapolate_data
+
+    extrapolate_data.prepare_data(overwrite=overwrite)
+
+
+def _model_stage(step):
+    def run(overwrite=True):
+        from src import extrapolate_data
+
+        df_ref, df_target = extrapolate_data.prepare_data()
+        getattr(extrapolate_data, step)(df_ref, df_target, overwrite=overwrite)
+
+    return run
+
+
+def _export(overwrite=True):
+    from src import extrapolate_data
+
+    extrapolate_data.export()
+
+
+def _summary(overwrite=True):
+    from src import extrapolate_data
+
+    extrapolate_data.summary_stat()
+
+
+def _bootstrap(overwrite=True):
+    from src import extrapolate_data
+
+    df_ref, df_target = extrapolate_data.prepare_data()
+    extrapolate_data.bootstrap_ci(df_ref, df_target)
+
+
+def _report(overwrite=True):
+    from src.extrapolation import reporting
+
+    reporting.render_pending(reporting.image_directories(), force=overwrite)
+
+
+# --------------------------------------------------------------------------- #
+# Stage declarations
+# --------------------------------------------------------------------------- #
+def _model_outputs(catalog, parameters, model_key):
+    """Model pickles and predictions written by a model stage."""
+    municipality = parameters["municipality"]
+    # baerum is extrapolated with the models trained on oslo
+    model_municipality = "oslo" if municipality == "baerum" else municipality
+
+    response = parameters[model_key]["model_options"]["response"]
+    if isinstance(response, str):
+        response = [response]
+    # totben_cap is modelled as one multi-column response
+    responses = [response] if model_key == "rf_total_cap" else [[y] for y in response]
+    # one model for all responses
+    multi_output = parameters[model_key]["model_options"].get("multi_output", False)
+    multi_output = multi_output and model_key != "rf_total_cap"
+    multi_output = multi_output and model_municipality != "kristiansand"
+
+    model_dir = catalog[f"{model_municipality}_extrapolation"]["model"][
+        "filepath_pickle"
+    ]
+    output_dir = catalog[f"{municipality}_extrapolation"]["output"]["filepath_csv"]
+
+    # predictions of a model (ID + response columns), see regressor.predict
+    outputs = []
+    if multi_output:
+        prefix = f"{model_municipality}_{' '.join(response)}"
+        outputs.append(os.path.join(model_dir, f"{prefix}_model.pkl"))
+        outputs.append(os.path.join(output_dir, f"{prefix}_predicted.parquet"))
+    else:
+        for y_var in responses:
+            prefix = f"{model_municipality}_{' '.join(y_var)}"
+            outputs.append(os.path.join(model_dir, f"{prefix}_model.pkl"))
+            outputs.append(os.path.join(output_dir, f"{prefix}_predicted.parquet"))
+    return outputs
+
+
+def build_pipeline(logger=None) -> Pipeline:
+    """Declare the pipeline stages for the municipality in parameters.yaml."""
+    catalog = load_catalog()
+    parameters = load_parameters()
+    municipality = parameters["municipality"]
+
+    pipeline = Pipeline(catalog["pipeline_cache"]["filepath"], logger=logger)
+    stage_kwargs = {"overwrite": True}
+
+    # --- i-Tree Eco data preparation ---
+    gdb_stems = catalog["interim_input_stems"]["filepath"]
+    gdb_crowns = catalog["interim_input_crowns"]["filepath"]
+    gdb_round_1 = catalog["geo_relation_round_1"]["filepath"]
+    gdb_round_2 = catalog["geo_relation_round_2"]["filepath"]
+    gdb_geo_relation = catalog["geo_relation"]["filepath"]
+
+    pipeline.add(
+        Stage(
+            "prepare_data",
+            _prepare_data,
+            inputs=[
+                catalog["raw_in_situ_trees"]["filepath"],
+                catalog["raw_laser_trekroner"]["filepath"],
+                catalog["lookup_fields"]["filepath"],
+                catalog["lookup_species"]["filepath"],
+                catalog["neighbourhood"]["filepath"],
+            ],
+            outputs=[gdb_stems, gdb_crowns],
+            params={
+                "municipality": municipality,
+                "fields": catalog["raw_in_situ_trees"]["fields"][municipality],
+            },
+            kwargs=stage_kwargs,
+        )
+    )
+    pipeline.add(
+        Stage(
+            "join_round_1",
+            _join_round_1,
+            inputs=[catalog["admin"]["filepath"]],
+            outputs=[gdb_round_1],
+            params={
+                "municipality": municipality,
+                "spatial_reference": parameters["spatial_reference"][municipality],
+            },
+            deps=["prepare_data"],
+            kwargs=stage_kwargs,
+        )
+    )
+    pipeline.add(
+        Stage(
+            "join_round_2",
+            _join_round_2,
+            outputs=[gdb_round_2],
+            params={
+                "municipality": municipality,
+                "spatial_reference": parameters["spatial_reference"][municipality],
+            },
+            deps=["join_round_1"],
+            kwargs=stage_kwargs,
+        )
+    )
+    pipeline.add(
+        Stage(
+            "copy_output",
+            _copy_output,
+            outputs=[gdb_geo_relation],
+            deps=["join_round_2"],
+            kwargs=stage_kwargs,
+        )
+    )
+
+    # --- attributes ---
+    # attr_input is prepared manually from geo_relation.gdb and edited in place
+    # (nb_code, nb_name), hence it is declared as an output.
+    # Only neighbourhood_stem is a stage. crown_polygon_attributes and the
+    # other steps of itree_point_attributes (overlay, tree attributes,
+    # distance to building, CLE) are not: compute_attributes.py does not
+    # import (src.attributes.overlay_attributes, attribute classes not
+    # exported), its auxiliary inputs are not in catalog.yaml yet and it has
+    # manual steps (pollution zone, joins). Run them from compute_attributes.
+    pipeline.add(
+        Stage(
+            "attr_neighbourhood",
+            _attr_neighbourhood,
+            inputs=[catalog["neighbourhood"]["filepath"]],
+            outputs=[
+                catalog["attr_overlay"]["filepath"],
+                catalog["attr_input"]["filepath"],
+            ],
+            kwargs=stage_kwargs,
+        )
+    )
+
+    # --- extrapolation ---
+    extrapolation = catalog[f"{municipality}_extrapolation"]
+    output_dir = extrapolation["output"]["filepath_csv"]
+    ref_municipality = "oslo" if municipality == "baerum" else municipality
+    col_params = parameters[municipality]
+
+    pipeline.add(
+        Stage(
+            "extrapolate_clean_data",
+            _clean_data,
+            inputs=[
+                extrapolation["raw_trees"]["filepath_csv"],
+                extrapolation["raw_trees"]["filepath_parquet"],
+                extrapolation["raw_crowns"]["filepath_csv"],
+                extrapolation["raw_crowns"]["filepath_parquet"],
+            ],
+            outputs=[
+                extrapolation["reference"]["filepath_csv"],
+                extrapolation["reference"]["filepath_parquet"],
+                extrapolation["species_summary"]["filepath"],
+                extrapolation["target"]["filepath_csv"],
+                extrapolation["target"]["filepath_parquet"],
+            ],
+            params={
+                "municipality": municipality,
+                "ref_id": parameters[ref_municipality]["ref_id"],
+                "target_id": col_params["target_id"],
+                "col_species": col_params["col_species"],
+                "cols_ref": parameters[ref_municipality].get("cols_ref"),
+                "cols_target": col_params.get("cols_target"),
+                "cols_int": parameters["cols_int"],
+                "cols_float": parameters["cols_float"],
+            },
+            kwargs=stage_kwargs,
+        )
+    )
+
+    model_stages = {
+        "extrapolate_totben_cap": ("totben_cap", "rf_total_cap"),
+        "extrapolate_individual_es": ("individual_es", "rf_individual_es"),
+        "extrapolate_carbon_es": ("carbon_es", "rf_carbon_es"),
+    }
+    for name, (step, model_key) in model_stages.items():
+        pipeline.add(
+            Stage(
+                name,
+                _model_stage(step),
+                outputs=_model_outputs(catalog, parameters, model_key),
+                params={
+                    "municipality": municipality,
+                    model_key: parameters[model_key],
+                },
+                deps=["extrapolate_clean_data"],
+                kwargs=stage_kwargs,
+            )
+        )
+
+    # diagnostic plots saved by the stages above (reporting: plots)
+    pipeline.add(
+        Stage(
+            "extrapolate_report",
+            _report,
+            params={"reporting": parameters.get("reporting")},
+            deps=["extrapolate_clean_data", *model_stages],
+            kwargs=stage_kwargs,
+        )
+    )
+    pipeline.add(
+        Stage(
+            "extrapolate_export",
+            _export,
+            outputs=[
+                os.path.join(output_dir, f"{municipality}_extrapolation_results.{ext}")
+                for ext in ("parquet", "csv")
+            ],
+            deps=list(model_stages),
+            kwargs=stage_kwargs,
+        )
+    )
+    pipeline.add(
+        Stage(
+            "extrapolate_summary",
+            _summary,
+            outputs=[
+                os.path.join(output_dir, f"{municipality}_summary_ES.csv"),
+                os.path.join(output_dir, f"{municipality}_sum_ES_per_district.csv"),
+            ],
+            deps=["extrapolate_export"],
+            kwargs=stage_kwargs,
+        )
+    )
+    if (parameters.get("bootstrap") or {}).get("enabled", False):
+        # confidence intervals of the district totals
+        pipeline.add(
+            Stage(
+                "extrapolate_bootstrap",
+                _bootstrap,
+                outputs=[
+                    os.path.join(output_dir, f"{municipality}_ci_ES_per_district.csv")
+                ],
+                params={"bootstrap": parameters["bootstrap"]},
+                deps=list(model_stages),
+                kwargs=stage_kwargs,
+            )
+        )
+    return pipeline
+
+
+if __name__ == "__main__":
+    setup_logging()
+    profiler.enable_from_config()
+    gp_stats.instrument_from_config()
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser(description="Run stale pipeline stages.")
+    parser.add_argument("targets", nargs="*", help="stages to bring up to date")
+    parser.add_argument("--status", action="store_true", help="only report status")
+    parser.add_argument("--force", action="store_true", help="rerun all stages")
+    args = parser.parse_args()
+
+    pipeline = build_pipeline(logger=logger)
+    if args.status:
+        for stage, status in pipeline.status(args.targets or None).items():
+            logger.info(f"{stage:<30} {status}")
+    else:
+        pipeline.run(args.targets or None, force=args.force)
+
+# --------------------------------------------------------------------------- #
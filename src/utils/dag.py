@@ -0,0 +1,352 @@
+"""
+Content-addressed artifact cache and DAG runner for the pipeline stages.
+
+Each stage declares the paths it reads (inputs), the paths it writes (outputs),
+the parameters that influence its result and the stages it depends on. The
+stage key is a hash of the input content, the parameters and the outputs of
+the upstream stages. A stage only reruns if its key changed or if its outputs are
+missing or were modified after the last run.
+
+Feature classes and tables in a file geodatabase are fingerprinted with arcpy
+(Describe signature and row count), not by the files of the geodatabase, so a
+stage is not rerun when another feature class of the same geodatabase changes.
+
+File outputs (csv, parquet, pkl, json, ...) are copied to
+<cache_dir>/objects/<key>/ so that switching back to a previous input state
+restores the outputs instead of recomputing them.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Callable, Dict, List
+
+from src.utils import profiler
+
+# file geodatabases are too large to hash byte by byte on every run,
+# directories are fingerprinted using (relative path, size, mtime) per file
+CHUNK_SIZE = 1024 * 1024
+
+
+def _in_gdb(path: str) -> bool:
+    """True if path is an item of a file gdb (e.g. input.gdb/stems_in_situ)."""
+    parent = os.path.dirname(path)
+    while parent and parent != os.path.dirname(parent):
+        if parent.lower().endswith(".gdb"):
+            return True
+        parent = os.path.dirname(parent)
+    return False
+
+
+def _fingerprint_gdb_item(path: str) -> str:
+    """
+    Fingerprint of a feature class, table or raster in a file gdb: its
+    Describe signature (data type, fields, spatial reference, extent) and the
+    row count of feature classes and tables.
+    """
+    import arcpy
+
+    if not arcpy.Exists(path):
+        return None
+
+    desc = arcpy.Describe(path)
+    signature = [desc.dataType]
+    if hasattr(desc, "fields"):
+        signature.append(
+            [(field.name, field.type, field.length) for field in desc.fields]
+        )
+        signature.append(arcpy.management.GetCount(path)[0])
+    if hasattr(desc, "shapeType"):
+        signature.append(desc.shapeType)
+    if hasattr(desc, "spatialReference"):
+        signature.append(desc.spatialReference.factoryCode)
+    if hasattr(desc, "extent") and desc.extent is not None:
+        extent = desc.extent
+        signature.append([extent.XMin, extent.YMin, extent.XMax, extent.YMax])
+    return hash_params(signature)
+
+
+def fingerprint(path: str) -> str:
+    """
+    Fingerprint of a file (content hash), a directory (file stats) or an item
+    of a file gdb (Describe signature and row count, see _fingerprint_gdb_item).
+
+    Args:
+        path (str): path to a file, directory or feature class in a file gdb
+
+    Returns:
+        str: sha256 hex digest, or None if the path does not exist
+    """
+    if not os.path.exists(path):
+        if _in_gdb(path):
+            return _fingerprint_gdb_item(path)
+        return None
+
+    h = hashlib.sha256()
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            # skip lock files written by arcpy
+            if name.endswith(".lock"):
+                continue
+            filepath = os.path.join(root, name)
+            stat = os.stat(filepath)
+            rel = os.path.relpath(filepath, path)
+            h.update(f"{rel}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+def hash_params(params) -> str:
+    """Hash of a json serialisable parameter object."""
+    dump = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(dump.encode()).hexdigest()
+
+
+class Stage:
+    """
+    A pipeline stage.
+
+    Attributes:
+    -----------
+    name : str
+        unique name of the stage
+    func : callable
+        function that runs the stage, called as func(**kwargs)
+    inputs : list
+        paths read by the stage
+    outputs : list
+        paths written by the stage
+    params : dict
+        parameters that influence the result of the stage
+    deps : list
+        names of upstream stages
+    kwargs : dict
+        keyword arguments passed to func
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        inputs: List[str] = None,
+        outputs: List[str] = None,
+        params: Dict = None,
+        deps: List[str] = None,
+        kwargs: Dict = None,
+    ):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.params = params or {}
+        self.deps = list(deps or [])
+        self.kwargs = kwargs or {}
+
+    def key(self, upstream: List[Dict]) -> str:
+        """Hash of the stage parameters, its input content and the outputs
+        of the upstream stages ({path: fingerprint} per upstream stage).
+        """
+        h = hashlib.sha256()
+        h.update(self.name.encode())
+        h.update(hash_params(self.params).encode())
+        for path in sorted(self.inputs):
+            h.update(f"{path}|{fingerprint(path)}".encode())
+        for outputs in upstream:
+            h.update(hash_params(outputs).encode())
+        return h.hexdigest()
+
+
+class Pipeline:
+    """
+    A small DAG runner with a content-addressed artifact cache.
+
+    Attributes:
+    -----------
+    cache_dir : str
+        directory that stores the manifest and the cached artifacts
+
+    Methods:
+    --------
+    - add(self, stage)
+    - stage(self, name, **kwargs)
+    - order(self, targets)
+    - status(self, targets)
+    - run(self, targets, force)
+    """
+
+    def __init__(self, cache_dir: str, logger=None):
+        self.cache_dir = cache_dir
+        self.stages = {}
+        self.logger = logger or logging.getLogger(__name__)
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        self.objects_dir = os.path.join(cache_dir, "objects")
+
+    # ------------------------------------------------------------------ #
+    # DAG
+    # ------------------------------------------------------------------ #
+    def add(self, stage: Stage) -> Stage:
+        if stage.name in self.stages:
+            raise ValueError(f"Stage <{stage.name}> is already defined.")
+        self.stages[stage.name] = stage
+        return stage
+
+    def stage(self, name: str, **kwargs):
+        """Decorator to register a function as a stage."""
+
+        def decorator(func):
+            self.add(Stage(name, func, **kwargs))
+            return func
+
+        return decorator
+
+    def order(self, targets: List[str] = None) -> List[str]:
+        """Topological order of the stages needed for targets."""
+        targets = targets or list(self.stages)
+        ordered, visiting = [], set()
+
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle detected at stage <{name}>.")
+            if name not in self.stages:
+                raise KeyError(f"Unknown stage <{name}>.")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.remove(name)
+            ordered.append(name)
+
+        for target in targets:
+            visit(target)
+        return ordered
+
+    # ------------------------------------------------------------------ #
+    # Manifest and artifact cache
+    # ------------------------------------------------------------------ #
+    def _load_manifest(self) -> Dict:
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        return {}
+
+    def _save_manifest(self, manifest: Dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _upstream(stage: Stage, manifest: Dict) -> List[Dict]:
+        """Output fingerprints of the upstream stages, as recorded in the manifest."""
+        return [manifest.get(dep, {}).get("outputs", {}) for dep in stage.deps]
+
+    def _is_fresh(self, stage: Stage, key: str, record: Dict) -> bool:
+        if record is None or record.get("key") != key:
+            return False
+        for path in stage.outputs:
+            # a missing output is never fresh, even if it was missing before
+            current = fingerprint(path)
+            if current is None or current != record["outputs"].get(path):
+                return False
+        return True
+
+    def _store(self, key: str, stage: Stage):
+        """Copy file outputs to the artifact cache."""
+        object_dir = os.path.join(self.objects_dir, key)
+        os.makedirs(object_dir, exist_ok=True)
+        for i, path in enumerate(stage.outputs):
+            if os.path.isfile(path):
+                target = os.path.join(object_dir, f"{i}_{os.path.basename(path)}")
+                shutil.copy2(path, target)
+
+    def _restore(self, key: str, stage: Stage) -> bool:
+        """Restore file outputs from the artifact cache, if all are cached."""
+        object_dir = os.path.join(self.objects_dir, key)
+        cached = []
+        for i, path in enumerate(stage.outputs):
+            source = os.path.join(object_dir, f"{i}_{os.path.basename(path)}")
+            if not os.path.isfile(source):
+                return False
+            cached.append((source, path))
+
+        if not cached:
+            return False
+
+        for source, path in cached:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            shutil.copy2(source, path)
+        return True
+
+    # ------------------------------------------------------------------ #
+    # Run
+    # ------------------------------------------------------------------ #
+    def status(self, targets: List[str] = None) -> Dict[str, str]:
+        """Returns {stage: "fresh" | "stale"} without running anything.
+        Stages downstream of a stale stage are reported as stale.
+        """
+        manifest = self._load_manifest()
+        status = {}
+        for name in self.order(targets):
+            stage = self.stages[name]
+            key = stage.key(self._upstream(stage, manifest))
+            upstream_stale = any(status[dep] == "stale" for dep in stage.deps)
+            fresh = self._is_fresh(stage, key, manifest.get(name))
+            status[name] = "fresh" if fresh and not upstream_stale else "stale"
+        return status
+
+    def run(self, targets: List[str] = None, force: bool = False) -> Dict:
+        """
+        Run the stale stages needed for targets (all stages by default).
+
+        Args:
+            targets (list): names of the stages to bring up to date
+            force (bool): rerun all stages regardless of the cache
+
+        Returns:
+            dict: {stage: "fresh" | "restored" | "ran"}
+        """
+        manifest = self._load_manifest()
+        result = {}
+
+        for name in self.order(targets):
+            stage = self.stages[name]
+            # the manifest holds the outputs of upstream stages run before
+            key = stage.key(self._upstream(stage, manifest))
+
+            if not force and self._is_fresh(stage, key, manifest.get(name)):
+                self.logger.info(f"Stage <{name}> is up to date. SKIP.")
+                result[name] = "fresh"
+                continue
+
+            if not force and self._restore(key, stage):
+                self.logger.info(f"Stage <{name}> restored from cache {key[:12]}.")
+                result[name] = "restored"
+            else:
+                self.logger.info(f"Stage <{name}> is stale. RUN.")
+                start = time.perf_counter()
+                with profiler.span(f"stage {name}", stage=name):
+                    stage.func(**stage.kwargs)
+                elapsed = time.perf_counter() - start
+                self.logger.info(f"Stage <{name}> finished in {elapsed:.2f} sec")
+                self._store(key, stage)
+                result[name] = "ran"
+
+            manifest[name] = {
+                "key": key,
+                "outputs": {path: fingerprint(path) for path in stage.outputs},
+                "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            self._save_manifest(manifest)
+
+        return result
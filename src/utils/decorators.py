@@ -27,12 +27,15 @@ def timer(func):
 
     logger = logging.getLogger(__name__)
 
+    from src.utils import profiler
+
     @wraps(func)
     def wrapper(*args, **kwargs):
 
         start = time.perf_counter()
-        # call the function
-        output = func(*args, **kwargs)
+        # call the function (recorded as span if the profiler is enabled)
+        with profiler.span(func.__name__, module=func.__module__):
+            output = func(*args, **kwargs)
         end = time.perf_counter()
         logger.info(f"Execution time {func.__name__}(): {end - start:.2f} sec")
         return output
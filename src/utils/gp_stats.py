@@ -0,0 +1,233 @@
+"""
+Geoprocessing call instrumentation.
+
+Wraps the arcpy geoprocessing tools (arcpy.*_management, arcpy.*_analysis,
+arcpy.*_conversion and the arcpy.management/analysis/conversion toolboxes)
+to record per tool: call count, cumulative time, input feature count and
+throughput. At exit a cost table sorted by cumulative time is logged and
+written to log/<timestamp>_<script>_gp_stats.csv, e.g.
+
+    tool                  calls   total_s  runtime_%  mean_ms  features  features/s
+    Clip_analysis         24012    8123.4       61.2    338.3     ...
+
+Instrumentation is opt-in (gp_instrumentation: enabled in parameters.yaml or
+ITREE_GP_STATS=1) and installed by calling instrument_from_config() in the
+entry point. Counting input features calls GetCount per tool invocation and
+is disabled by default (count_features).
+
+Tool calls are also recorded as profiler spans if the profiler is enabled.
+"""
+
+import atexit
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+from functools import wraps
+
+from src.utils import profiler
+
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+
+TOOL_SUFFIXES = ("_management", "_analysis", "_conversion", "_cartography")
+TOOLBOXES = ("management", "analysis", "conversion", "cartography")
+# tools that are called to count features, never counted themselves
+NO_COUNT_TOOLS = ("GetCount_management",)
+
+
+class GPStats:
+    """
+    Collects call statistics per geoprocessing tool.
+
+    Attributes:
+    -----------
+    count_features : bool
+        count the features of the first input per call (arcpy.GetCount)
+    stats : dict
+        {tool: {"calls", "seconds", "features"}}
+
+    Methods:
+    --------
+    - record(self, tool, seconds, features)
+    - table(self)
+    - report(self, filepath)
+    """
+
+    def __init__(self, count_features: bool = False, logger=None):
+        self.count_features = count_features
+        self.logger = logger or logging.getLogger(__name__)
+        self.stats = {}
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, tool: str, seconds: float, features: int = None):
+        with self._lock:
+            entry = self.stats.setdefault(
+                tool, {"calls": 0, "seconds": 0.0, "features": 0}
+            )
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            if features is not None:
+                entry["features"] += features
+
+    def table(self):
+        """Rows sorted by cumulative time (descending)."""
+        runtime = time.perf_counter() - self.start
+        rows = []
+        for tool, entry in self.stats.items():
+            seconds = entry["seconds"]
+            rows.append(
+                {
+                    "tool": tool,
+                    "calls": entry["calls"],
+                    "total_s": round(seconds, 3),
+                    "runtime_%": round(seconds / runtime * 100, 1) if runtime else 0,
+                    "mean_ms": round(seconds / entry["calls"] * 1000, 3),
+                    "features": entry["features"] if self.count_features else None,
+                    "features/s": (
+                        round(entry["features"] / seconds, 1)
+                        if self.count_features and seconds
+                        else None
+                    ),
+                }
+            )
+        return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+    def report(self, filepath: str = None) -> str:
+        """Log the cost table and write it to a csv file (defaults to log/)."""
+        rows = self.table()
+        if not rows:
+            return None
+
+        header = ["tool", "calls", "total_s", "runtime_%", "mean_ms"]
+        if self.count_features:
+            header += ["features", "features/s"]
+
+        title = (
+            f"{'tool':<40}{'calls':>10}{'total_s':>12}{'runtime_%':>11}{'mean_ms':>11}"
+        )
+        if self.count_features:
+            title += f"{'features':>12}{'features/s':>12}"
+        lines = [title]
+        for row in rows:
+            line = (
+                f"{row['tool']:<40}{row['calls']:>10}{row['total_s']:>12.1f}"
+                f"{row['runtime_%']:>11.1f}{row['mean_ms']:>11.1f}"
+            )
+            if self.count_features:
+                line += f"{row['features']:>12}{row['features/s'] or 0:>12.1f}"
+            lines.append(line)
+        self.logger.info("Geoprocessing cost table:\n" + "\n".join(lines))
+
+        if filepath is None:
+            filepath = os.path.join(
+                project_dir,
+                "log",
+                datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                + "_"
+                + os.path.splitext(os.path.basename(sys.argv[0]))[0]
+                + "_gp_stats.csv",
+            )
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "w", encoding="utf-8") as f:
+            f.write(",".join(header) + "\n")
+            for row in rows:
+                f.write(",".join(str(row[col]) for col in header) + "\n")
+        self.logger.info(f"Geoprocessing cost table: {filepath}")
+        return filepath
+
+
+_stats = None
+_local = threading.local()
+
+
+def _feature_count(arcpy, args, kwargs):
+    """Feature count of the first input (path or layer), None if unknown."""
+    value = args[0] if args else next(iter(kwargs.values()), None)
+    if not isinstance(value, str):
+        return None
+    try:
+        return int(arcpy.management.GetCount(value).getOutput(0))
+    except Exception:
+        return None
+
+
+def _wrap(arcpy, func, tool):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # nested tool calls (e.g. Clip_analysis -> analysis.Clip) count once
+        if getattr(_local, "active", False) or _stats is None:
+            return func(*args, **kwargs)
+
+        _local.active = True
+        try:
+            features = None
+            if _stats.count_features and tool not in NO_COUNT_TOOLS:
+                features = _feature_count(arcpy, args, kwargs)
+
+            start = time.perf_counter()
+            with profiler.span(tool, cat="gp"):
+                output = func(*args, **kwargs)
+            _stats.record(tool, time.perf_counter() - start, features)
+            return output
+        finally:
+            _local.active = False
+
+    wrapper.__gp_wrapped__ = func
+    return wrapper
+
+
+def instrument(count_features: bool = False) -> GPStats:
+    """Wrap the arcpy geoprocessing tools and report the cost table at exit."""
+    global _stats
+    if _stats is not None:
+        return _stats
+
+    import arcpy
+
+    _stats = GPStats(count_features=count_features)
+    wrappers = {}  # the same tool can be exposed under several names
+
+    def patch(module, name, tool):
+        func = getattr(module, name, None)
+        if not callable(func) or hasattr(func, "__gp_wrapped__"):
+            return
+        if id(func) not in wrappers:
+            wrappers[id(func)] = _wrap(arcpy, func, tool)
+        setattr(module, name, wrappers[id(func)])
+
+    # arcpy.Clip_analysis, arcpy.Delete_management, ...
+    for name in dir(arcpy):
+        if name.endswith(TOOL_SUFFIXES) and not name.startswith("_"):
+            patch(arcpy, name, name)
+
+    # arcpy.analysis.Clip, arcpy.management.Delete, ...
+    for toolbox in TOOLBOXES:
+        module = getattr(arcpy, toolbox, None)
+        if module is None:
+            continue
+        for name in dir(module):
+            if name[:1].isupper():
+                patch(module, name, f"{name}_{toolbox}")
+
+    atexit.register(report)
+    return _stats
+
+
+def instrument_from_config() -> GPStats:
+    """Instrument arcpy if set in parameters.yaml or ITREE_GP_STATS=1."""
+    from src.config.config import load_parameters
+
+    config = load_parameters().get("gp_instrumentation", {}) or {}
+    if os.environ.get("ITREE_GP_STATS", "0") == "1" or config.get("enabled", False):
+        return instrument(count_features=config.get("count_features", False))
+    return None
+
+
+def report(filepath: str = None) -> str:
+    """Log and export the cost table of the instrumented tools."""
+    if _stats is None:
+        return None
+    return _stats.report(filepath)
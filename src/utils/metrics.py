@@ -0,0 +1,147 @@
+"""
+Structured progress metrics.
+
+Long running loops (per neighbourhood, per crown, per tree) report progress
+as JSON lines on the "metrics" logger instead of free text log lines:
+
+    {"ts": "2023-11-02T10:15:03", "event": "progress", "stage": "split_per_nb",
+     "neighbourhood": "302420", "rows": 1200, "total": 5400, "rows_per_s": 3.9,
+     "elapsed_s": 307.7, "eta_s": 1076.9}
+
+The metrics logger writes to log/<timestamp>_<script>_metrics.jsonl (see
+config/logging.yaml). Events are emitted at most every `interval_s` seconds
+(parameters.yaml, metrics: interval_s) and once when the loop is done.
+
+Example:
+--------
+with Progress("crown_light_exposure", total=n_trees, neighbourhood=n_code) as p:
+    for row in cursor:
+        ...
+        p.update()
+
+for n_code in track(neighbourhood_list, "classify_per_nb"):
+    ...
+"""
+
+import datetime
+import json
+import logging
+import time
+
+from src.config.config import load_parameters
+
+DEFAULT_INTERVAL_S = 30
+METRICS_LOGGER = "metrics"
+
+
+def _interval() -> float:
+    config = load_parameters().get("metrics", {}) or {}
+    return float(config.get("interval_s", DEFAULT_INTERVAL_S))
+
+
+class Progress:
+    """
+    Progress of a loop, reported as JSON lines on the metrics logger.
+
+    Attributes:
+    -----------
+    stage : str
+        name of the processing stage
+    total : int
+        expected number of rows (None if unknown, no ETA)
+    neighbourhood : str
+        neighbourhood code (optional)
+    interval : float
+        minimum seconds between two progress events
+    rows : int
+        rows processed so far
+
+    Methods:
+    --------
+    - update(self, n, neighbourhood)
+    - emit(self, event)
+    - close(self)
+    """
+
+    def __init__(
+        self,
+        stage: str,
+        total: int = None,
+        neighbourhood: str = None,
+        interval: float = None,
+        logger=None,
+    ):
+        self.stage = stage
+        self.total = total
+        self.neighbourhood = neighbourhood
+        self.interval = _interval() if interval is None else interval
+        self.logger = logger or logging.getLogger(METRICS_LOGGER)
+        self.rows = 0
+        self.start = time.perf_counter()
+        self._last_emit = self.start
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        failed = exc_type is not None and exc_type is not GeneratorExit
+        self.close(event="failed" if failed else "done")
+        return False
+
+    def update(self, n: int = 1, neighbourhood: str = None):
+        """Add n processed rows, emit an event if the interval has passed."""
+        self.rows += n
+        if neighbourhood is not None:
+            self.neighbourhood = neighbourhood
+
+        now = time.perf_counter()
+        if now - self._last_emit >= self.interval:
+            self._last_emit = now
+            self.emit("progress", now)
+
+    def emit(self, event: str = "progress", now: float = None):
+        now = now or time.perf_counter()
+        elapsed = now - self.start
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = round(max(self.total - self.rows, 0) / rate, 1)
+
+        record = {
+            "ts": datetime.datetime.now().isoformat(timespec="seconds"),
+            "event": event,
+            "stage": self.stage,
+            "neighbourhood": self.neighbourhood,
+            "rows": self.rows,
+            "total": self.total,
+            "rows_per_s": round(rate, 3),
+            "elapsed_s": round(elapsed, 1),
+            "eta_s": eta,
+        }
+        self.logger.info(json.dumps(record))
+
+    def close(self, event: str = "done"):
+        """Emit the final event (once)."""
+        if not self._closed:
+            self._closed = True
+            self.emit(event)
+
+
+def track(iterable, stage: str, total: int = None):
+    """Yield the neighbourhoods of iterable and report progress per neighbourhood.
+
+    Args:
+        iterable: neighbourhood codes
+        stage (str): name of the processing stage
+        total (int): number of neighbourhoods, defaults to len(iterable)
+    """
+    if total is None and hasattr(iterable, "__len__"):
+        total = len(iterable)
+
+    with Progress(stage, total) as progress:
+        for item in iterable:
+            progress.neighbourhood = str(item)
+            yield item
+            progress.update()
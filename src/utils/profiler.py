@@ -0,0 +1,234 @@
+"""
+Hierarchical span profiler.
+
+Records nested spans (pipeline stage > neighbourhood > geoprocessing call)
+with wall time, CPU time and optionally peak memory, and exports them as a
+Chrome trace (open in chrome://tracing, https://ui.perfetto.dev or
+https://speedscope.app).
+
+The profiler is off by default and costs a single flag check per span. Enable
+it in parameters.yaml (profiler: enabled) or with the environment variable
+ITREE_PROFILE=1, and call enable_from_config() in the entry point:
+
+    setup_logging()
+    profiler.enable_from_config()
+
+The peak python heap per span is opt-in (profiler: trace_memory), tracemalloc
+slows down every allocation and so distorts the wall and CPU times.
+
+Functions decorated with @dec.timer are recorded as spans. Other code can use:
+
+    with profiler.span("clip", n_code=n_code):
+        ...
+
+    for n_code in profiler.iterate(neighbourhood_list, "classify_per_nb"):
+        ...
+
+The trace is written to log/<timestamp>_<script>_trace.json at exit.
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:  # RSS is optional
+    psutil = None
+
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+
+_profiler = None
+
+
+class Profiler:
+    """
+    Collects spans and exports them as Chrome trace events.
+
+    Attributes:
+    -----------
+    trace_memory : bool
+        track the peak python heap per span with tracemalloc (opt-in, slows
+        down every allocation)
+    events : list
+        completed spans in Chrome trace event format
+
+    Methods:
+    --------
+    - begin(self, name, **args)
+    - end(self)
+    - export(self, filepath)
+    """
+
+    def __init__(self, trace_memory: bool = False, logger=None):
+        self.trace_memory = trace_memory
+        self.logger = logger or logging.getLogger(__name__)
+        self.events = []
+        self._local = threading.local()
+        self._t0 = time.perf_counter()
+        self._process = psutil.Process() if psutil else None
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _peak(self) -> int:
+        return tracemalloc.get_traced_memory()[1] if self.trace_memory else 0
+
+    def begin(self, name: str, **args):
+        """Open a span, nested in the current span of this thread."""
+        stack = self._stack
+        if self.trace_memory:
+            # hand the peak so far to the parent before resetting it
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], self._peak())
+            tracemalloc.reset_peak()
+
+        stack.append(
+            {
+                "name": name,
+                "args": args,
+                "wall": time.perf_counter(),
+                "cpu": time.process_time(),
+                "peak": 0,
+            }
+        )
+
+    def end(self):
+        """Close the current span and record it."""
+        span = self._stack.pop()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        peak = max(span["peak"], self._peak())
+        if self._stack:
+            self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+
+        args = dict(span["args"])
+        args["cpu_ms"] = round((cpu - span["cpu"]) * 1000, 3)
+        if self.trace_memory:
+            args["peak_heap_mb"] = round(peak / 1024**2, 3)
+        if self._process is not None:
+            args["rss_mb"] = round(self._process.memory_info().rss / 1024**2, 3)
+
+        self.events.append(
+            {
+                "name": span["name"],
+                "cat": "span",
+                "ph": "X",
+                "ts": round((span["wall"] - self._t0) * 1e6, 1),
+                "dur": round((wall - span["wall"]) * 1e6, 1),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+        )
+
+    def export(self, filepath: str = None) -> str:
+        """Write the Chrome trace to filepath (defaults to log/)."""
+        if filepath is None:
+            filepath = os.path.join(
+                project_dir,
+                "log",
+                datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                + "_"
+                + os.path.splitext(os.path.basename(sys.argv[0]))[0]
+                + "_trace.json",
+            )
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        with open(filepath, "w") as f:
+            json.dump(
+                {"traceEvents": self.events, "displayTimeUnit": "ms"}, f, indent=None
+            )
+        self.logger.info(f"Profiler trace ({len(self.events)} spans): {filepath}")
+        return filepath
+
+
+# --------------------------------------------------------------------------- #
+# Module level API
+# --------------------------------------------------------------------------- #
+def enable(trace_memory: bool = False, export_at_exit: bool = True) -> Profiler:
+    """Start recording spans."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(trace_memory=trace_memory)
+        if export_at_exit:
+            atexit.register(export)
+    return _profiler
+
+
+def enable_from_config() -> Profiler:
+    """Enable the profiler if set in parameters.yaml or ITREE_PROFILE=1."""
+    from src.config.config import load_parameters
+
+    config = load_parameters().get("profiler", {}) or {}
+    if os.environ.get("ITREE_PROFILE", "0") == "1" or config.get("enabled", False):
+        return enable(trace_memory=config.get("trace_memory", False))
+    return None
+
+
+def disable():
+    """Stop recording spans and discard them."""
+    global _profiler
+    if _profiler is not None and _profiler.trace_memory:
+        tracemalloc.stop()
+    _profiler = None
+
+
+def is_enabled() -> bool:
+    return _profiler is not None
+
+
+def export(filepath: str = None) -> str:
+    """Write the recorded spans to a Chrome trace file."""
+    if _profiler is None or not _profiler.events:
+        return None
+    return _profiler.export(filepath)
+
+
+@contextmanager
+def span(name: str, **args):
+    """Record the enclosed block as a span (no-op if the profiler is off)."""
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+
+    profiler.begin(name, **args)
+    try:
+        yield
+    finally:
+        profiler.end()
+
+
+def iterate(iterable, name: str, key: str = "item", label=None):
+    """Yield from iterable, recording each iteration as a span.
+
+    Args:
+        iterable: e.g. a neighbourhood list or an arcpy cursor
+        name (str): span name
+        key (str): name of the span argument holding the item label
+        label (callable): label of an item, defaults to str(item)
+
+    Example: for n_code in iterate(neighbourhood_list, "split_per_nb", "n_code")
+    """
+    if _profiler is None:
+        yield from iterable
+        return
+
+    for item in iterable:
+        item_label = label(item) if label else str(item)
+        with span(f"{name} <{item_label}>", **{key: item_label}):
+            yield item
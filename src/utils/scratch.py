@@ -0,0 +1,149 @@
+"""Scratch workspace for short-lived intermediate datasets.
+
+Temporary feature classes (buffers, clips, hulls, thiessen polygons, ...) are
+routed to a scratch workspace instead of the output file geodatabase. The
+workspace is configured in parameters.yaml (`scratch_workspace`):
+
+- memory:  the arcpy "memory" workspace (default)
+- ramdisk: a file geodatabase on a RAM-backed directory (Linux, /dev/shm)
+- disk:    the file geodatabase of the calling module (previous behaviour)
+
+Everything created through the workspace is deleted on context exit.
+"""
+
+import logging
+import os
+import platform
+import shutil
+import uuid
+
+import arcpy
+
+from src.config.config import load_parameters
+
+MODES = ("memory", "ramdisk", "disk")
+
+
+class ScratchWorkspace:
+    """
+    A context manager that routes temporary datasets to a scratch workspace.
+
+    Attributes:
+    -----------
+    fallback_gdb : str
+        path to the filegdb used in "disk" mode, or when the requested mode is
+        not available on this platform
+    mode : str
+        "memory", "ramdisk" or "disk", defaults to the mode in parameters.yaml
+    require_geometry_fields : bool
+        the memory workspace does not maintain Shape_Length and Shape_Area,
+        set to True if the caller reads these fields (falls back to ramdisk)
+
+    Methods:
+    --------
+    - open(self)
+    - close(self)
+    - path(self, name)
+    - delete(self, *paths)
+
+    Example:
+    --------
+    with ScratchWorkspace(filegdb_path) as scratch:
+        v_buffer = scratch.path("tmp_c3_buffer")
+        arcpy.Buffer_analysis(v_stems, v_buffer, "crown_radius")
+    """
+
+    def __init__(
+        self,
+        fallback_gdb: str,
+        mode: str = None,
+        require_geometry_fields: bool = False,
+        logger=None,
+    ):
+        config = load_parameters().get("scratch_workspace", {}) or {}
+
+        self.fallback_gdb = fallback_gdb
+        self.mode = mode or config.get("mode", "memory")
+        self.ramdisk_dir = config.get("ramdisk_dir", "/dev/shm")
+        self.require_geometry_fields = require_geometry_fields
+        self.logger = logger or logging.getLogger(__name__)
+
+        if self.mode not in MODES:
+            raise ValueError(
+                f"Invalid scratch workspace mode <{self.mode}>, use one of {MODES}"
+            )
+
+        self.workspace = None
+        self._items = {}  # ordered set of registered datasets
+        self._owns_workspace = False
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _resolve_mode(self):
+        mode = self.mode
+        if mode == "memory" and self.require_geometry_fields:
+            mode = "ramdisk"
+        if mode == "ramdisk" and (
+            platform.system() != "Linux" or not os.path.isdir(self.ramdisk_dir)
+        ):
+            mode = "disk"
+        return mode
+
+    def open(self):
+        """Resolve and (if necessary) create the scratch workspace."""
+        mode = self._resolve_mode()
+
+        if mode == "memory":
+            self.workspace = "memory"
+        elif mode == "ramdisk":
+            gdb_name = f"scratch_{os.getpid()}_{uuid.uuid4().hex[:8]}.gdb"
+            arcpy.management.CreateFileGDB(self.ramdisk_dir, gdb_name)
+            self.workspace = os.path.join(self.ramdisk_dir, gdb_name)
+            self._owns_workspace = True
+        else:
+            self.workspace = self.fallback_gdb
+
+        self.logger.debug(f"\tScratch workspace ({mode}): {self.workspace}")
+        return self
+
+    def path(self, name: str) -> str:
+        """Return the path for a temporary dataset and register it for cleanup.
+
+        Args:
+            name (str): name of the temporary dataset
+
+        Returns:
+            str: full path to the dataset in the scratch workspace
+        """
+        if self.workspace is None:
+            raise RuntimeError("Scratch workspace is not open.")
+
+        path = os.path.join(self.workspace, name)
+        self._items[path] = None
+        return path
+
+    def delete(self, *paths):
+        """Delete temporary datasets before the context exits."""
+        for path in paths:
+            if arcpy.Exists(path):
+                arcpy.Delete_management(path)
+            self._items.pop(path, None)
+
+    def close(self):
+        """Delete all registered datasets (and the workspace if it was created)."""
+        if self.workspace is None:
+            return
+
+        self.delete(*list(self._items))
+
+        if self._owns_workspace:
+            arcpy.Delete_management(self.workspace)
+            shutil.rmtree(self.workspace, ignore_errors=True)
+
+        self.workspace = None
+        self._owns_workspace = False
@@ -1,4 +1,25 @@
-"""Calculate the 3-30-300 rule for urban trees in a district."""
+"""Calculate the 3-30-300 rule for urban trees in a district.
+
+All districts are calculated in one DuckDB session (Session): the spatial
+extension is loaded once and the statistics are prepared statements on the
+tables of the current district (current_districts, current_bldg,
+current_res_bldg, current_tree_crowns), which are reloaded from the
+per_district parquet files for every district and executed again.
+
+In the set_based mode (rule_3_30_300: mode in parameters.yaml) the statistics
+of all districts are computed at once from the municipality tables, with one
+GROUP BY per table joined to the districts (set_based_statistics), and
+written to the same by_district CSV files.
+
+The res bldg flags n_green_spaces (green space within 300 m) and n_trees (3
+trees within 15 m) are spatial joins of the buildings and the features
+(near_flags, rule_3_30_300: proximity): on parsed geometries with a bounding
+box prefilter (indexed), on a shapely STRtree (strtree) or as the former
+correlated subquery per building (exists). With rule_3_30_300:
+raster_cell_size the green space distances are sampled from a distance
+transform of the rasterised green spaces instead (distance_grid), with the
+exact test for the buildings near 300 m.
+"""
 
 # Calculate Count Statistics for Tree Visibility
 # n_trees = number of trees in the district
@@ -11,149 +32,399 @@ import os
 
 import duckdb
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import shapely
 
 # convert geom from binary to shapely
 from shapely.wkb import loads
 
-def get_parquet_dict(district_number, parquet_dir):
-    file_names = [
-        f"districts_{district_number}",
-        f"bldg_{district_number}",
-        f"res_bldg_{district_number}",
-        f"tree_crowns_{district_number}",
-    ]
+# municipality tables, loaded once
+MUNICIPALITY_TABLES = ("districts", "green_space", "tree_crowns")
+# per_district/<name>_<district_number>.parquet, loaded as current_<name>
+DISTRICT_TABLES = ("districts", "bldg", "res_bldg", "tree_crowns")
+
+
+def current(name):
+    """Table of the current district."""
+    return f"current_{name}"
+
+
+# statistics of the current district, prepared once per session
+# (col_join: column of the district number)
+STATEMENTS = {
+    "n_trees": """
+        UPDATE current_districts
+        SET n_trees = (
+            SELECT COUNT(*)
+            FROM current_tree_crowns
+            WHERE current_districts.{col_join} = current_tree_crowns.{col_join}
+            )
+        """,
+    "n_bldg": """
+        UPDATE current_districts
+        SET n_bldg = (
+            SELECT COUNT(*)
+            FROM current_bldg
+            WHERE current_districts.{col_join} = current_bldg.{col_join}
+            )
+        """,
+    "n_res_bldg": """
+        UPDATE current_districts
+        SET n_res_bldg = (
+            SELECT COUNT(*)
+            FROM current_res_bldg
+            WHERE current_districts.{col_join} = current_res_bldg.{col_join}
+            )
+        """,
+    "n_res_bldg_near_gs": """
+        UPDATE current_districts
+        SET n_res_bldg_near_gs = (
+            SELECT COUNT(*)
+            FROM current_res_bldg
+            WHERE n_green_spaces >= 1
+            AND current_districts.{col_join} = current_res_bldg.{col_join}
+            )
+        """,
+    "n_res_bldg_near_trees": """
+        UPDATE current_districts
+        SET n_bldg_near_trees = (
+            SELECT COUNT(*)
+            FROM current_res_bldg
+            WHERE n_trees >= 1
+            AND current_districts.{col_join} = current_res_bldg.{col_join}
+            )
+        """,
+    "a_crown": """
+        UPDATE current_districts
+        SET a_crown = (
+            SELECT SUM(ST_Area(ST_GeomFromWKB(current_tree_crowns.geometry)))
+            FROM current_tree_crowns
+            WHERE current_districts.{col_join} = current_tree_crowns.{col_join}
+            )
+        """,
+    # if NAN set to 0, normalize and percentage of tree crown coverage
+    "fill_counts": """
+        UPDATE current_districts
+        SET n_res_bldg_near_gs = COALESCE(n_res_bldg_near_gs, 0),
+            n_bldg = COALESCE(n_bldg, 0),
+            n_res_bldg = COALESCE(n_res_bldg, 0),
+            n_bldg_near_trees= COALESCE(n_bldg_near_trees, 0)
+        """,
+    "perc_near_gs": """
+        UPDATE current_districts
+        SET perc_near_gs = (n_res_bldg_near_gs / n_res_bldg) * 100
+        """,
+    "perc_near_trees": """
+        UPDATE current_districts
+        SET perc_near_trees = (n_bldg_near_trees / n_res_bldg) * 100
+        """,
+    "perc_crown": """
+        UPDATE current_districts
+        SET perc_crown = (a_crown / a_clipped) * 100
+        """,
+    "fill_percentages": """
+        UPDATE current_districts
+        SET perc_near_gs = COALESCE(perc_near_gs, 0),
+            perc_near_trees = COALESCE(perc_near_trees, 0),
+            perc_crown = COALESCE(perc_crown, 0)
+        """,
+}
+
+
+# proximity rules of the res bldg flags: {flag column: (features, distance in
+# m, minimum number of features)}, 1 if the rule holds, else 0
+PROXIMITY_RULES = {
+    "n_green_spaces": ("green_space", 300, 1),
+    "n_trees": ("tree_crowns", 15, 3),
+}
+# indexed: parsed geometries with a bounding box prefilter (DuckDB)
+# strtree: shapely STRtree of the features (GeoPandas spatial index)
+# exists: correlated subquery per building, parses the WKB per comparison
+PROXIMITY_ENGINES = ("indexed", "strtree", "exists")
+
+# parsed geometries and bounding boxes of the features, once per session
+FEATURE_GEOMETRY = """
+    CREATE OR REPLACE TABLE {features}_geom AS
+    SELECT
+        geom,
+        ST_XMin(geom) AS xmin,
+        ST_YMin(geom) AS ymin,
+        ST_XMax(geom) AS xmax,
+        ST_YMax(geom) AS ymax
+    FROM (
+        SELECT ST_GeomFromWKB(geometry) AS geom
+        FROM {features}
+        WHERE geometry IS NOT NULL
+    )
+    """
+
+# flag per building (rowid) of a proximity rule, the bounding boxes within
+# distance are a range join and an exact prefilter of ST_DWithin
+NEAR_INDEXED = """
+    CREATE OR REPLACE TEMP TABLE near_{column} AS
+    WITH bldg AS (
+        SELECT
+            bldg_id,
+            geom,
+            ST_XMin(geom) AS xmin,
+            ST_YMin(geom) AS ymin,
+            ST_XMax(geom) AS xmax,
+            ST_YMax(geom) AS ymax
+        FROM (
+            SELECT rowid AS bldg_id, ST_GeomFromWKB(geometry) AS geom
+            FROM {table}
+        )
+    ),
+    near AS (
+        SELECT bldg.bldg_id
+        FROM bldg
+        JOIN {features}_geom AS f
+        ON f.xmin <= bldg.xmax + {distance}
+        AND f.xmax >= bldg.xmin - {distance}
+        AND f.ymin <= bldg.ymax + {distance}
+        AND f.ymax >= bldg.ymin - {distance}
+        AND ST_DWithin(bldg.geom, f.geom, {distance})
+        GROUP BY bldg.bldg_id
+        HAVING COUNT(*) >= {min_count}
+    )
+    SELECT
+        bldg.bldg_id,
+        CASE WHEN near.bldg_id IS NULL THEN 0 ELSE 1 END AS flag
+    FROM bldg
+    LEFT JOIN near ON bldg.bldg_id = near.bldg_id
+    """
+
+NEAR_EXISTS = """
+    CREATE OR REPLACE TEMP TABLE near_{column} AS
+    SELECT
+        rowid AS bldg_id,
+        CASE
+            WHEN (
+                SELECT COUNT(*)
+                FROM {features}
+                WHERE {features}.geometry IS NOT NULL
+                AND ST_DWithin(
+                    ST_GeomFromWKB({table}.geometry),
+                    ST_GeomFromWKB({features}.geometry),
+                    {distance}
+                )
+            ) >= {min_count} THEN 1
+            ELSE 0
+        END AS flag
+    FROM {table}
+    """
+
+UPDATE_FLAG = """
+    UPDATE {table}
+    SET {column} = near_{column}.flag
+    FROM near_{column}
+    WHERE {table}.rowid = near_{column}.bldg_id
+    """
+
+
+class Session:
+    """
+    DuckDB connection of the 3-30-300 calculation of all districts.
+
+    Attributes:
+    -----------
+    db_path : str
+        DuckDB database file
+    con : duckdb.DuckDBPyConnection
+        connection with the spatial extension loaded
+
+    Methods:
+    --------
+    - close(self)
+    - tables(self)
+    - columns(self, table)
+    - execute(self, name, col_join)
+    - feature_table(self, features)
+    - feature_index(self, features)
+    - feature_raster(self, features, cell_size, pad)
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.con = duckdb.connect(database=db_path, read_only=False)
+        # load spatial extension
+        self.con.install_extension("spatial")
+        self.con.load_extension("spatial")
+        self._prepared = set()
+        self._features = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.con.close()
+
+    def tables(self):
+        return [
+            row[0]
+            for row in self.con.execute(
+                "SELECT name FROM sqlite_master WHERE type='table';"
+            ).fetchall()
+        ]
+
+    def columns(self, table):
+        return self.con.execute(f"PRAGMA table_info({table})").fetch_df()[
+            "name"
+        ].tolist()
+
+    def execute(self, name, col_join="grunnkretsnummer"):
+        """Execute the statement name of STATEMENTS, prepared on first use."""
+        statement = f"{name}_{col_join}"
+        if statement not in self._prepared:
+            sql = STATEMENTS[name].format(col_join=col_join)
+            self.con.execute(f"PREPARE {statement} AS {sql}")
+            self._prepared.add(statement)
+        self.con.execute(f"EXECUTE {statement}")
+
+    def feature_table(self, features):
+        """<features>_geom: parsed geometries and bounding boxes, once."""
+        key = ("table", features)
+        if key not in self._features:
+            self.con.execute(FEATURE_GEOMETRY.format(features=features))
+            self._features[key] = f"{features}_geom"
+        return self._features[key]
+
+    def feature_index(self, features):
+        """STRtree of the geometries of the features table, once."""
+        key = ("index", features)
+        if key not in self._features:
+            geoms = _geometries(
+                self.con.execute(
+                    f"SELECT geometry FROM {features} WHERE geometry IS NOT NULL"
+                ).fetch_df()["geometry"]
+            )
+            self._features[key] = shapely.STRtree(geoms)
+        return self._features[key]
+
+    def feature_raster(self, features, cell_size, pad=0.0):
+        """distance_grid of the features table at cell_size, once."""
+        key = ("raster", features, cell_size)
+        if key not in self._features:
+            geoms = self.feature_index(features).geometries
+            self._features[key] = distance_grid(
+                geoms[~shapely.is_empty(geoms)], cell_size, pad
+            )
+        return self._features[key]
+
 
+def get_parquet_dict(district_number, parquet_dir):
+    # {table name: per_district/<name>_<district_number>.parquet}
     parquet_dict = {
-        name: os.path.join(parquet_dir, "per_district", f"{name}.parquet")
-        for name in file_names
+        name: os.path.join(
+            parquet_dir, "per_district", f"{name}_{district_number}.parquet"
+        )
+        for name in DISTRICT_TABLES
     }
 
     return parquet_dict
 
-def load_parquet_to_duckdb(input_parquet, output_table, db_path):
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        # load spatial extension
-        con.install_extension("spatial")
-        con.load_extension("spatial")
-
-        # check if table exists
-        table_exists = con.execute(
-            f"SELECT name FROM sqlite_master WHERE type='table' AND name='{output_table}';"
-        ).fetchone()
-        if table_exists:
+
+def load_parquet_to_duckdb(session, input_parquet, output_table, replace=False):
+    con = session.con
+
+    # check if table exists
+    if output_table in session.tables():
+        if not replace:
             print(f"Table {output_table} already exists. Skipping.")
             return
+        con.execute(f"DROP TABLE {output_table}")
+
+    # add table
+    if os.path.exists(input_parquet):
+        con.execute(
+            f"""
+            CREATE TABLE {output_table} AS
+            SELECT *
+            FROM parquet_scan('{input_parquet}')
+            """
+        )
+        print(f"Loaded table: {output_table}")
+
+        # get columns
+        columns = session.columns(output_table)
 
-        # add table
-        if os.path.exists(input_parquet):
+        # if col exists remove leading zeros from 'grunnkretsnummer' column
+        if "grunnkretsnummer" in columns:
             con.execute(
                 f"""
-                CREATE TABLE {output_table} AS 
-                SELECT * 
-                FROM parquet_scan('{input_parquet}')
-                """
-            )
-            print(f"Loaded table: {output_table}")
-            
-            # get columns
-            columns = (
-                con.execute(f"PRAGMA table_info({output_table})")
-                .fetch_df()["name"]
-                .tolist()
+                UPDATE {output_table}
+                SET grunnkretsnummer = TRIM(LEADING '0' FROM grunnkretsnummer)
+            """
             )
 
-            # if col exists remove leading zeros from 'grunnkretsnummer' column
-            if "grunnkretsnummer" in columns:
-                con.execute(
-                    f"""
-                    UPDATE {output_table}
-                    SET grunnkretsnummer = TRIM(LEADING '0' FROM grunnkretsnummer)
-                """
-                )
-
-            # if col_name district_code exists, rename to grunnkretsnummer
-            if "district_code" in columns:
-                # remove grunnkretsnummer column
-                con.execute(
-                    f"""
-                    ALTER TABLE {output_table}
-                    DROP COLUMN grunnkretsnummer
-                """
-                )
-                # rename district_code to grunnkretsnummer
-                con.execute(
-                    f"""
-                    ALTER TABLE {output_table}
-                    RENAME COLUMN district_code TO grunnkretsnummer
-                """
-                )
-        else:
-            print(f"File {input_parquet} does not exist. Skipping.")
-            # creaet empty table with col "grunnkretsnumer and delomradenummer type int"
+        # if col_name district_code exists, rename to grunnkretsnummer
+        if "district_code" in columns:
+            # remove grunnkretsnummer column
             con.execute(
                 f"""
-                CREATE TABLE {output_table} (
-                    grunnkretsnummer INT,
-                    delomradenummer INT,
-                    geometry GEOMETRY
-                )
+                ALTER TABLE {output_table}
+                DROP COLUMN grunnkretsnummer
+            """
+            )
+            # rename district_code to grunnkretsnummer
+            con.execute(
+                f"""
+                ALTER TABLE {output_table}
+                RENAME COLUMN district_code TO grunnkretsnummer
             """
             )
+    else:
+        print(f"File {input_parquet} does not exist. Skipping.")
+        # creaet empty table with col "grunnkretsnumer and delomradenummer type int"
+        con.execute(
+            f"""
+            CREATE TABLE {output_table} (
+                grunnkretsnummer INT,
+                delomradenummer INT,
+                geometry GEOMETRY
+            )
+        """
+        )
     return
 
 
-def check_column_in_tables(db_path):
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        con.install_extension("spatial")
-        con.load_extension("spatial")
-
-        # Get the list of all tables in the database
-        tables = (
-            con.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            .fetch_df()["name"]
-            .tolist()
-        )
-
-        for table in tables:
-            # Check if 'grunnkretsnummer' column exists in the table
-            columns = (
-                con.execute(f"PRAGMA table_info({table})").fetch_df()["name"].tolist()
-            )
-            if "grunnkretsnummer" in columns:
-                # Check if 'grunnkretsnummer' column is filled with values with length 8
-                df = pd.read_sql(
-                    f"SELECT grunnkretsnummer FROM {table} WHERE LENGTH(grunnkretsnummer) = 7",
-                    con,
+def check_column_in_tables(session):
+    for table in session.tables():
+        # Check if 'grunnkretsnummer' column exists in the table
+        if "grunnkretsnummer" in session.columns(table):
+            # Check if 'grunnkretsnummer' column is filled with values with length 8
+            df = session.con.execute(
+                f"SELECT grunnkretsnummer FROM {table} "
+                "WHERE LENGTH(grunnkretsnummer) = 7"
+            ).fetch_df()
+            if not df.empty:
+                print(
+                    f"Table {table} contains 'grunnkretsnummer' column with "
+                    "values of length 8."
                 )
-                if not df.empty:
-                    print(
-                        f"Table {table} contains 'grunnkretsnummer' column with values of length 8."
-                    )
-                else:
-                    print(
-                        f"Table {table} contains 'grunnkretsnummer' column but it does not have values of length 8."
-                    )
             else:
-                print(f"Table {table} does not contain 'grunnkretsnummer' column.")
+                print(
+                    f"Table {table} contains 'grunnkretsnummer' column but it "
+                    "does not have values of length 8."
+                )
+        else:
+            print(f"Table {table} does not contain 'grunnkretsnummer' column.")
     return
 
 
-def print_duckdb_info(db_path, district_number):
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        # load spatial extension
-        con.install_extension("spatial")
-        con.load_extension("spatial")
-
-        # Get table names
-        tables = con.execute(
-            "SELECT name FROM sqlite_master WHERE type='table';"
-        ).fetchall()
-        print("Tables:", tables)
-
-        # Print column names of district table
-        columns = con.execute(f"PRAGMA table_info(districts_{district_number});").fetchall()
-        print("Columns of districts table:", columns)
+def print_duckdb_info(session):
+    # Get table names
+    print("Tables:", session.tables())
+
+    # Print column names of district table
+    columns = session.con.execute(
+        f"PRAGMA table_info({current('districts')});"
+    ).fetchall()
+    print("Columns of districts table:", columns)
     return
 
 
@@ -165,24 +436,30 @@ def remove_duckdb_database(db_path):
     return
 
 
-def remove_all_except_two(db_path, table_a, table_b, table_c):
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        # Get table names
-        tables = con.execute(
-            "SELECT name FROM sqlite_master WHERE type='table';"
-        ).fetchall()
-
-        # Drop each table that is not 'districts'
-        for table in tables:
-            table_name = table[0]
-            if table_name != table_a and table_name != table_b and table_name != table_c:
-                con.execute(f"DROP TABLE {table_name};")
+def remove_all_except(session, keep=MUNICIPALITY_TABLES):
+    # Drop each table that is not a municipality table
+    for table_name in session.tables():
+        if table_name not in keep:
+            session.con.execute(f"DROP TABLE {table_name};")
     return
 
 
-def add_columns(db_path, district_number):
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        columns = [
+def _add_columns(session, table, columns):
+    existing_columns = session.columns(table)
+    for column in columns:
+        if column in existing_columns:
+            print(f"Column {column} already exists. Skipping.")
+            continue
+
+        session.con.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER")
+
+
+def add_columns(session):
+    # count columns of the districts table
+    _add_columns(
+        session,
+        current("districts"),
+        [
             "n_trees",
             "n_bldg",
             "n_res_bldg",
@@ -192,332 +469,507 @@ def add_columns(db_path, district_number):
             "perc_near_trees",
             "a_crown",
             "perc_crown",
-        ]
-        existing_columns = [
-            column[1]
-            for column in con.execute(
-                f"PRAGMA table_info(districts_{district_number});"
-            ).fetchall()
-        ]
+        ],
+    )
+    # add column n_green_spaces and n_trees to res_bldg table
+    _add_columns(session, current("res_bldg"), ["n_green_spaces", "n_trees"])
+    return
 
-        for column in columns:
-            if column in existing_columns:
-                print(f"Column {column} already exists. Skipping.")
-                continue
 
-            con.execute(
-                f"ALTER TABLE districts_{district_number} ADD COLUMN {column} INTEGER"
-            )
+def _column(session, table, column):
+    return session.con.execute(f"SELECT {column} FROM {table}").fetchall()
 
-    # add column n_green_spaces and n_trees to res_bldg table
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        columns = ["n_green_spaces", "n_trees"]
-        existing_columns = [
-            column[1]
-            for column in con.execute(
-                f"PRAGMA table_info(res_bldg_{district_number});"
-            ).fetchall()
-        ]
 
-        for column in columns:
-            if column in existing_columns:
-                print(f"Column {column} already exists. Skipping.")
-                continue
+def _geometries(wkb):
+    # WKB (bytearray from duckdb, missing geometries None) to shapely geometries
+    return shapely.from_wkb([None if pd.isna(g) else bytes(g) for g in wkb])
 
-            con.execute(
-                f"ALTER TABLE res_bldg_{district_number} ADD COLUMN {column} INTEGER"
-            )
 
-    return
+def _flags_table(session, column, bldg_id, flags):
+    df_flags = pd.DataFrame({"bldg_id": bldg_id, "flag": flags.astype("int32")})
+    session.con.register("df_flags", df_flags)
+    session.con.execute(
+        f"CREATE OR REPLACE TEMP TABLE near_{column} AS SELECT * FROM df_flags"
+    )
+    session.con.unregister("df_flags")
 
 
-def n_trees(db_path, district_number, col_join="grunnkretsnummer"):
+def _near_exact(session, features, geoms, distance, min_count):
+    # flags of the shapely geometries geoms with the STRtree of the features
+    pairs = session.feature_index(features).query(
+        geoms, predicate="dwithin", distance=distance
+    )
+    return np.bincount(pairs[0], minlength=len(geoms)) >= min_count
+
+
+def distance_grid(features, cell_size, pad=0.0):
+    """
+    Euclidean distance transform of the features rasterised at cell_size
+    (all cells touched by a feature), over the bounds of the features
+    extended by pad.
+
+    Returns:
+        tuple: (x0, y0, cell_size, distance), the top left corner of the grid
+        and the distance of each cell to the nearest feature cell; None
+        without features
+    """
+    from rasterio.features import rasterize
+    from rasterio.transform import from_origin
+    from scipy.ndimage import distance_transform_edt
+
+    if not len(features):
+        return None
+
+    xmin, ymin, xmax, ymax = shapely.total_bounds(features)
+    x0, y0 = xmin - pad, ymax + pad
+    n_cols = int((xmax + pad - x0) // cell_size) + 1
+    n_rows = int((y0 - (ymin - pad)) // cell_size) + 1
+
+    mask = rasterize(
+        ((feature, 1) for feature in features),
+        out_shape=(n_rows, n_cols),
+        transform=from_origin(x0, y0, cell_size, cell_size),
+        fill=0,
+        all_touched=True,
+        dtype="uint8",
+    )
+    return x0, y0, cell_size, distance_transform_edt(mask == 0, sampling=cell_size)
+
+
+def sample_distance(grid, geoms):
+    """
+    Minimum distance of each geometry of geoms to the features, sampled from
+    the cells of grid (distance_grid) that the geometry intersects. The
+    sampled distance differs from the exact distance by less than the cell
+    diagonal; inf for missing or empty geometries and for geometries that are
+    not inside the grid.
+    """
+    sampled = np.full(len(geoms), np.inf)
+    if grid is None:
+        return sampled
+    x0, y0, cell_size, distance = grid
+    n_rows, n_cols = distance.shape
+
+    # cells of the bounding box of each geometry inside the grid
+    index = np.flatnonzero(~(shapely.is_missing(geoms) | shapely.is_empty(geoms)))
+    bounds = shapely.bounds(geoms[index])
+    col0 = ((bounds[:, 0] - x0) // cell_size).astype(np.int64)
+    col1 = ((bounds[:, 2] - x0) // cell_size).astype(np.int64)
+    row0 = ((y0 - bounds[:, 3]) // cell_size).astype(np.int64)
+    row1 = ((y0 - bounds[:, 1]) // cell_size).astype(np.int64)
+    inside = (col0 >= 0) & (row0 >= 0) & (col1 < n_cols) & (row1 < n_rows)
+    index, col0, col1, row0, row1 = (a[inside] for a in (index, col0, col1, row0, row1))
+    n_window_cols = col1 - col0 + 1
+    n_cells = (row1 - row0 + 1) * n_window_cols
+
+    # sampled where the geometry intersects the cell
+    owner = np.repeat(np.arange(len(index)), n_cells)
+    k = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+    rows = row0[owner] + k // n_window_cols[owner]
+    cols = col0[owner] + k % n_window_cols[owner]
+    cells = shapely.box(
+        x0 + cols * cell_size,
+        y0 - (rows + 1) * cell_size,
+        x0 + (cols + 1) * cell_size,
+        y0 - rows * cell_size,
+    )
+    touched = shapely.intersects(geoms[index][owner], cells)
+    np.minimum.at(
+        sampled, index[owner[touched]], distance[rows[touched], cols[touched]]
+    )
+    return sampled
+
+
+def _near_raster(session, features, geoms, distance, cell_size):
+    # raster distance, exact (STRtree) for the geometries within a cell
+    # diagonal of distance, where the raster may decide wrongly, and for the
+    # geometries outside the grid
+    diagonal = np.sqrt(2) * cell_size
+    grid = session.feature_raster(features, cell_size, pad=distance + diagonal)
+    sampled = sample_distance(grid, geoms)
+    flags = sampled <= distance
+    exact = np.abs(sampled - distance) <= diagonal
+    exact |= ~np.isfinite(sampled) & ~shapely.is_missing(geoms)
+    flags[exact] = _near_exact(session, features, geoms[exact], distance, 1)
+    print(
+        f"Raster distance to {features}: {exact.sum()} of {len(geoms)} "
+        "buildings tested exactly"
+    )
+    return flags
+
+
+def near_flags(session, table, column, engine="indexed", cell_size=None):
+    """
+    Flag of the proximity rule column (PROXIMITY_RULES) of every building of
+    table, as the temporary table near_<column> (bldg_id = rowid, flag). The
+    engines (PROXIMITY_ENGINES) give the same flags.
+
+    With cell_size the distances of a rule of one feature (n_green_spaces)
+    are sampled from a distance transform of the features rasterised at
+    cell_size m (distance_grid, once per session), and the buildings within
+    a cell diagonal of the rule distance are tested exactly; the flags are
+    the same.
+    """
+    if engine not in PROXIMITY_ENGINES:
+        raise ValueError(
+            f"proximity must be one of {PROXIMITY_ENGINES}, not <{engine}>"
+        )
+    features, distance, min_count = PROXIMITY_RULES[column]
+    if cell_size is not None and (min_count != 1 or cell_size <= 0):
+        raise ValueError(
+            f"raster_cell_size must be positive and is only valid for rules of "
+            f"one feature, not <{cell_size}> for {column}"
+        )
+    params = {
+        "table": table,
+        "column": column,
+        "features": features,
+        "distance": distance,
+        "min_count": min_count,
+    }
+
+    if cell_size is not None or engine == "strtree":
+        df = session.con.execute(
+            f"SELECT rowid AS bldg_id, geometry FROM {table}"
+        ).fetch_df()
+        geoms = _geometries(df["geometry"])
+        if cell_size is not None:
+            flags = _near_raster(session, features, geoms, distance, cell_size)
+        else:
+            flags = _near_exact(session, features, geoms, distance, min_count)
+        _flags_table(session, column, df["bldg_id"], flags)
+    elif engine == "indexed":
+        session.feature_table(features)
+        session.con.execute(NEAR_INDEXED.format(**params))
+    else:
+        session.con.execute(NEAR_EXISTS.format(**params))
+    return f"near_{column}"
+
+
+def _update_flag(session, table, column, engine, cell_size=None):
+    near_flags(session, table, column, engine, cell_size)
+    session.con.execute(UPDATE_FLAG.format(table=table, column=column))
+
+
+def n_trees(session, col_join="grunnkretsnummer"):
     # based on ATTRIBUTE VALUE
     # count of all trees in the district
-
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET n_trees = (
-                SELECT COUNT(*)
-                FROM tree_crowns_{district_number}
-                WHERE districts_{district_number}.{col_join} = tree_crowns_{district_number}.{col_join}
-                )
-            """
-        )
-        count = con.execute(
-            f"SELECT n_trees FROM districts_{district_number}"
-        ).fetchall()
-    return count
+    session.execute("n_trees", col_join)
+    return _column(session, current("districts"), "n_trees")
 
 
-def n_bldg(db_path, district_number, col_join="grunnkretsnummer"):
+def n_bldg(session, col_join="grunnkretsnummer"):
     # based on ATTRIBUTE VALUE
     # count of all buildings in the district
-
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET n_bldg = (
-                SELECT COUNT(*)
-                FROM bldg_{district_number}
-                WHERE districts_{district_number}.{col_join} = bldg_{district_number}.{col_join}
-                )
-            """
-        )
-        count = con.execute(
-            f"SELECT n_bldg FROM districts_{district_number}"
-        ).fetchall()
-    return count
+    session.execute("n_bldg", col_join)
+    return _column(session, current("districts"), "n_bldg")
 
 
-def n_res_bldg(db_path, district_number, col_join="grunnkretsnummer"):
+def n_res_bldg(session, col_join="grunnkretsnummer"):
     # based on ATTRIBUTE VALUE
     # count of all residential buildings in the district
-
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        con.install_extension("spatial")
-        con.load_extension("spatial")
-
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET n_res_bldg = (
-                SELECT COUNT(*)
-                FROM res_bldg_{district_number}
-                WHERE districts_{district_number}.{col_join} = res_bldg_{district_number}.{col_join}
-                )
-            """
-        )
-        count = con.execute(
-            f"SELECT n_res_bldg FROM districts_{district_number}"
-        ).fetchall()
-    return count
+    session.execute("n_res_bldg", col_join)
+    return _column(session, current("districts"), "n_res_bldg")
 
 
-def n_green_spaces(db_path, district_number):
+def n_green_spaces(session, engine="indexed", cell_size=None):
     # based on GEOMETRY
     # if there is a green spaces within 300 m distance of a res bldg, set n_green_spaces to 1
     # if there is no green space within 300 m distance of a res bldg, set n_green_spaces to 0
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        con.install_extension("spatial")
-        con.load_extension("spatial")
-
-        con.execute(
-            f"""
-            UPDATE res_bldg_{district_number}
-            SET n_green_spaces = (
-                CASE
-                    WHEN EXISTS (
-                        SELECT 1
-                        FROM green_space
-                        WHERE green_space.geometry IS NOT NULL 
-                        AND ST_DWithin(ST_GeomFromWKB(res_bldg_{district_number}.geometry), ST_GeomFromWKB(green_space.geometry), 300)
-                    ) THEN 1
-                    ELSE 0
-                END
-            )
-            """
-        )
-        count = con.execute(
-            f"SELECT n_green_spaces FROM res_bldg_{district_number}"
-        ).fetchall()
+    _update_flag(session, current("res_bldg"), "n_green_spaces", engine, cell_size)
     return
 
 
-def n_res_bldg_near_gs(db_path, district_number, col_join="grunnkretsnummer"):
+def n_res_bldg_near_gs(session, col_join="grunnkretsnummer"):
     # based on ATTRIBUTE VALUE
     # count all values =1 in n_green_spaces column in res_bldg table
     # and add to districts table based on districtnumber
+    session.execute("n_res_bldg_near_gs", col_join)
+    return _column(session, current("districts"), "n_res_bldg_near_gs")
 
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET n_res_bldg_near_gs = (
-                SELECT COUNT(*)
-                FROM res_bldg_{district_number}
-                WHERE n_green_spaces >= 1 AND districts_{district_number}.{col_join} = res_bldg_{district_number}.{col_join}
-                )
-            """
-        )
-        count = con.execute(
-            f"SELECT n_res_bldg_near_gs FROM districts_{district_number}"
-        ).fetchall()
-
-    return count
 
-def n_near_trees(db_path, district_number):
+def n_near_trees(session, engine="indexed"):
     # based on GEOMETRY
     # count all trees within 15m distance of a res bldg
     # if count >= 3, set n_trees to 1
     # if count < 3, set n_trees to 0
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        con.install_extension("spatial")
-        con.load_extension("spatial")
-
-        con.execute(
-            f"""
-            UPDATE res_bldg_{district_number}
-            SET n_trees = (
-                CASE
-                    WHEN (
-                        SELECT COUNT(*)
-                        FROM tree_crowns
-                        WHERE tree_crowns.geometry IS NOT NULL 
-                        AND ST_DWithin(ST_GeomFromWKB(res_bldg_{district_number}.geometry), ST_GeomFromWKB(tree_crowns.geometry), 15)
-                    ) >= 3 THEN 1
-                    ELSE 0
-                END
-            )
-            """
-        )
-        count = con.execute(
-            f"SELECT n_trees FROM res_bldg_{district_number}"
-        ).fetchall()
-    return count
+    _update_flag(session, current("res_bldg"), "n_trees", engine)
+    return _column(session, current("res_bldg"), "n_trees")
 
 
-def n_res_bldg_near_trees(db_path, district_number, col_join="grunnkretsnummer"):
+def n_res_bldg_near_trees(session, col_join="grunnkretsnummer"):
     # based on ATTRIBUTE VALUE
     # count all values =1 in n_trees column in res_bldg table
     # and add to districts table based on districtnumber
-
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET n_bldg_near_trees = (
-                SELECT COUNT(*)
-                FROM res_bldg_{district_number}
-                WHERE n_trees >= 1 AND districts_{district_number}.{col_join} = res_bldg_{district_number}.{col_join}
-                )
-            """
-        )
-        count = con.execute(
-            f"SELECT n_bldg_near_trees FROM districts_{district_number}"
-        ).fetchall()
-    return count
+    session.execute("n_res_bldg_near_trees", col_join)
+    return _column(session, current("districts"), "n_bldg_near_trees")
 
 
-def a_crown(db_path, district_number, col_join="grunnkretsnummer"):
+def a_crown(session, col_join="grunnkretsnummer"):
     # sum crown area for all trees in the district
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        con.install_extension("spatial")
-        con.load_extension("spatial")
-
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET a_crown = (
-                SELECT SUM(ST_Area(ST_GeomFromWKB(tree_crowns_{district_number}.geometry)))
-                FROM tree_crowns_{district_number}
-                WHERE districts_{district_number}.{col_join} = tree_crowns_{district_number}.{col_join}
-                )
-            """
-        )
-        count = con.execute(
-            f"SELECT a_crown FROM districts_{district_number}"
-        ).fetchall()
-    return count
+    session.execute("a_crown", col_join)
+    return _column(session, current("districts"), "a_crown")
 
 
-def update_table(db_path, district_number):
+def update_table(session, district_number):
     print(f"District number: {district_number}")
-    # print district col names 
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        columns = con.execute(
-            f"PRAGMA table_info(districts_{district_number});"
-        ).fetchall()
-        print("Columns of districts table:", columns)
-    
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        # if NAN set to 0
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET n_res_bldg_near_gs = COALESCE(n_res_bldg_near_gs, 0),
-                n_bldg = COALESCE(n_bldg, 0),
-                n_res_bldg = COALESCE(n_res_bldg, 0),
-                n_bldg_near_trees= COALESCE(n_bldg_near_trees, 0)
-            """
-        )
+    # print district col names
+    columns = session.con.execute(
+        f"PRAGMA table_info({current('districts')});"
+    ).fetchall()
+    print("Columns of districts table:", columns)
+
+    # if NAN set to 0, normalize perc_near_gs, perc_near_trees and
+    # PERCENTAGE of tree crown coverage per district
+    for name in (
+        "fill_counts",
+        "perc_near_gs",
+        "perc_near_trees",
+        "perc_crown",
+        "fill_percentages",
+    ):
+        session.execute(name)
+    return
 
-        # normalize perc_near_gs
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET perc_near_gs = (n_res_bldg_near_gs / n_res_bldg) * 100
-            """
-        )
 
-        # normalize perc_near_trees
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET perc_near_trees = (n_bldg_near_trees / n_res_bldg) * 100
-            """
-        )
+def export_districts_to_gdf(session):
+    df = pd.read_sql(f"SELECT * FROM {current('districts')}", session.con)
+    # Convert geometry column from WKB to shapely geometry
+    df["geometry"] = df["geometry"].apply(loads, hex=True)
 
-        # PERCENTAGE of tree crown coverage per district
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET perc_crown = (a_crown / a_clipped) * 100
-            """
+    # Convert DataFrame to GeoDataFrame
+    gdf = gpd.GeoDataFrame(df, geometry="geometry")
+    gdf_sorted = gdf.sort_values(by="grunnkretsnummer", ascending=True)
+    gdf_sorted = gdf_sorted.round(2)
+
+    return gdf
+
+
+def _export_table_to_csv(session, table_name, filepath):
+    df = pd.read_sql(f"SELECT * FROM {table_name}", session.con)
+    df.to_csv(filepath, index=False)
+
+
+def export_district_tables_to_csv(session, district_number, reporting_dir):
+    # tables of the current district as by_district/<name>_<district_number>.csv
+    output_path = os.path.join(reporting_dir, "by_district")
+    os.makedirs(output_path, exist_ok=True)
+
+    for name in DISTRICT_TABLES:
+        _export_table_to_csv(
+            session,
+            current(name),
+            os.path.join(output_path, f"{name}_{district_number}.csv"),
         )
+    return
 
-        # if NAN set to 0
-        con.execute(
-            f"""
-            UPDATE districts_{district_number}
-            SET perc_near_gs = COALESCE(perc_near_gs, 0),
-                perc_near_trees = COALESCE(perc_near_trees, 0),
-                perc_crown = COALESCE(perc_crown, 0)
-            """
+
+def export_all_tables_to_csv(session, reporting_dir, tables=MUNICIPALITY_TABLES):
+    # Create folder if not exists
+    output_path = os.path.join(reporting_dir, "by_district")
+    os.makedirs(output_path, exist_ok=True)
+
+    # Export each table to csv
+    for table_name in tables:
+        _export_table_to_csv(
+            session, table_name, os.path.join(output_path, f"{table_name}.csv")
         )
     return
 
 
-def export_districts_to_gdf(db_path, district_number):
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        df = pd.read_sql(f"SELECT * FROM districts_{district_number}", con)
-        # Convert geometry column from WKB to shapely geometry
-        df["geometry"] = df["geometry"].apply(loads, hex=True)
+# --------------------------------------------------------------------------- #
+# Set-based mode: all districts in one query plan
+# --------------------------------------------------------------------------- #
+# municipality tables of the set-based mode (<municipality>_<name>.parquet)
+SET_BASED_TABLES = ("districts", "bldg", "res_bldg", "green_space", "tree_crowns")
+# columns added to the districts table, in the order of add_columns
+STAT_COLUMNS = (
+    "n_trees",
+    "n_bldg",
+    "n_res_bldg",
+    "n_res_bldg_near_gs",
+    "perc_near_gs",
+    "n_bldg_near_trees",
+    "perc_near_trees",
+    "a_crown",
+    "perc_crown",
+)
+FLAG_COLUMNS = ("n_green_spaces", "n_trees")
+
+# res_bldg with the flags of n_green_spaces and n_trees (near_flags)
+RES_BLDG_FLAGS = """
+    CREATE OR REPLACE TABLE res_bldg_flags AS
+    SELECT
+        {res_columns},
+        near_n_green_spaces.flag AS n_green_spaces,
+        near_n_trees.flag AS n_trees
+    FROM res_bldg AS res
+    JOIN near_n_green_spaces ON res.rowid = near_n_green_spaces.bldg_id
+    JOIN near_n_trees ON res.rowid = near_n_trees.bldg_id
+    ORDER BY res.rowid
+    """
+
+# statistics of all districts: one GROUP BY per table joined to the districts,
+# with the INTEGER columns, NULL handling and percentages of update_table
+DISTRICT_STATS = """
+    CREATE OR REPLACE TABLE district_stats AS
+    WITH trees AS (
+        SELECT
+            {col_join},
+            COUNT(*) AS n_trees,
+            SUM(ST_Area(ST_GeomFromWKB(geometry))) AS a_crown
+        FROM tree_crowns
+        GROUP BY {col_join}
+    ),
+    bldg_count AS (
+        SELECT {col_join}, COUNT(*) AS n_bldg
+        FROM bldg
+        GROUP BY {col_join}
+    ),
+    res_count AS (
+        SELECT
+            {col_join},
+            COUNT(*) AS n_res_bldg,
+            COUNT(*) FILTER (WHERE n_green_spaces >= 1) AS n_res_bldg_near_gs,
+            COUNT(*) FILTER (WHERE n_trees >= 1) AS n_bldg_near_trees
+        FROM res_bldg_flags
+        GROUP BY {col_join}
+    ),
+    counts AS (
+        SELECT
+            {district_columns},
+            CAST(COALESCE(trees.n_trees, 0) AS INTEGER) AS n_trees,
+            CAST(COALESCE(bldg_count.n_bldg, 0) AS INTEGER) AS n_bldg,
+            CAST(COALESCE(res_count.n_res_bldg, 0) AS INTEGER) AS n_res_bldg,
+            CAST(COALESCE(res_count.n_res_bldg_near_gs, 0) AS INTEGER)
+                AS n_res_bldg_near_gs,
+            CAST(COALESCE(res_count.n_bldg_near_trees, 0) AS INTEGER)
+                AS n_bldg_near_trees,
+            CAST(trees.a_crown AS INTEGER) AS a_crown
+        FROM districts AS d
+        LEFT JOIN trees ON d.{col_join} = trees.{col_join}
+        LEFT JOIN bldg_count ON d.{col_join} = bldg_count.{col_join}
+        LEFT JOIN res_count ON d.{col_join} = res_count.{col_join}
+    )
+    SELECT
+        {district_columns},
+        n_trees,
+        n_bldg,
+        n_res_bldg,
+        n_res_bldg_near_gs,
+        COALESCE(
+            CAST((n_res_bldg_near_gs / NULLIF(n_res_bldg, 0)) * 100 AS INTEGER), 0
+        ) AS perc_near_gs,
+        n_bldg_near_trees,
+        COALESCE(
+            CAST((n_bldg_near_trees / NULLIF(n_res_bldg, 0)) * 100 AS INTEGER), 0
+        ) AS perc_near_trees,
+        a_crown,
+        COALESCE(
+            CAST((a_crown / NULLIF(a_clipped, 0)) * 100 AS INTEGER), 0
+        ) AS perc_crown
+    FROM counts AS d
+    """
+
+
+def _select_columns(session, table, exclude, alias):
+    return ", ".join(
+        f'{alias}."{column}"'
+        for column in session.columns(table)
+        if column not in exclude
+    )
 
-        # Convert DataFrame to GeoDataFrame
-        gdf = gpd.GeoDataFrame(df, geometry="geometry")
-        gdf_sorted = gdf.sort_values(by="grunnkretsnummer", ascending=True)
-        gdf_sorted = gdf_sorted.round(2)
 
-    return gdf
+def set_based_statistics(
+    session, col_join="grunnkretsnummer", proximity="indexed", raster_cell_size=None
+):
+    """
+    Statistics of all districts in one query plan over the municipality
+    tables (SET_BASED_TABLES): res_bldg_flags (res_bldg with n_green_spaces
+    and n_trees) and district_stats (districts with STAT_COLUMNS).
+    """
+    near_flags(session, "res_bldg", "n_green_spaces", proximity, raster_cell_size)
+    near_flags(session, "res_bldg", "n_trees", proximity)
+    session.con.execute(
+        RES_BLDG_FLAGS.format(
+            res_columns=_select_columns(session, "res_bldg", FLAG_COLUMNS, "res")
+        )
+    )
+    session.con.execute(
+        DISTRICT_STATS.format(
+            col_join=col_join,
+            district_columns=_select_columns(session, "districts", STAT_COLUMNS, "d"),
+        )
+    )
+    return
 
 
-def export_all_tables_to_csv(db_path, reporting_dir):
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        # Get table names
-        tables = con.execute(
-            "SELECT name FROM sqlite_master WHERE type='table';"
-        ).fetchall()
-
-        # Create folder if not exists
-        output_path = os.path.join(reporting_dir, "by_district")
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
-            
-        # Export each table to csv
-        for table in tables:
-            table_name = table[0]
-            df = pd.read_sql(f"SELECT * FROM {table_name}", con)
+def export_set_based_to_csv(session, district_numbers, reporting_dir):
+    # per district CSV files of the per_district mode (concat_all_csvs):
+    # by_district/<name>_<district_number>.csv by delomradenummer
+    output_path = os.path.join(reporting_dir, "by_district")
+    os.makedirs(output_path, exist_ok=True)
+
+    tables = {
+        "districts": "district_stats",
+        "bldg": "bldg",
+        "res_bldg": "res_bldg_flags",
+        "tree_crowns": "tree_crowns",
+    }
+    for name, table in tables.items():
+        if "delomradenummer" not in session.columns(table):
+            print(f"Table {table} has no delomradenummer column. Skipping.")
+            continue
+        for district_number in district_numbers:
+            df = session.con.execute(
+                f"SELECT * FROM {table} "
+                "WHERE CAST(delomradenummer AS BIGINT) = CAST(? AS BIGINT)",
+                [district_number],
+            ).fetch_df()
             df.to_csv(
-                os.path.join(output_path, f"{table_name}.csv"),
+                os.path.join(output_path, f"{name}_{district_number}.csv"),
                 index=False,
             )
     return
 
 
+def main_set_based(
+    district_numbers,
+    parquet_dir,
+    db_path,
+    reporting_dir,
+    proximity="indexed",
+    raster_cell_size=None,
+):
+    with Session(db_path) as session:
+        # municipality tables
+        for name in SET_BASED_TABLES:
+            load_parquet_to_duckdb(
+                session,
+                os.path.join(parquet_dir, f"{municipality}_{name}.parquet"),
+                name,
+            )
+
+        # statistics of all districts
+        set_based_statistics(
+            session, proximity=proximity, raster_cell_size=raster_cell_size
+        )
+        print(
+            session.con.execute(
+                "SELECT delomradenummer, grunnkretsnummer, "
+                f"{', '.join(STAT_COLUMNS)} FROM district_stats "
+                "ORDER BY grunnkretsnummer"
+            ).fetch_df()
+        )
+
+        # save count statistics to csv
+        export_set_based_to_csv(session, district_numbers, reporting_dir)
+        export_all_tables_to_csv(session, reporting_dir)
+
+    print("Finished running all districts")
+    return
+
+
 def concat_all_csvs(geojson_dir, reporting_dir, district_numbers, projection):
     dfs = []
     for district_number in district_numbers:
@@ -665,77 +1117,103 @@ def check_parquet_files(parquet_dict):
         print(f"Cols: {df.columns}")
         print(df.head())
 
-def main(district_numbers, parquet_dir, db_path, reporting_dir):
+def main(
+    district_numbers,
+    parquet_dir,
+    db_path,
+    reporting_dir,
+    mode="per_district",
+    proximity="indexed",
+    raster_cell_size=None,
+):
+    if mode == "set_based":
+        return main_set_based(
+            district_numbers,
+            parquet_dir,
+            db_path,
+            reporting_dir,
+            proximity,
+            raster_cell_size,
+        )
+    if mode != "per_district":
+        raise ValueError(f"mode must be per_district or set_based, not <{mode}>")
 
     # add district layer to duckdb
     district_path = os.path.join(parquet_dir, f"{municipality}_districts.parquet")
     green_space_path = os.path.join(parquet_dir, f"{municipality}_green_space.parquet")
     tree_path = os.path.join(parquet_dir, f"{municipality}_tree_crowns.parquet")
-    
-    # load to duckdb
-    load_parquet_to_duckdb(district_path, "districts", db_path)
-    load_parquet_to_duckdb(green_space_path, "green_space", db_path)
-    load_parquet_to_duckdb(tree_path, "tree_crowns", db_path)
 
-    # remove per_district tables from previous run
-    remove_all_except_two(db_path, "districts", "green_space", "tree_crowns")
+    with Session(db_path) as session:
+        # load to duckdb
+        load_parquet_to_duckdb(session, district_path, "districts")
+        load_parquet_to_duckdb(session, green_space_path, "green_space")
+        load_parquet_to_duckdb(session, tree_path, "tree_crowns")
+
+        # remove per_district tables from previous run
+        remove_all_except(session, MUNICIPALITY_TABLES)
+
+        for district_number in district_numbers:
+            print(f"Running.. district number: {district_number}")
+            # get parquet files
+            parquet_dict = get_parquet_dict(district_number, parquet_dir)
+
+            # CHECK FILES FIRST TIME YOU RUN NEW STUDY AREA
+            # check_parquet_files(parquet_dict)
+
+            # load parquet files as the tables of the current district
+            for name, parquet in parquet_dict.items():
+                load_parquet_to_duckdb(
+                    session,
+                    input_parquet=parquet,
+                    output_table=current(name),
+                    replace=True,
+                )
 
-    for district_number in district_numbers:
-        print(f"Running.. district number: {district_number}")
-        # get parquet files
-        parquet_dict = get_parquet_dict(district_number, parquet_dir)
-        
-        # CHECK FILES FIRST TIME YOU RUN NEW STUDY AREA
-        #check_parquet_files(parquet_dict)
-        
-        # load parquet files to duckdb
-        for table, parquet in parquet_dict.items():
-            load_parquet_to_duckdb(
-                input_parquet=parquet, output_table=table, db_path=db_path
+            # add count columns to districts table
+            add_columns(session)
+
+            # get count statistics
+            n_trees(session)
+            n_bldg(session)
+            n_res_bldg(session)
+            n_green_spaces(session, proximity, raster_cell_size)
+            n_res_bldg_near_gs(session)
+            n_near_trees(session, proximity)
+            n_res_bldg_near_trees(session)
+            a_crown(session)
+
+            # update table (normalize and fill NANs)
+            update_table(session, district_number)
+
+            # export district to gdf
+            gdf = export_districts_to_gdf(session)
+
+            print(
+                gdf[
+                    [
+                        "delomradenummer",
+                        "grunnkretsnummer",
+                        "n_trees",
+                        "n_bldg",
+                        "n_res_bldg",
+                        "n_res_bldg_near_gs",
+                        "perc_near_gs",
+                        "n_bldg_near_trees",
+                        "perc_near_trees",
+                        "a_crown",
+                        "perc_crown",
+                    ]
+                ]
             )
 
-        # add count columns to districts table
-        add_columns(db_path, district_number)
-        
-        # get count statistics
-        COUNT_trees = n_trees(db_path, district_number)
-        COUNT_bldg = n_bldg(db_path, district_number)
-        COUNT_res_bldg = n_res_bldg(db_path, district_number)
-        n_green_spaces(db_path, district_number)
-        COUNT_n_res_bldg_near_gs = n_res_bldg_near_gs(db_path, district_number)
-        n_near_trees(db_path, district_number)
-        COUNT_res_bldg_near_trees = n_res_bldg_near_trees(db_path, district_number)
-        AREA_crown = a_crown(db_path, district_number)
-
-        # update table (normalize and fill NANs)
-        update_table(db_path, district_number)
-
-        # export district to gdf
-        gdf = export_districts_to_gdf(db_path, district_number)
+            # save count statistics to csv
+            export_district_tables_to_csv(session, district_number, reporting_dir)
 
-        print(
-            gdf[
-                [
-                    "delomradenummer",
-                    "grunnkretsnummer",
-                    "n_trees",
-                    "n_bldg",
-                    "n_res_bldg",
-                    "n_res_bldg_near_gs",
-                    "perc_near_gs",
-                    "n_bldg_near_trees",
-                    "perc_near_trees",
-                    "a_crown",
-                    "perc_crown",
-                ]
-            ]
-        )
+            print(f"Finished running district number: {district_number}")
+            # break
 
-        # save count statistics to csv
-        export_all_tables_to_csv(db_path, reporting_dir)
-
-        print(f"Finished running district number: {district_number}")
-        #break
+        # municipality tables to csv
+        export_all_tables_to_csv(session, reporting_dir)
 
     print("Finished running all districts")
     return
@@ -765,7 +1243,18 @@ if __name__ == "__main__":
     # remove duckdb database
     remove_duckdb_database(db_path)
 
-    main(district_numbers, parquet_dir, db_path, reporting_dir)
+    # per_district or set_based (all districts in one query plan)
+    # proximity: indexed, strtree or exists (PROXIMITY_ENGINES)
+    rule_params = params.get("rule_3_30_300") or {}
+    main(
+        district_numbers,
+        parquet_dir,
+        db_path,
+        reporting_dir,
+        mode=rule_params.get("mode", "per_district"),
+        proximity=rule_params.get("proximity", "indexed"),
+        raster_cell_size=rule_params.get("raster_cell_size"),
+    )
 
     # export all tables to csv
     concat_all_csvs(geojson_dir, reporting_dir, district_numbers, projection)